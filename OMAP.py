@@ -1,7 +1,11 @@
 
 
 import os
+import mmap
+import math
 import struct
+import contextlib
+import collections
 from array import array
 
 # monkey-patch array to prettyprint a *byte* array in hex
@@ -15,8 +19,605 @@ def tohex(self):
 import time
 
 from util import *
+from instrument import Observer, Phase
+from imagecache import BootImage
+from compressed import CompressedImage, compression
 
-class BaseOMAP:
+class ASICID:
+    """
+    the ASIC ID an OMAP ROM answers GET_ID with, taken apart.
+    
+    Reference: TI's OMAP4430 TRM, section 27.4.5 and table 27-19,
+    and @swetland's usbboot.c for the subblocks the TRM doesn't cover.
+    Fields the device didn't send are None.
+    """
+    __slots__ = ("model",        #e.g. 0x4430
+                 "rom_revision",
+                 "ch",           #True if the ROM's Configuration Header (CH) support is enabled, False if disabled, None if we don't know the code
+                 "iden",         #20 bytes
+                 "mpkh",         #32 bytes, a hash of the public key images have to be signed with
+                 "crc0", "crc1", #4 bytes each
+                 "unknown")      #{subblock type: bytes} for everything else
+    
+    # subblock types
+    ID = 0x01
+    UNDOCUMENTED = 0x13 #one byte, meaning unknown
+    IDEN = 0x12
+    MPKH = 0x14
+    CRC = 0x15
+    
+    _CH = {0x07: True, 0x17: False}
+    
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        self.unknown = {}
+    
+    def as_dict(self):
+        "the fields as a dict of plain ints, bools, and hex strings; e.g. for json.dumps()"
+        d = {field: getattr(self, field) for field in self.__slots__}
+        for field in ("iden", "mpkh", "crc0", "crc1"):
+            if d[field] is not None:
+                d[field] = d[field].hex().upper()
+        d["unknown"] = {type: data.hex().upper() for type, data in self.unknown.items()}
+        return d
+    
+    def __repr__(self):
+        return "<ASICID %s>" % (" ".join("%s=%r" % (field, getattr(self, field)) for field in self.__slots__),)
+    
+    def __str__(self):
+        lines = []
+        if self.model is not None:
+            lines.append("Model: %04X" % (self.model,))
+            lines.append("ROM revision: 0x%02x" % (self.rom_revision,))
+            #this has something to do with the header format of certain boot images. See the TRM.
+            lines.append("CH: %s" % ({True: "enabled", False: "disabled"}.get(self.ch, "unknown"),))
+        for type, data in sorted(self.unknown.items()):
+            lines.append("Underdocumented ASIC subblock #%d: 0x%s" % (type, data.hex().upper()))
+        for field in ("IDEN", "MPKH", "CRC0", "CRC1"):
+            value = getattr(self, field.lower())
+            if value is not None:
+                lines.append("%s: 0x%s" % (field, value.hex().upper()))
+        return "\n".join(lines)
+
+def _parse_asic_id(view, offset):
+    """
+    parse one ASIC ID out of memoryview view starting at offset;
+    return it and the offset just past its end.
+    
+    The format is a count of subblocks, then that many of (type, length, data[length]),
+    where the first byte of data is always 1.
+    This walks it with offsets so that nothing gets copied but the fields we keep.
+    """
+    asic = ASICID()
+    end = len(view)
+    if offset >= end:
+        raise ValueError("ASIC ID is empty")
+    N = view[offset]
+    offset += 1
+    for i in range(N):
+        if offset + 2 > end:
+            raise ValueError("ASIC ID truncated in the header of subblock %d of %d" % (i+1, N))
+        type, length = struct.unpack_from("BB", view, offset)
+        offset += 2
+        if offset + length > end:
+            raise ValueError("ASIC ID truncated in subblock %d of %d (type 0x%02x)" % (i+1, N, type))
+        if length < 1 or view[offset] != 1:
+            raise ValueError("ASIC ID subblock type 0x%02x is missing its fixed 0x01" % (type,))
+        start, length = offset + 1, length - 1 #skip the fixed 1
+        offset += length + 1
+        
+        if type == ASICID.ID and length == 4:
+            model, ch, asic.rom_revision = struct.unpack_from(">HBB", view, start) #the model number is written in hex just to be funny: 0x44, 0x30 for an omap4430
+            asic.model = model
+            asic.ch = ASICID._CH.get(ch)
+        ## these next ones were taken from @swetland's usbboot.c. I don't know what they mean.
+        elif type == ASICID.IDEN and length == 20:
+            asic.iden = view[start:offset].tobytes()
+        elif type == ASICID.MPKH and length == 32:
+            asic.mpkh = view[start:offset].tobytes()
+        elif type == ASICID.CRC and length == 8:
+            asic.crc0 = view[start:start+4].tobytes()
+            asic.crc1 = view[start+4:offset].tobytes()
+        else:
+            asic.unknown[type] = view[start:offset].tobytes()
+    return asic, offset
+
+def parse_asic_id(data):
+    """
+    parse the bytes-like reply to GET_ID into an ASICID.
+    raises ValueError if it is malformed or has anything trailing it.
+    """
+    with memoryview(data) as view:
+        asic, end = _parse_asic_id(view, 0)
+    if end != len(data):
+        raise ValueError("ASIC ID has %d bytes of trailing garbage" % (len(data) - end,))
+    return asic
+
+def parse_asic_ids(data):
+    """
+    parse a batch of ASIC IDs, e.g. out of an inventory database.
+    data is either an iterable of separate replies to GET_ID,
+    or one bytes-like object with replies laid end to end (each says how long it is).
+    returns a list of ASICIDs.
+    """
+    if isinstance(data, (bytes, bytearray, memoryview, array)):
+        asics = []
+        with memoryview(data) as view, view.cast("B") as view:
+            offset = 0
+            while offset < len(view):
+                asic, offset = _parse_asic_id(view, offset)
+                asics.append(asic)
+        return asics
+    return [parse_asic_id(d) for d in data]
+
+# The boot protocol, sans I/O.
+#
+# BootProtocol knows what to say to the ROM and then x-loader, and what to
+# expect back, but not how to actually talk to them or how to tell the time.
+# Whoever's driving it asks it what to do next() and does that:
+#  Enter(phase): we're on to the next step of the boot (for progress reports)
+#  Send(data, timeout): write data to the device, giving up after timeout seconds;
+#                      if .image, it's a whole boot image to be sent in chunks (and timeout is per chunk),
+#                      and if it has a .header too, that goes in the same transfer as the first chunk
+#  Receive(size, timeout): read up to size bytes, giving up after timeout seconds,
+#                          and tell the protocol what came back with receive() or that nothing did with timeout()
+#  (a timeout of None means wait forever)
+#  Confirm(prompt): wait for the operator to say go, then call confirm()
+#  Done(): that's it
+# That makes it equally at home in a blocking loop (OMAP4.boot()),
+# on an event loop (OMAP4.boot_async()), or in a test.
+# fastboot.FastbootProtocol, for what comes after u-boot, works the same way.
+
+class Enter:
+    __slots__ = ("phase",)
+    def __init__(self, phase):
+        self.phase = phase
+
+class Send:
+    __slots__ = ("data", "image", "timeout", "header")
+    def __init__(self, data, image=False, timeout=None, header=None):
+        self.data = data
+        self.image = image
+        self.timeout = timeout
+        self.header = header
+
+class Receive:
+    __slots__ = ("size", "timeout")
+    def __init__(self, size, timeout=None):
+        self.size = size
+        self.timeout = timeout
+
+class Confirm:
+    __slots__ = ("prompt",)
+    def __init__(self, prompt):
+        self.prompt = prompt
+
+class Done:
+    __slots__ = ()
+
+class ProtocolError(RuntimeError):
+    "the device said something it shouldn't have, at this point in the protocol"
+
+def _received_asic_id(data):
+    # parse_asic_id() on what the device sent: a garbled one is the device's doing (or the cable's), not the caller's
+    try:
+        return parse_asic_id(data)
+    except ValueError as e:
+        raise ProtocolError("Garbled ASIC ID from the device: %s" % (e,)) from e
+
+class Protocol:
+    """
+    what the sans-I/O protocols have in common: a queue of actions, and a deadline for each phase.
+    
+    Subclasses queue up actions in self._actions as they go, and _more(now) is
+    asked for some when it runs dry. A phase's deadline is DEADLINES (as overridden
+    by deadlines) for its name, or for the part of its name before a ":"
+    (so "flash:boot" is held to the deadline for "flash").
+    """
+    
+    DEADLINES = {}
+    
+    def __init__(self, deadlines=None):
+        self.deadlines = dict(self.DEADLINES, **(deadlines or {}))
+        self.phase = None
+        self._limit = None #the current phase's deadline, in seconds
+        self._deadline = None #when the current phase runs out of time
+        self._actions = collections.deque()
+    
+    def next(self, now):
+        """
+        what to do next. now is the time.monotonic()
+        """
+        if not self._actions:
+            self._more(now)
+        
+        action = self._actions.popleft()
+        if isinstance(action, Enter):
+            self.phase = action.phase
+            self._limit = self.deadlines.get(action.phase, self.deadlines.get(action.phase.partition(":")[0]))
+            self._deadline = None if self._limit is None else now + self._limit
+        elif isinstance(action, (Send, Receive)) and self._deadline is not None:
+            remaining = self._deadline - now
+            if remaining <= 0:
+                raise TimeoutError("%s took longer than %gs" % (self.phase, self._limit))
+            action.timeout = remaining if action.timeout is None else min(action.timeout, remaining)
+        return action
+    
+    def _more(self, now):
+        raise RuntimeError("%s is waiting for input in state %r, not for next()" % (type(self).__name__, self.state))
+
+class BootProtocol(Protocol):
+    """
+    the ROM's peripheral boot protocol, from the host's side, as a state machine.
+    
+    x_loader and u_boot are buffers holding the images
+    (or anything else with a len() that the driver knows how to send, like a CompressedImage).
+    If confirm is true it stops to Confirm() that the battery's in before sending u-boot.
+    deadlines overrides DEADLINES, phase by phase; xloader_deadline is
+    short for the one for "bringup", how many seconds to give x-loader to come up.
+    If not ask_id, the ASIC ID is waited for rather than asked for with GET_ID,
+    as over UART, where the ROM sends it by itself.
+    If coalesce, BOOT and x-loader's size go in the same transfer as the start of x-loader,
+    and u-boot's size with the start of u-boot, rather than each in a transfer of its own
+    (see OMAP4()).
+    
+    Afterwards, .asic_id holds the device's ASICID, .banner x-loader's banner,
+    and .bringup_time how many seconds x-loader took to come up.
+    """
+    
+    BANNER = 0xAABBCCDD
+    
+    # how long x-loader gets to come up after being uploaded, in seconds.
+    # They usually manage in well under a second, but it fluctuates.
+    XLOADER_DEADLINE = 10
+    # how long each attempt to read its banner waits, in seconds
+    XLOADER_POLL = 0.05
+    
+    # how long each phase gets, in seconds, before we call the device stuck (None: forever).
+    # Every Send and Receive is given at most what's left of its phase's deadline,
+    # so a device that's stopped answering is noticed promptly instead of never.
+    # These are generous: a healthy device does each of them in well under a second, except bringup.
+    DEADLINES = {"get_id": 2,
+                 "xloader_upload": 5,
+                 "bringup": XLOADER_DEADLINE,
+                 "battery": None, #that's up to the operator
+                 "uboot_upload": 15}
+    
+    def __init__(self, x_loader, u_boot, confirm=False, xloader_deadline=None, deadlines=None, ask_id=True, coalesce=False):
+        super().__init__(deadlines)
+        self.ask_id = ask_id
+        self.coalesce = coalesce
+        self.x_loader = x_loader
+        self.u_boot = u_boot
+        self.confirm_battery = confirm
+        if xloader_deadline is not None:
+            self.deadlines["bringup"] = xloader_deadline
+        self.xloader_deadline = self.deadlines["bringup"]
+        
+        self.state = "start" #start, get_id, xloader, bringup, battery, uboot, done
+        self.asic_id = None
+        self.banner = None
+        self.bringup_time = None
+        self._received = b""
+    
+    def _more(self, now):
+        if self.state == "start":
+            self.state = "get_id"
+            self._actions.extend([Enter("get_id"), Send(OMAP4.GET_ID), Receive(0xFF)] if self.ask_id else [Enter("get_id"), Receive(0xFF)])
+        elif self.state == "xloader":
+            # x-loader is all sent, and now it has to find its feet.
+            # IMPORTANT: the 2nd stage needs a moment to orient itself;
+            #            speaking to it too quickly makes things crash,
+            #            and what "too" means fluctuates a little bit.
+            # So we don't speak until spoken to: the banner is x-loader telling us it's ready.
+            # We ask for it with short reads and carry on the moment it answers,
+            # rather than sleeping for however long the slowest x-loader we've seen took.
+            self.state = "bringup"
+            self._bringup_start = now
+            self._actions.extend([Enter("bringup"), Receive(4, self.XLOADER_POLL)])
+        elif self.state == "uboot":
+            self.state = "done"
+            self._actions.append(Done())
+        else:
+            super()._more(now)
+    
+    def receive(self, data, now):
+        """
+        the device said data in reply to a Receive
+        """
+        if self.state == "get_id":
+            self.asic_id = _received_asic_id(data)
+            
+            # upload 2nd stage (x-loader) via the 1st stage
+            self.state = "xloader"
+            self._actions.append(Enter("xloader_upload"))
+            self._upload(self.x_loader, OMAP4.BOOT)
+        
+        elif self.state == "bringup":
+            # read x-loader "banner"
+            # By convention(?) this is only printed by x-loaders that are awaiting a u-boot download over USB
+            # The NAND x-loader that came with your device won't print it, for example.
+            self._received += data
+            if len(self._received) < 4:
+                return self.timeout(now) #nothing (or not enough) yet; same as a timeout
+            self.bringup_time = now - self._bringup_start
+            self.banner, = struct.unpack("I", self._received[:4]) #< the comma is because struct returns a tuple of as many items as you tell it to expect
+            if self.banner != self.BANNER:
+                raise ProtocolError("Unexpected banner `0x%X` from what should have been x-loader." % (self.banner,))
+            
+            # We also need to ensure the battery is in before we continue,
+            # because U-Boot will shut down if it finds no battery.
+            # (this is the source of the "wait 4 seconds" myth on xda-developer.com's LG-p760 subforum:
+            #  if the usb boot doesn't wait for you, you need to time it so that you start with the battery
+            #  out so that the OMAP protocol is available, but you put the battery in before U-Boot comes up)
+            # Possibly this could replace the sleep() above,
+            # but it is useful to be able for the user to see the banner came through properly at the same time they are putting in the bbatter
+            # Note: this assumes that all x-loaders you use with this program
+            # will be happy to wait indefinitely for you!
+            if self.confirm_battery:
+                self.state = "battery"
+                self._actions.extend([Enter("battery"), Confirm("Insert battery and press enter to upload u-boot > ")])
+            else:
+                self._upload_uboot()
+        
+        else:
+            raise RuntimeError("BootProtocol wasn't expecting anything in state %r" % (self.state,))
+    
+    def timeout(self, now):
+        """
+        a Receive ran out of time without hearing anything
+        """
+        if self.state != "bringup":
+            raise TimeoutError("Timed out waiting for the device during %s" % (self.phase,))
+        if self._deadline is not None and now >= self._deadline:
+            raise TimeoutError("x-loader did not come up within %gs" % (self.xloader_deadline,))
+        self._actions.append(Receive(4 - len(self._received), self.XLOADER_POLL))
+    
+    def confirm(self):
+        """
+        the operator says to go ahead (the battery's in)
+        """
+        if self.state != "battery":
+            raise RuntimeError("BootProtocol wasn't asking for confirmation in state %r" % (self.state,))
+        self._upload_uboot()
+    
+    def _upload_uboot(self):
+        self.state = "uboot"
+        self._actions.append(Enter("uboot_upload"))
+        self._upload(self.u_boot)
+    
+    def _upload(self, image, command=None):
+        # [command,] size, image: each in a transfer of its own, or all in one go if coalescing
+        size = struct.pack("I", len(image))
+        if self.coalesce:
+            self._actions.append(Send(image, image=True, header=(command or b"") + size))
+            return
+        if command is not None:
+            self._actions.append(Send(command))
+        self._actions.extend([Send(size), Send(image, image=True)])
+
+class IdentifyProtocol(Protocol):
+    """
+    just the first step of BootProtocol: ask the ROM for its ASIC ID (or, if not ask_id, wait for it),
+    and leave it at that, still in the ROM and waiting to be booted.
+    
+    Afterwards .asic_id holds the device's ASICID.
+    """
+    
+    DEADLINES = {"get_id": BootProtocol.DEADLINES["get_id"]}
+    
+    def __init__(self, deadlines=None, ask_id=True):
+        super().__init__(deadlines)
+        self.ask_id = ask_id
+        self.state = "start" #start, get_id, done
+        self.asic_id = None
+    
+    def _more(self, now):
+        if self.state == "start":
+            self.state = "get_id"
+            self._actions.extend([Enter("get_id"), Send(OMAP4.GET_ID), Receive(0xFF)] if self.ask_id else [Enter("get_id"), Receive(0xFF)])
+        elif self.state == "done":
+            self._actions.append(Done())
+        else:
+            super()._more(now)
+    
+    def receive(self, data, now):
+        """
+        the device said data in reply to a Receive
+        """
+        if self.state != "get_id":
+            raise RuntimeError("IdentifyProtocol wasn't expecting anything in state %r" % (self.state,))
+        self.asic_id = _received_asic_id(data)
+        self.state = "done"
+    
+    def timeout(self, now):
+        """
+        a Receive ran out of time without hearing anything
+        """
+        raise TimeoutError("Timed out waiting for the device during %s" % (self.phase,))
+
+class Driver:
+    """
+    runs a sans-I/O protocol (see above) against a port,
+    either blocking (_run()) or on asyncio (_run_async()).
+    
+    Subclasses say what to print() along the way with _report(),
+    and pick the results out of the finished protocol with _finish().
+    """
+    
+    # how many chunks of a compressed image to decompress ahead of the one being sent
+    READ_AHEAD = 4
+    
+    def __init__(self, port, verbose=True, observer=None):
+        """
+        port: a file-like object in read/write mode which
+              should be connected to the device (e.g. a usbbulk.BulkUSB).
+        verbose: whether to print() progress as we go.
+                 Turn this off when driving several devices at once,
+                 or their progress reports will be interleaved into mush.
+        observer: an instrument.Observer to tell about the
+                  timing of each phase and each chunk of every image sent
+        """
+        
+        self._dev = port
+        self.verbose = verbose
+        self.observer = observer if observer is not None else Observer()
+    
+    def _say(self, *args, **kwargs):
+        if self.verbose:
+            print(*args, **kwargs)
+        
+    def confirm(self, prompt):
+        """
+        wait for the operator to say it's OK to go on (i.e. the battery is in).
+        
+        This asks on the terminal; replace it to ask somewhere else.
+        """
+        input(prompt)
+    
+    def _send_image(self, data, header=None):
+        # The device has always been told how much is coming, so no zero-length packet at the end.
+        chunksize = getattr(self._dev, "transfer_size", 4096)
+        if not isinstance(data, CompressedImage):
+            return write_buffer(data, self._dev, chunksize, on_chunk=self.observer.chunk, header=header)
+        # decompress on another thread, overlapped with sending
+        return write_chunks(data.chunks(chunksize, self.READ_AHEAD), self._dev, self.observer.chunk, header)
+    
+    def _run(self, protocol):
+        """
+        drive protocol to the end, blocking.
+        """
+        driver = self._drive(protocol)
+        result, error = None, None
+        while True:
+            try:
+                call = driver.send(result) if error is None else driver.throw(error)
+            except StopIteration:
+                return
+            try:
+                result, error = call(), None
+            except Exception as e:
+                result, error = None, e
+    
+    async def _run_async(self, protocol):
+        """
+        drive protocol to the end on the running event loop, with the blocking
+        calls (the port's read()s and write()s, and confirm()) handed off to its default executor.
+        
+        If this is cancelled, the call in flight can't be: it carries on in its thread.
+        So the cancellation is only let through once that call is over, so that
+        whoever cancelled us can close the port without pulling it out from under it.
+        """
+        import asyncio #here rather than up top, since it takes longer to import than everything else put together
+        loop = asyncio.get_running_loop()
+        driver = self._drive(protocol)
+        result, error = None, None
+        while True:
+            try:
+                call = driver.send(result) if error is None else driver.throw(error)
+            except StopIteration:
+                return
+            future = loop.run_in_executor(None, call)
+            try:
+                result, error = await asyncio.shield(future), None
+            except asyncio.CancelledError:
+                while not future.done():
+                    try:
+                        await asyncio.wait([future])
+                    except asyncio.CancelledError:
+                        pass #cancelled again; we know, and we're still waiting
+                if not future.cancelled():
+                    future.exception() #whatever it was, it's moot now; this just stops asyncio complaining nobody looked
+                raise
+            except Exception as e:
+                result, error = None, e
+    
+    def _drive(self, protocol):
+        """
+        run protocol against our port.
+        
+        This is a generator so that it can be shared between _run() and _run_async():
+        instead of doing blocking I/O itself it yields a function that does it,
+        and whoever's running it sends back the result, or throws in the exception.
+        """
+        timeout = getattr(self._dev, "timeout", None) #to put back afterwards
+        has_timeout = hasattr(self._dev, "timeout")
+        phase = None
+        
+        def within(seconds, io):
+            # pass the action's timeout down to the port (in its milliseconds);
+            # ports with no notion of a timeout (e.g. a plain file) just block
+            def call():
+                if has_timeout:
+                    self._dev.timeout = timeout if seconds is None else max(math.ceil(seconds * 1000), 1)
+                return io()
+            return call
+        try:
+            while True:
+                action = protocol.next(time.monotonic())
+                
+                if isinstance(action, Enter):
+                    if phase is not None:
+                        phase.__exit__(None, None, None)
+                    self._report(phase and phase.name, action.phase, protocol)
+                    phase = Phase(self.observer, action.phase).__enter__()
+                
+                elif isinstance(action, Send):
+                    try:
+                        if action.image:
+                            phase.nbytes += yield within(action.timeout, lambda: self._send_image(action.data, action.header))
+                        else:
+                            yield within(action.timeout, lambda: self._dev.write(action.data))
+                    except OSError as e:
+                        if not is_timeout(e):
+                            raise
+                        raise TimeoutError("Timed out sending to the device during %s" % (phase.name,)) from e
+                
+                elif isinstance(action, Receive):
+                    try:
+                        data = yield within(action.timeout, lambda: self._dev.read(action.size))
+                    except OSError as e:
+                        if not is_timeout(e):
+                            raise
+                        protocol.timeout(time.monotonic())
+                    else:
+                        phase.nbytes += len(data)
+                        protocol.receive(data, time.monotonic())
+                        self._report(phase.name, phase.name, protocol)
+                
+                elif isinstance(action, Confirm):
+                    yield (lambda: self.confirm(action.prompt))
+                    protocol.confirm()
+                
+                elif isinstance(action, Done):
+                    break
+        except BaseException as e:
+            if phase is not None:
+                phase.__exit__(type(e), e, e.__traceback__)
+            raise
+        else:
+            phase.__exit__(None, None, None)
+            self._report(phase.name, None, protocol)
+        finally:
+            if has_timeout:
+                self._dev.timeout = timeout
+        self._finish(protocol)
+    
+    def _report(self, old, new, protocol):
+        """
+        the running commentary: called as the protocol moves from phase old to phase new
+        (either of which is None at the ends), and with old == new whenever something arrives.
+        """
+        pass
+    
+    def _finish(self, protocol):
+        """
+        protocol has finished successfully; keep whatever's worth keeping out of it.
+        """
+        pass
+
+class BaseOMAP(Driver):
     pass
 
 class OMAP4(BaseOMAP):
@@ -70,130 +671,134 @@ class OMAP4(BaseOMAP):
     locals().update(messages)
     del messages
     
-    def __init__(self, port):
+    XLOADER_DEADLINE = BootProtocol.XLOADER_DEADLINE
+    
+    asic_id = None #the ASICID the device gave on the last boot
+    bringup_time = None #seconds x-loader took to come up on the last boot
+    
+    def __init__(self, port, verbose=True, observer=None, coalesce=False):
         """
-        port: a file-like object in read/write mode which
-              should be connected to an OMAP device.
+        coalesce: whether to send BOOT and each image's size in the same USB transfer as the start of the image,
+                  rather than in transfers of their own, which saves three round trips per boot. That's only worth
+                  anything where round trips are slow (behind a few hubs, say): at a microframe apiece it's well under
+                  a millisecond of a boot that takes seconds. Off by default, since separate transfers are how TI's
+                  own tools talk to the ROM, and so what every ROM is known to take; a ROM that wants its commands alone
+                  loses the start of x-loader, which then never comes up (a TimeoutError).
+                  Try it with yours (omapboot --coalesce) before relying on it.
+        The rest are as for Driver.
         """
+        super().__init__(port, verbose, observer)
+        self.coalesce = coalesce
+    
+    def id(self, deadlines=None):
+        """
+        ask the ROM for its ASIC ID; returns an ASICID.
         
-        self._dev = port
-        
-    def id(self):
-        self._dev.write(self.GET_ID)
-        id = self._dev.read(1<<10)
-        return id #TODO: parse this
+        Unlike boot(), this leaves the device open, and in the ROM, ready to be boot()ed
+        (or asked again). deadlines is as for boot(); only "get_id" matters.
+        """
+        protocol = IdentifyProtocol(deadlines, self._asks_id())
+        self._run(protocol)
+        return protocol.asic_id
     
-    def upload(self, fname):
+    def upload(self, image):
         """
         
         OMAP uses the world's simplest uploading protocol:
          say how much then say the stuff.
-        """
-        # content-length header
-        size = os.stat(fname).st_size
-        self._dev.write(struct.pack("I", size))
         
-        # content
-        readinto_io(open(fname, "rb"), self._dev)
+        image is either a file name (of a raw or compressed image) or an imagecache.BootImage.
+        
+        returns the number of bytes of image sent
+        """
+        with image_buffer(image) as data:
+            # content-length header
+            header = struct.pack("I", len(data))
+            if self.coalesce:
+                return self._send_image(data, header)
+            self._dev.write(header)
+            # content
+            return self._send_image(data)
     
-    def boot(self, x_loader, u_boot, AUTOFLAG=False):
+    def boot(self, x_loader, u_boot, AUTOFLAG=False, xloader_deadline=None, deadlines=None):
         """
-        x_loader and u_boot should be filenames so that we can stat them for their filesizes
+        x_loader and u_boot should be filenames so that we can stat them for their filesizes,
+         or imagecache.BootImages
+         (files compressed with gzip, xz or zstd are decompressed on the fly: see compressed.py)
          note: you are not obligated to actually provide a u-boot instance. any raw ARM program can in theory be uploaded, so long as its suitable for just dumping into RAM and jumping into
         
+        xloader_deadline is how many seconds to give x-loader to come up,
+        and deadlines is {phase: seconds} for how long each phase may take (see BootProtocol.DEADLINES).
+        Running out of time raises a TimeoutError.
+        
         closes the USB device when done, since booting means replacing what this class is designed to talk to
         """
-        self._dev.write(self.GET_ID)
-        ASIC = self._dev.read(0xFF)
-
-        def split_ASIC_blocks(ASIC):
-            ASIC = array("B", ASIC)
-            N = ASIC.pop(0)
-            for i in range(N):
-                type = ASIC.pop(0)
-                length = ASIC.pop(0)
-                assert length <= len(ASIC), "Don't overflow! Python will silently let us overflow if we're not careful"
-                data, ASIC = ASIC[:length], ASIC[length:]
-                assert data.pop(0) == 1, "Fixed value, e.g. as in TRM table 27-19"
-                yield type, data
-            assert not ASIC, "ASIC should be empty once we've parsed all its blocks"
-        
-        def parse_ASIC_blocks(ASIC):
-            for type, data in split_ASIC_blocks(ASIC):
-                # TODO: clean this up with some classes and a nice dictionary lookup
-                #print(type, data) #DEBUG
-                if type == 0x01:
-                    assert len(data) == 4
-                    model, ch_enabled, version = data[:2], data[2], data[3]
-                    assert model.tobytes() == b"\x44\x30", "model number, written in hex just to be funny"
-                    ch_enabled = {0x07: "enabled", 0x17: "disabled"}.get(ch_enabled, "unknown")
-                    print("Model:", tohex(model)[2:])
-                    print("ROM revision: 0x%02x" % (version,))
-                    print("CH:", ch_enabled) #this has something to do with the header format of certain boot images. See the TRM.
-                
-                ## these next ones were taken from @swetland's usbboot.c. I don't know what they mean.
-                elif type == 18:
-                   assert len(data) == 20
-                   print("IDEN:", tohex(data))
-                elif type == 19:
-                    # unknown and undocumented
-                    assert len(data) == 1
-                    print("Underdocumented ASIC subblock #18: %02X"  % (data[0],))
-                elif type == 20:
-                    assert len(data) == 32
-                    print("MPKH:", tohex(data))
-                elif type == 21:
-                    assert len(data) == 8
-                    CRC0, CRC1 = data[:4], data[4:]
-                    print("CRC0:", tohex(CRC0))
-                    print("CRC0:", tohex(CRC1))
-        
-        print()
-        print("recevied ASIC ID banner:")
-        parse_ASIC_blocks(ASIC)
-
-        # upload 2nd stage (x-loader) via the 1st stage
-        self._dev.write(self.BOOT)
-        
-        print()
-        print("Uploading x-loader...", end="", flush=True);
-        self.upload(x_loader)
-        print("done.")
-        
-        # IMPORTANT: the 2nd stage needs a moment to orient itself;
-        #            speaking to it too quickly makes things crash,
-        #            and what "too" means fluctuates a little bit.
-        print("Giving x-loader a chance to come up", end="", flush=True)
-        for i in range(3):
-            print(".", end="", flush=True);
-            time.sleep(1)
-        print()
-        
-        # read x-loader "banner"
-        # By convention(?) this is only printed by x-loaders that are awaiting a u-boot download over USB
-        # The NAND x-loader that came with your device won't print it, for example.
-        banner = self._dev.read(4)
-        banner, = struct.unpack("I", banner) #< the comma is because struct returns a tuple of as many items as you tell it to expect
-        assert banner == 0xAABBCCDD, "Unexpected banner `0x%X` from what should have been x-loader." % (notice)
-        
-        print('Received boot banner ("0x%X") from x-loader.' % (banner,))
-        
-        # We also need to ensure the battery is in before we continue,
-        # because U-Boot will shut down if it finds no battery.
-        # (this is the source of the "wait 4 seconds" myth on xda-developer.com's LG-p760 subforum:
-        #  if the usb boot doesn't wait for you, you need to time it so that you start with the battery
-        #  out so that the OMAP protocol is available, but you put the battery in before U-Boot comes up)
-        # Possibly this could replace the sleep() above,
-        # but it is useful to be able for the user to see the banner came through properly at the same time they are putting in the bbatter
-        # Note: this assumes that all x-loaders you use with this program
-        # will be happy to wait indefinitely for you!
-        if not AUTOFLAG:
-            input("Insert battery and press enter to upload u-boot > ")
-        
-        print("Uploading u-boot... ", end="", flush=True);
-        self.upload(u_boot)
-        print("done.", flush=True);
-        
+        with image_buffer(x_loader) as x_loader, image_buffer(u_boot) as u_boot:
+            self._run(BootProtocol(x_loader, u_boot, not AUTOFLAG, xloader_deadline, deadlines, self._asks_id(), self.coalesce))
         
         # close the device because there's nothing left to dooo
         self._dev.close()
+    
+    async def boot_async(self, x_loader, u_boot, AUTOFLAG=False, xloader_deadline=None, deadlines=None):
+        """
+        boot(), for asyncio.
+        
+        The protocol and all the waiting run on the event loop, so one thread can
+        keep any number of these going, e.g. with asyncio.gather(); the port's
+        blocking read()s and write()s (and confirm(), if not AUTOFLAG) are
+        handed off to the loop's default executor.
+        """
+        with image_buffer(x_loader) as x_loader, image_buffer(u_boot) as u_boot:
+            await self._run_async(BootProtocol(x_loader, u_boot, not AUTOFLAG, xloader_deadline, deadlines, self._asks_id(), self.coalesce))
+        self._dev.close()
+    
+    def _asks_id(self):
+        # whether to ask for the ASIC ID, or whether the port says the ROM will send it anyway (see uart.SerialPort)
+        return not getattr(self._dev, "announces_id", False)
+    
+    def _finish(self, protocol):
+        self.asic_id = protocol.asic_id
+        if isinstance(protocol, BootProtocol):
+            self.bringup_time = protocol.bringup_time
+    
+    def _report(self, old, new, protocol):
+        # the running commentary, for people watching boot() go
+        if old == new:
+            return
+        if new == "xloader_upload":
+            self._say()
+            self._say("recevied ASIC ID banner:")
+            self._say(protocol.asic_id)
+            self._say()
+            self._say("Uploading x-loader...", end="", flush=True);
+        elif new == "bringup":
+            self._say("done.")
+            self._say("Giving x-loader a chance to come up...", end="", flush=True)
+        elif old == "bringup":
+            self._say("up after %.2fs." % (protocol.bringup_time,))
+            self._say('Received boot banner ("0x%X") from x-loader.' % (protocol.banner,))
+        if new == "uboot_upload":
+            self._say("Uploading u-boot... ", end="", flush=True);
+        elif old == "uboot_upload":
+            self._say("done.", flush=True);
+
+@contextlib.contextmanager
+def image_buffer(image):
+    """
+    get at the contents of a boot image, which is either
+    a file name or an imagecache.BootImage, as a buffer;
+    or, if it's a compressed file, as a compressed.CompressedImage.
+    """
+    if isinstance(image, BootImage):
+        yield image.data
+        return
+    with open(image, "rb") as f:
+        if compression(f) is not None:
+            yield CompressedImage(image)
+            return
+        if not os.fstat(f.fileno()).st_size:
+            yield b"" #mmap refuses to map empty files
+            return
+        # map the image rather than read() it, so we send straight out of the page cache.
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+benchmarks for omapboot, against the simulated OMAP4 (and fastboot device) in usbbulk.sim,
+so they run on any old Linux box with no phone attached.
+
+usage: python bench.py [-n REPEAT] [--bandwidth BYTES_PER_S] [--latency SECONDS] [--xloader-latency SECONDS] [BENCHMARK...]
+
+Each benchmark is run REPEAT times over the images in images/ and we report
+the best and median times and the throughput of the best, which is the
+figure least disturbed by whatever else the machine was doing.
+
+The startup benchmark is also a check: it exits non-zero if importing
+omapboot (from the checkout, and from dist/omapboot.pyz if that's been built)
+takes longer than STARTUP_BUDGET more than starting python does, or drags in any of LAZY_MODULES.
+"""
+
+import os
+import sys
+import glob
+import subprocess
+import time
+import argparse
+import statistics
+
+from util import readinto_io, write_buffer
+from OMAP import OMAP4, parse_asic_ids
+from usbbulk.sim import SimulatedOMAP4, SimulatedFastboot
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMAGES = sorted(glob.glob(os.path.join(HERE, "images", "*", "*")))
+CHUNK_SIZES = [512, 4096, 16*1024, 64*1024]
+
+# how much longer than starting python at all `import omapboot` may take, in seconds
+STARTUP_BUDGET = 0.05
+# what importing omapboot mustn't import (yet): the USB backends, and what only some modes need
+LAZY_MODULES = ["usb", "usbbulk.ugen", "usbbulk.usbfs", "usbbulk.pyusb", "usbbulk.pinning", "usbbulk.hotplug", "ctypes.util",
+                "asyncio", "concurrent.futures", "multiprocessing", "hashlib", "daemon", "zstandard"]
+
+class NullSink:
+    "a write()able that throws everything away, to measure just our side of the copying"
+    def write(self, data):
+        return len(data)
+
+def measure(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+def report(name, params, nbytes, best, median):
+    throughput = "%9.1fMB/s" % (nbytes / best / 1e6 if best else float("inf"),) if nbytes is not None else ""
+    print("%-18s %-44s %9.2fms %9.2fms %s" % (name, params, best * 1e3, median * 1e3, throughput), flush=True)
+
+def bench_readinto_io(args):
+    for image in IMAGES:
+        size = os.path.getsize(image)
+        for chunksize in CHUNK_SIZES:
+            def run():
+                with open(image, "rb") as f:
+                    readinto_io(f, NullSink(), chunksize)
+            report("readinto_io", "%s chunk=%d" % (os.path.basename(image), chunksize), size, *measure(run, args.repeat))
+
+def bench_write_buffer(args):
+    import mmap
+    for image in IMAGES:
+        size = os.path.getsize(image)
+        for chunksize in CHUNK_SIZES:
+            def run():
+                with open(image, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    write_buffer(m, NullSink(), chunksize)
+            report("write_buffer", "%s chunk=%d" % (os.path.basename(image), chunksize), size, *measure(run, args.repeat))
+
+def simulator(args, **kwargs):
+    return SimulatedOMAP4(bandwidth=args.bandwidth, latency=args.latency, xloader_latency=args.xloader_latency, **kwargs)
+
+def bench_upload(args):
+    for image in IMAGES:
+        size = os.path.getsize(image)
+        for chunksize in CHUNK_SIZES:
+            def run():
+                dev = simulator(args)
+                dev.TRANSFER_SIZE = chunksize
+                dev.write(OMAP4.BOOT) #get the ROM ready to receive
+                OMAP4(dev, verbose=False).upload(image)
+                assert dev.state == "bringup"
+            report("upload", "%s chunk=%d" % (os.path.basename(image), chunksize), size, *measure(run, args.repeat))
+
+def bench_upload_compressed(args):
+    # the same images, stored raw and compressed: compression shouldn't cost wall-clock time,
+    # as long as decompressing a chunk is quicker than sending one
+    import gzip, lzma, tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        for image in IMAGES:
+            size = os.path.getsize(image)
+            with open(image, "rb") as f:
+                data = f.read()
+            name = os.path.join(tmp, os.path.basename(image))
+            with gzip.open(name + ".gz", "wb") as f:
+                f.write(data)
+            with lzma.open(name + ".xz", "wb") as f:
+                f.write(data)
+            for stored in (image, name + ".gz", name + ".xz"):
+                def run():
+                    dev = simulator(args)
+                    dev.write(OMAP4.BOOT)
+                    OMAP4(dev, verbose=False).upload(stored)
+                    assert dev.state == "bringup"
+                report("upload_compressed", os.path.basename(stored) if stored != image else os.path.basename(image) + " (raw)",
+                       size, *measure(run, args.repeat))
+
+def bench_boot(args):
+    for aboot in sorted(glob.glob(os.path.join(HERE, "images", "*", "*aboot*"))):
+        for uboot in sorted(glob.glob(os.path.join(os.path.dirname(aboot), "*u-boot*"))):
+            size = os.path.getsize(aboot) + os.path.getsize(uboot)
+            def run():
+                dev = simulator(args)
+                OMAP4(dev, verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+                assert dev.state == "booted"
+            report("boot", os.path.basename(uboot), size, *measure(run, args.repeat))
+
+def bench_coalesce(args):
+    # boots with BOOT and the sizes in transfers of their own, and coalesced with the images;
+    # the difference is what the saved round trips are worth at --latency per transfer
+    for aboot in sorted(glob.glob(os.path.join(HERE, "images", "*", "*aboot*"))):
+        for uboot in sorted(glob.glob(os.path.join(os.path.dirname(aboot), "*u-boot*"))):
+            size = os.path.getsize(aboot) + os.path.getsize(uboot)
+            for coalesce in (False, True):
+                transfers = []
+                def run():
+                    dev = simulator(args)
+                    OMAP4(dev, verbose=False, coalesce=coalesce).boot(aboot, uboot, AUTOFLAG=True)
+                    assert dev.state == "booted"
+                    assert dev.images["x-loader"] == open(aboot, "rb").read() and dev.images["u-boot"] == open(uboot, "rb").read()
+                    transfers.append(dev.transfers)
+                times = measure(run, args.repeat)
+                report("coalesce", "%s %s (%d transfers)" % (os.path.basename(uboot), "coalesced" if coalesce else "separate", transfers[-1]),
+                       size, *times)
+
+def bench_fastboot(args):
+    # flash each image, stored raw and compressed, to a simulated fastboot device and reboot it,
+    # both blocking and on an event loop (whose figures include starting the event loop up)
+    import asyncio, gzip, lzma, tempfile
+    from fastboot import Fastboot
+    with tempfile.TemporaryDirectory() as tmp:
+        for image in IMAGES:
+            size = os.path.getsize(image)
+            with open(image, "rb") as f:
+                data = f.read()
+            name = os.path.join(tmp, os.path.basename(image))
+            with gzip.open(name + ".gz", "wb") as f:
+                f.write(data)
+            with lzma.open(name + ".xz", "wb") as f:
+                f.write(data)
+            for stored in (image, name + ".gz", name + ".xz"):
+                for blocking in (True, False):
+                    def run():
+                        dev = SimulatedFastboot(bandwidth=args.bandwidth, latency=args.latency)
+                        if blocking:
+                            Fastboot(dev, verbose=False).flash([("boot", stored)], reboot=True)
+                        else:
+                            asyncio.run(Fastboot(dev, verbose=False).flash_async([("boot", stored)], reboot=True))
+                        assert dev.partitions["boot"] == data
+                        assert dev.state == "rebooted" and dev.commands[-1] == "reboot"
+                    report("fastboot", "%s %s" % (os.path.basename(stored) if stored != image else os.path.basename(image) + " (raw)",
+                                                  "flash" if blocking else "flash_async"),
+                           size, *measure(run, args.repeat))
+
+def bench_capture(args):
+    # what recording a boot costs (compare with the boot benchmark), and how quickly it plays back
+    import tempfile
+    from usbbulk.capture import Recorder, Replay
+    for aboot in sorted(glob.glob(os.path.join(HERE, "images", "*", "*aboot*"))):
+        for uboot in sorted(glob.glob(os.path.join(os.path.dirname(aboot), "*u-boot*"))):
+            size = os.path.getsize(aboot) + os.path.getsize(uboot)
+            with tempfile.TemporaryDirectory() as tmp:
+                capture = os.path.join(tmp, "boot.omapcap")
+                def record():
+                    dev = simulator(args)
+                    OMAP4(Recorder(dev, capture), verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+                    assert dev.state == "booted"
+                report("capture", "%s recording" % (os.path.basename(uboot),), size, *measure(record, args.repeat))
+                for speed in (1, 0):
+                    def replay():
+                        port = Replay(capture, speed)
+                        OMAP4(port, verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+                        assert port.remaining == 0
+                    report("capture", "%s replay speed=%g" % (os.path.basename(uboot), speed), size, *measure(replay, args.repeat))
+
+def bench_uart(args):
+    # boot over uart.SerialPort, against a simulated OMAP4 on the other end of a pty pair:
+    # ptys are as fast as memory, so the line's speed is the simulator's bandwidth
+    import pty, select, threading
+    from uart import SerialPort
+    def serve(dev, master, stop):
+        while True:
+            if select.select([master], [], [], 0.001)[0]:
+                dev.timeout = None #take as long as the simulated line takes
+                dev.write(os.read(master, 1 << 16))
+            elif stop.is_set():
+                break #once whatever was still in the pty has been had
+            dev.timeout = 1 #but don't wait around for the simulated x-loader to come up
+            while True:
+                try:
+                    os.write(master, dev.read(1 << 16))
+                except OSError:
+                    break
+    for aboot in sorted(glob.glob(os.path.join(HERE, "images", "*", "*aboot*"))):
+        for uboot in sorted(glob.glob(os.path.join(os.path.dirname(aboot), "*u-boot*"))):
+            size = os.path.getsize(aboot) + os.path.getsize(uboot)
+            for baud in (3000000, None):
+                def run():
+                    master, slave = pty.openpty()
+                    port = SerialPort(os.ttyname(slave), 3000000) #first, as it throws away anything already sent
+                    dev = SimulatedOMAP4(bandwidth=baud and baud / 10, xloader_latency=args.xloader_latency, announce_id=True)
+                    stop = threading.Event()
+                    server = threading.Thread(target=serve, args=(dev, master, stop))
+                    server.start()
+                    try:
+                        OMAP4(port, verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+                    finally:
+                        stop.set()
+                        server.join()
+                        os.close(master)
+                        os.close(slave)
+                    assert dev.state == "booted"
+                report("uart", "%s %s" % (os.path.basename(uboot), "%d baud" % (baud,) if baud else "unthrottled"), size, *measure(run, args.repeat))
+
+def bench_tuning(args):
+    # boot the simulator with a Tuner until it's settled on a transfer size, then boot with what it settled on.
+    # Settling always takes len(CANDIDATES) * SAMPLES boots; what's measured is booting with the
+    # backend's default, booting while the tuner tries sizes out, and booting once it's done
+    import tempfile
+    from tuning import Tuner, CANDIDATES, SAMPLES
+    aboot = sorted(glob.glob(os.path.join(HERE, "images", "*", "*aboot*")))[0]
+    uboot = sorted(glob.glob(os.path.join(os.path.dirname(aboot), "*u-boot*")))[0]
+    size = os.path.getsize(aboot) + os.path.getsize(uboot)
+    with tempfile.TemporaryDirectory() as tmp:
+        tuner = Tuner(os.path.join(tmp, "transfer-sizes.json"), explore=True)
+        def run(tuner=tuner):
+            dev = simulator(args, path="1-1")
+            observer = tuner.tune(dev, "omap44") if tuner else None
+            OMAP4(dev, verbose=False, observer=observer).boot(aboot, uboot, AUTOFLAG=True)
+            assert dev.state == "booted"
+        report("tuning", "%s untuned (chunk=%d)" % (os.path.basename(uboot), simulator(args).transfer_size), size,
+               *measure(lambda: run(None), args.repeat))
+        report("tuning", "%s while tuning" % (os.path.basename(uboot),), size, *measure(run, len(CANDIDATES) * SAMPLES))
+        best = tuner.transfer_size(Tuner.key(simulator(args, path="1-1"), "omap44"))
+        report("tuning", "%s tuned (chunk=%d)" % (os.path.basename(uboot), best), size, *measure(run, args.repeat))
+
+def bench_parse_asic_ids(args):
+    for n in (1, 1000, 100000):
+        batch = SimulatedOMAP4.ASIC_ID * n
+        report("parse_asic_ids", "%d IDs, end to end" % (n,), len(batch), *measure(lambda: parse_asic_ids(batch), args.repeat))
+
+def bench_startup(args):
+    # in a fresh interpreter every time, since it's the cold start we care about
+    def python(*argv):
+        return lambda: subprocess.run([sys.executable] + list(argv), cwd=HERE, stdout=subprocess.DEVNULL, check=True)
+    baseline = measure(python("-c", "pass"), args.repeat)
+    report("startup", "python -c pass", None, *baseline)
+    imported = measure(python("-c", "import omapboot"), args.repeat)
+    report("startup", "import omapboot", None, *imported)
+    report("startup", "omapboot --help", None, *measure(python("omapboot.py", "--help"), args.repeat))
+    checks = [("omapboot", "", imported)]
+    pyz = os.path.join(HERE, "dist", "omapboot.pyz")
+    if os.path.exists(pyz):
+        # the pyz is what gets copied onto line-control machines, so it's held to the same budget
+        prelude = "import sys; sys.path.insert(0, %r); " % (pyz,)
+        imported = measure(python("-c", prelude + "import omapboot"), args.repeat)
+        report("startup", "import omapboot from omapboot.pyz", None, *imported)
+        report("startup", "omapboot.pyz --help", None, *measure(python(pyz, "--help"), args.repeat))
+        checks.append(("omapboot.pyz", prelude, imported))
+
+    ok = True
+    for name, prelude, imported in checks:
+        if imported[0] - baseline[0] > STARTUP_BUDGET:
+            print("startup: importing %s took %.1fms more than starting python, over the %.1fms budget"
+                  % (name, (imported[0] - baseline[0]) * 1e3, STARTUP_BUDGET * 1e3))
+            ok = False
+        loaded = subprocess.run([sys.executable, "-c", prelude + "import sys, omapboot; print(*(m for m in %r if m in sys.modules))" % (LAZY_MODULES,)],
+                                cwd=HERE, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout.split()
+        if loaded:
+            print("startup: importing %s imported %s, which it should leave until they're needed" % (name, ", ".join(loaded)))
+            ok = False
+    return ok
+
+BENCHMARKS = {"readinto_io": bench_readinto_io,
+              "write_buffer": bench_write_buffer,
+              "upload": bench_upload,
+              "upload_compressed": bench_upload_compressed,
+              "boot": bench_boot,
+              "coalesce": bench_coalesce,
+              "fastboot": bench_fastboot,
+              "capture": bench_capture,
+              "uart": bench_uart,
+              "tuning": bench_tuning,
+              "parse_asic_ids": bench_parse_asic_ids,
+              "startup": bench_startup}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark omapboot against a simulated OMAP4.")
+    parser.add_argument("-n", "--repeat", type=int, default=5,
+                        help="how many times to run each benchmark (default: %(default)s)")
+    parser.add_argument("--bandwidth", type=float, default=40e6,
+                        help="simulated bus bandwidth in bytes/second (default: %(default)g, about what USB 2.0 bulk manages)")
+    parser.add_argument("--latency", type=float, default=125e-6,
+                        help="simulated per-transfer overhead in seconds (default: %(default)g, one microframe)")
+    parser.add_argument("--xloader-latency", type=float, default=0.3,
+                        help="simulated x-loader bring-up time in seconds (default: %(default)s)")
+    parser.add_argument("benchmarks", nargs="*", choices=[[]] + list(BENCHMARKS), metavar="BENCHMARK",
+                        help="which benchmarks to run: %s (default: all)" % ", ".join(BENCHMARKS))
+    args = parser.parse_args()
+
+    print("%-18s %-44s %11s %11s %13s" % ("benchmark", "parameters", "best", "median", "throughput"))
+    failed = [name for name in args.benchmarks or BENCHMARKS if BENCHMARKS[name](args) is False]
+    if failed:
+        raise SystemExit("Failed: %s" % (", ".join(failed),))
+
+if __name__ == '__main__':
+    main()
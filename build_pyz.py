@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+build omapboot (and omapbootctl) as single-file, precompiled zipapps.
+
+usage: python build_pyz.py [-d DIR] [--python INTERPRETER] [--source]
+
+Makes DIR/omapboot.pyz and DIR/omapbootctl.pyz, which run just like the
+scripts (`./omapboot.pyz -a aboot.2nd u-boot.bin`), but can be copied onto
+a line-control box as one file, with nothing to install.
+
+They also start faster than a fresh checkout would: every module is
+compiled ahead of time into an unchecked-hash .pyc (PEP 552), so there's
+neither compiling nor stat()ing of sources on the way in. Only the .pycs
+go in, since a python that can use them never looks at the sources, and
+those only work on the python version that built them: for any other,
+build with --source, which ships the sources instead, to be compiled on the way in.
+Either way the archive is deflated, since inflating a few hundred
+kilobytes costs less than reading them would.
+
+EXCLUDE leaves out what's for the bench rather than the line: the simulator,
+and usbbulk/capture.py, which --capture and --replay need (omapboot says so, if they're asked for anyway).
+pyusb isn't included either; it's used from wherever it's installed, if it's needed at all.
+--python "/usr/bin/python3 -I" (no site, no environment) shaves off a
+little more where that's not needed either, e.g. on Linux, with usbfs.
+"""
+
+import os
+import glob
+import shutil
+import zipapp
+import argparse
+import tempfile
+import py_compile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# what each archive needs, as paths relative to HERE
+APPS = {"omapboot": ["omapboot.py", "OMAP.py", "util.py", "instrument.py", "imagecache.py", "compressed.py",
+                     "fastboot.py", "daemon.py", "omapbootctl.py", "uart.py", "tuning.py",
+                     "usbbulk/*.py"],
+        "omapbootctl": ["omapbootctl.py"]}
+
+# what's matched above but not wanted at runtime
+EXCLUDE = ["usbbulk/sim.py", "usbbulk/capture.py"]
+
+def build(name, target, interpreter, source=False):
+    with tempfile.TemporaryDirectory() as staging:
+        with open(os.path.join(staging, "__main__.py"), "w") as f:
+            f.write("from %s import main\nmain()\n" % (name,))
+        files = ["__main__.py"]
+        for pattern in APPS[name]:
+            for path in sorted(glob.glob(os.path.join(HERE, pattern))):
+                relative = os.path.relpath(path, HERE)
+                if relative in EXCLUDE:
+                    continue
+                os.makedirs(os.path.join(staging, os.path.dirname(relative)), exist_ok=True)
+                shutil.copyfile(path, os.path.join(staging, relative))
+                files.append(relative)
+
+        if not source:
+            for relative in files:
+                py_compile.compile(os.path.join(staging, relative), cfile=os.path.join(staging, relative[:-3] + ".pyc"),
+                                   dfile=relative, doraise=True, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+                if relative != "__main__.py": #zipapp wants a __main__.py to be there; it's two lines
+                    os.unlink(os.path.join(staging, relative))
+
+        zipapp.create_archive(staging, target, interpreter, compressed=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build omapboot and omapbootctl as single-file zipapps.")
+    parser.add_argument("-d", "--dir", default=os.path.join(HERE, "dist"),
+                        help="where to put them (default: %(default)s)")
+    parser.add_argument("--python", default="/usr/bin/env python3",
+                        help="the interpreter for their #! line (default: %(default)s)")
+    parser.add_argument("--source", action="store_true",
+                        help="ship the .py files instead of .pycs, for running on a different python version than this one")
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    for name in APPS:
+        target = os.path.join(args.dir, name + ".pyz")
+        build(name, target, args.python, args.source)
+        print("%s (%d bytes)" % (target, os.path.getsize(target)))
+
+if __name__ == '__main__':
+    main()
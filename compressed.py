@@ -0,0 +1,175 @@
+"""
+compressed boot images, decompressed on the fly as they're uploaded.
+
+The ROM (and x-loader) want to be told how big an image is before they
+get it, so a compressed image is only any use if we can find out how big it
+will be without decompressing it first. In order of preference, that comes from:
+ * a sidecar file next to it, named like the image plus ".size", holding the size in decimal
+   (e.g. u-boot.bin.xz.size), for when the container doesn't say or can't be trusted to;
+ * the container itself:
+   - gzip: the ISIZE field at the end, which is the size mod 2**32 of the last member only,
+     so multi-member files need a sidecar (boot images are a lot smaller than 4GiB);
+   - xz: the stream's index, which lists the size of every block;
+     only single-stream files are understood;
+   - zstd: the first frame's Frame_Content_Size, which zstd(1) fills in when it
+     knows the size up front, i.e. unless it was compressing a pipe.
+
+gzip and xz support come with python; zstd needs the zstandard module
+(`pip install zstandard`), and only to decompress, so it isn't imported until a zstd image turns up.
+
+OMAP4.upload() and boot() take compressed image files like any others,
+and upload them through util.read_ahead(), so the decompression happens in
+another thread while the previous chunk is on its way out over USB.
+"""
+
+import os
+import gzip
+import lzma
+import struct
+
+from util import read_ahead
+
+__all__ = ["CompressedImage", "compression"]
+
+MAGIC = {b"\x1f\x8b": "gzip",
+         b"\xfd7zXZ\x00": "xz",
+         b"\x28\xb5\x2f\xfd": "zstd"}
+
+def compression(f):
+    """
+    which of the formats in MAGIC binary file f is compressed with, or None.
+    Leaves f where it was.
+    """
+    pos = f.tell()
+    head = f.read(max(len(m) for m in MAGIC))
+    f.seek(pos)
+    for magic, format in MAGIC.items():
+        if head.startswith(magic):
+            return format
+    return None
+
+def _gzip_size(f):
+    f.seek(-4, os.SEEK_END)
+    return struct.unpack("<I", f.read(4))[0]
+
+def _varint(data, pos):
+    # xz's multibyte integers: 7 bits at a time, least significant first
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+def _xz_size(f):
+    # Reference: The .xz File Format, sections 2.1.2 (Stream Footer) and 4 (Index)
+    f.seek(-12, os.SEEK_END)
+    footer = f.read(12)
+    if footer[10:] != b"YZ":
+        raise ValueError("xz stream footer not found (stream padding and multiple streams aren't supported; use a .size sidecar)")
+    backward_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+    f.seek(-12 - backward_size, os.SEEK_END)
+    index = f.read(backward_size)
+    if index[0] != 0:
+        raise ValueError("xz index not found")
+    records, pos = _varint(index, 1)
+    size = 0
+    for i in range(records):
+        unpadded, pos = _varint(index, pos)
+        uncompressed, pos = _varint(index, pos)
+        size += uncompressed
+    return size
+
+def _zstd_size(f):
+    # Reference: RFC 8878, section 3.1.1.1 (Frame_Header)
+    f.seek(0)
+    header = f.read(18) #the biggest a frame header gets
+    descriptor = header[4]
+    fcs_flag, single_segment, did_flag = descriptor >> 6, descriptor >> 5 & 1, descriptor & 3
+    pos = 5 + (0 if single_segment else 1) + (0, 1, 2, 4)[did_flag]
+    fcs_size = (single_segment, 2, 4, 8)[fcs_flag]
+    if not fcs_size:
+        raise ValueError("zstd frame doesn't give its content size; use a .size sidecar")
+    return int.from_bytes(header[pos:pos+fcs_size], "little") + (256 if fcs_size == 2 else 0)
+
+_SIZE = {"gzip": _gzip_size, "xz": _xz_size, "zstd": _zstd_size}
+
+class CompressedImage:
+    """
+    a compressed boot image file.
+
+    .size (and len()) is how big it is decompressed, .format which compression it uses.
+    """
+
+    def __init__(self, path, format=None):
+        self.path = path
+        with open(path, "rb") as f:
+            self.format = format or compression(f)
+            if self.format not in _SIZE:
+                raise ValueError("%s isn't a compressed image" % (path,))
+            if self.format == "zstd":
+                try:
+                    import zstandard
+                except ImportError:
+                    raise ImportError("%s is zstd-compressed; decompressing it needs the zstandard module" % (path,)) from None
+            try:
+                with open(path + ".size") as sidecar:
+                    self.size = int(sidecar.read())
+            except FileNotFoundError:
+                self.size = _SIZE[self.format](f)
+
+    def open(self):
+        """
+        open the image for reading, decompressed.
+        """
+        if self.format == "gzip":
+            return gzip.open(self.path, "rb")
+        if self.format == "xz":
+            return lzma.open(self.path, "rb")
+        import zstandard
+        f = open(self.path, "rb")
+        try:
+            return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        except BaseException:
+            f.close()
+            raise
+
+    def chunks(self, chunksize=4096, depth=4):
+        """
+        decompress the image in chunksize pieces on another thread, up to depth pieces ahead;
+        see util.read_ahead(), which this is, except that it makes sure the image comes out
+        the size it said it would, and won't hand out any more than that.
+        """
+        sent = 0
+        with self.open() as f:
+            for chunk in read_ahead(f, chunksize, depth):
+                sent += len(chunk)
+                if sent > self.size:
+                    break
+                yield chunk
+        if sent != self.size:
+            raise ValueError("%s decompresses to %s bytes, not the %d it claims to" % (self.path, "more than %d" % self.size if sent > self.size else sent, self.size))
+
+    def read(self):
+        """
+        decompress the whole image into a new bytearray.
+        """
+        data = bytearray(self.size)
+        with self.open() as f, memoryview(data) as view:
+            n = 0
+            while n < self.size:
+                r = f.readinto(view[n:])
+                if not r:
+                    break
+                n += r
+            if n != self.size or f.read(1):
+                raise ValueError("%s doesn't decompress to the %d bytes it claims to" % (self.path, self.size))
+        return data
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return "<CompressedImage %s (%s, %d bytes decompressed)>" % (self.path, self.format, self.size)
@@ -0,0 +1,256 @@
+"""
+omapboot --daemon: stay resident and boot omap44s on request.
+
+Running omapboot once per phone pays for starting python, importing the
+USB backend and reading the images every time, which is most of the time
+it takes to get to the first byte on the wire. The daemon pays for all
+that once, then takes boot jobs over a Unix socket (omapbootctl.py has
+the client and a description of the protocol) and runs them on one event
+loop with OMAP4.boot_async(), any number at once.
+"""
+
+import os
+import json
+import time
+import socket
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import usbbulk
+from omapboot import VENDOR, PRODUCT, open_device, _device_steps
+from omapbootctl import SOCKET
+from imagecache import ImageCache
+
+class Daemon:
+    """
+    aboot and uboot are the images to use for jobs that don't say;
+    the rest are as for omapboot.farm(), and are likewise defaults for jobs that don't say
+    (except tuner, a tuning.Tuner, which is shared by every job).
+    """
+
+    def __init__(self, aboot=None, uboot=None, jobs=8, xloader_deadline=None, trace=None, deadlines=None, attempts=1,
+                 flash=None, reboot=False, tuner=None, coalesce=False):
+        self.cache = ImageCache()
+        self.aboot = aboot
+        self.uboot = uboot
+        self.jobs = jobs
+        self.xloader_deadline = xloader_deadline
+        self.trace = trace
+        self.deadlines = deadlines
+        self.attempts = attempts
+        self.flash = flash
+        self.reboot = reboot
+        self.tuner = tuner
+        self.coalesce = coalesce
+        self.busy = set() #bus/port paths with a boot going; only touched from the event loop
+
+    async def serve(self, path=SOCKET):
+        loop = asyncio.get_running_loop()
+        # every job does its blocking I/O on the executor one call at a time,
+        # so this many threads is what bounds how many devices we boot at once
+        loop.set_default_executor(ThreadPoolExecutor(self.jobs))
+        self._slots = asyncio.Semaphore(self.jobs)
+
+        # warm the cache up with the default images now, rather than on the first job
+        for image in (self.aboot, self.uboot):
+            if image is not None:
+                self.cache.get(image)
+
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path) #left behind by a daemon that didn't get to clean up
+            else:
+                raise SystemExit("There's already an omapboot daemon at %s" % (path,))
+            finally:
+                probe.close()
+
+        server = await asyncio.start_unix_server(self._connection, path)
+        print("omapboot daemon listening on %s" % (path,), flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            os.unlink(path)
+
+    async def _connection(self, reader, writer):
+        jobs = set()
+        confirms = {} #{job id: future to set when the client says go}
+
+        def post(**reply):
+            # for where there's no waiting (a job's callbacks): the next send() waits for this too
+            writer.write(json.dumps(reply).encode() + b"\n")
+
+        async def send(**reply):
+            # post() and wait for it to go, so that a client that isn't reading
+            # holds its jobs up, rather than having its replies pile up in memory
+            post(**reply)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                writer.close() #it's gone: that ends the loop below, which calls off its jobs
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    # no telling which request this was; the client has to take that as fatal
+                    await send(status="error", error="Bad request: %s" % (e,))
+                    continue
+                if not isinstance(request, dict):
+                    await send(status="error", error="Bad request: not a JSON object: %r" % (request,))
+                    continue
+                id = request.get("id")
+                op = request.get("op", "boot")
+                if op == "boot":
+                    await send(id=id, status="accepted")
+                    job = asyncio.ensure_future(self._boot(request, send, post, confirms))
+                    jobs.add(job)
+                    job.add_done_callback(jobs.discard)
+                elif op == "confirm":
+                    future = confirms.pop(id, None)
+                    if future is None:
+                        await send(id=id, status="error", error="Job %r isn't waiting for confirmation" % (id,))
+                    else:
+                        future.set_result(None)
+                elif op == "status":
+                    await send(id=id, status="ok", busy=sorted(self.busy), images=len(self.cache))
+                else:
+                    await send(id=id, status="error", error="Unknown op %r" % (op,))
+        except ConnectionError:
+            pass
+        finally:
+            # the client's gone, so there's nobody to report to: call off its jobs
+            for future in confirms.values():
+                future.cancel()
+            for job in jobs:
+                job.cancel()
+            writer.close()
+
+    async def _boot(self, request, send, post, confirms):
+        loop = asyncio.get_running_loop()
+        id = request.get("id")
+        start = time.monotonic()
+        path = None
+        try:
+            async with self._slots:
+                aboot = request.get("aboot", self.aboot)
+                uboot = request.get("uboot", self.uboot)
+                if aboot is None or uboot is None:
+                    raise ValueError("No boot images given, and the daemon has no defaults")
+                aboot = await loop.run_in_executor(None, self.cache.get, aboot)
+                uboot = await loop.run_in_executor(None, self.cache.get, uboot)
+
+                port = await self._claim(request.get("port"), request.get("timeout"))
+                path = port.path
+                try:
+                    await send(id=id, status="started", port=path)
+                    flash = request.get("flash", self.flash)
+                    omap = await self._run(_device_steps(
+                        port, aboot, uboot, request.get("autoflag", True), request.get("xloader_deadline", self.xloader_deadline),
+                        dict(self.deadlines or {}, **request.get("deadlines", {})), request.get("retries", self.attempts - 1) + 1,
+                        verbose=False, observer=self.trace.tagged(device=path) if self.trace else None,
+                        on_retry=lambda attempt, e: post(id=id, status="retrying", port=path, attempt=attempt, error=str(e) or type(e).__name__),
+                        tuner=self.tuner, coalesce=request.get("coalesce", self.coalesce),
+                        flash=flash, reboot=request.get("reboot", self.reboot),
+                        on_flashing=lambda omap: post(id=id, status="flashing", port=path),
+                        confirm=lambda prompt: asyncio.run_coroutine_threadsafe(self._confirm(id, prompt, send, confirms), loop).result()))
+                finally:
+                    self.busy.discard(path)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await send(id=id, status="failed", port=path, seconds=time.monotonic() - start, error=str(e) or type(e).__name__)
+        else:
+            reply = dict(id=id, status="booted", port=path, seconds=time.monotonic() - start, bringup=omap.bringup_time)
+            if flash:
+                reply["flashed"] = [partition for partition, image in flash]
+            await send(**reply)
+
+    async def _run(self, steps):
+        """
+        run omapboot._device_steps() on the event loop, and return what it returns:
+        as omapboot._run_steps(), but with boot_async() and flash_async(), and ports opened on the executor.
+        
+        If the job's cancelled (the client went away) partway, that's thrown into steps too,
+        once boot_async() or flash_async() has waited for its last read or write to be over,
+        so that it closes the port now, rather than leave it claimed until the garbage collector gets to it.
+        """
+        result, error = None, None
+        while True:
+            try:
+                what, target, args = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as e:
+                return e.value
+            try:
+                if what == "open":
+                    result = await self._opening(target, *args)
+                else:
+                    result = await getattr(target, what + "_async")(*args)
+                error = None
+            except BaseException as e:
+                result, error = None, e
+
+    async def _claim(self, path, timeout):
+        """
+        wait for the omap44 at path (or any one, if None) that nobody else is booting, and open it.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with usbbulk.hotplug.Watcher(VENDOR, PRODUCT) as watcher:
+            while True:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No omap44 turned up at %s within %gs" % (path or "any port", timeout))
+                # wait in short stretches, so a cancelled job doesn't hold on to its thread for long
+                found = await loop.run_in_executor(None, watcher.wait, 1 if remaining is None else min(remaining, 1))
+                if found is None or found in self.busy or (path is not None and found != path):
+                    continue
+                self.busy.add(found)
+                try:
+                    return await self._opening(open_device, found)
+                except BaseException:
+                    self.busy.discard(found)
+                    raise
+
+    async def _opening(self, open, *args):
+        """
+        open(*args), which opens a port, on the executor.
+        
+        A cancelled job can't cancel the call itself, which carries on in its thread,
+        so wait for that to be over before letting the cancellation through,
+        and close whatever port it opened, since nobody's going to use it.
+        """
+        future = asyncio.get_running_loop().run_in_executor(None, open, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            while not future.done():
+                try:
+                    await asyncio.wait([future])
+                except asyncio.CancelledError:
+                    pass
+            if not future.cancelled() and future.exception() is None:
+                future.result().close()
+            raise
+
+    async def _confirm(self, id, prompt, send, confirms):
+        confirms[id] = future = asyncio.get_running_loop().create_future()
+        await send(id=id, status="confirm", prompt=prompt)
+        await future
+
+def serve(path=SOCKET, aboot=None, uboot=None, jobs=8, xloader_deadline=None, trace=None, deadlines=None, attempts=1,
+          flash=None, reboot=False, tuner=None, coalesce=False):
+    """
+    run the daemon until interrupted.
+    """
+    try:
+        asyncio.run(Daemon(aboot, uboot, jobs, xloader_deadline, trace, deadlines, attempts, flash, reboot, tuner, coalesce).serve(path))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,217 @@
+"""
+fastboot: what comes after u-boot.
+
+The u-boot_fastboot.bin builds of u-boot come up speaking Android's fastboot
+protocol over the same USB cable, so once omapboot has booted one it can go
+on and flash the phone's partitions itself, instead of leaving that to a
+separate fastboot run that has to start up and find the device all over again.
+
+Reference: AOSP's system/core/fastboot/README.md (formerly protocol.txt). In short:
+ * the host sends a command, an ASCII string of at most 64 bytes,
+   e.g. "getvar:max-download-size", "download:0001f000", "flash:boot", "reboot";
+ * the device answers in packets of at most 64 bytes, each starting with
+   - "INFO": a progress message; another packet follows
+   - "FAIL": it didn't work; the rest says why
+   - "OKAY": done; the rest is the answer, for getvar
+   - "DATA": (after download:) 8 hex digits saying how much it'll take, after which
+     the host sends exactly that much and gets another answer.
+
+FastbootProtocol is sans-I/O just like OMAP.BootProtocol, and Fastboot
+drives it over a usbbulk port the same way OMAP4 does, so images go out
+through the same chunked (and, for compressed images, pipelined) upload path.
+"""
+
+import contextlib
+
+from OMAP import Protocol, ProtocolError, Driver, Enter, Send, Receive, Done, image_buffer
+
+__all__ = ["Fastboot", "FastbootProtocol", "FastbootError", "ProtocolError", "VENDOR", "PRODUCT"]
+
+# USB IDs fastboot devices turn up with,
+# from TI's <https://gforge.ti.com/gf/project/flash>/trunk/omapflash/host/fastboot.c
+# which doesn't bother with product IDs
+VENDOR = [0x18d1, 0x0451, 0x0bb4]
+PRODUCT = None
+
+class FastbootError(RuntimeError):
+    "the device said FAIL"
+
+class FastbootProtocol(Protocol):
+    """
+    fastboot, from the host's side, as a state machine.
+
+    images is a list of (partition, image) pairs, where the images are buffers
+    (or anything else the driver knows how to send, as for BootProtocol),
+    to be download:ed and flash:ed in that order; if reboot, the device is told to reboot afterwards.
+    It asks for max-download-size first, and won't try to send anything bigger
+    (sparse images, which is how fastboot(1) gets around that, aren't supported).
+
+    Afterwards .variables holds what getvar said, and .info every INFO message the device sent.
+    """
+
+    # the most a command or a response can be
+    PACKET = 64
+
+    # see BootProtocol.DEADLINES; "download:<partition>" and "flash:<partition>"
+    # are held to "download" and "flash". Big images take a while on both counts.
+    DEADLINES = {"getvar": 5,
+                 "download": 300,
+                 "flash": 300,
+                 "reboot": 5}
+
+    def __init__(self, images, reboot=False, deadlines=None):
+        super().__init__(deadlines)
+        self.images = list(images)
+        self.reboot = reboot
+
+        self.state = "start" #start, getvar, download, data, flash, reboot, done
+        self.variables = {}
+        self.info = []
+        self._image = -1 #index into images of the one being sent
+
+    @property
+    def max_download_size(self):
+        size = self.variables.get("max-download-size")
+        return int(size, 16) if size else None
+
+    def _command(self, command):
+        command = command.encode("ascii")
+        if len(command) > self.PACKET:
+            raise ValueError("fastboot command %r is too long" % (command,))
+        self._actions.extend([Send(command), Receive(self.PACKET)])
+
+    def _more(self, now):
+        if self.state == "start":
+            self.state = "getvar"
+            self._actions.append(Enter("getvar"))
+            self._command("getvar:max-download-size")
+        elif self.state == "done":
+            self._actions.append(Done())
+        else:
+            super()._more(now)
+
+    def _next_image(self):
+        self._image += 1
+        if self._image < len(self.images):
+            partition, data = self.images[self._image]
+            limit = self.max_download_size
+            if limit is not None and len(data) > limit:
+                raise ValueError("The %s image is %d bytes, more than the device's max-download-size of %d" % (partition, len(data), limit))
+            self.state = "download"
+            self._actions.append(Enter("download:%s" % (partition,)))
+            self._command("download:%08x" % (len(data),))
+        elif self.reboot:
+            self.state = "reboot"
+            self.reboot = False
+            self._actions.append(Enter("reboot"))
+            self._command("reboot")
+        else:
+            self.state = "done"
+
+    def receive(self, data, now):
+        """
+        the device said data in reply to a Receive
+        """
+        tag, message = bytes(data[:4]), bytes(data[4:]).decode("ascii", "replace")
+        if tag == b"INFO":
+            self.info.append(message)
+            self._actions.append(Receive(self.PACKET))
+            return
+
+        if tag == b"FAIL":
+            if self.state == "getvar":
+                # not every bootloader has a max-download-size; then we'll just have to hope
+                return self._next_image()
+            raise FastbootError("%s failed: %s" % (self.phase, message))
+
+        if self.state == "download":
+            if tag != b"DATA":
+                raise ProtocolError("Unexpected answer %r from fastboot to download:" % (bytes(data),))
+            partition, image = self.images[self._image]
+            try:
+                size = int(message, 16)
+            except ValueError:
+                size = None
+            if size != len(image):
+                raise ProtocolError("fastboot wants %s bytes of the %d byte %s image" % (message, len(image), partition))
+            self.state = "data"
+            self._actions.extend([Send(image, image=True), Receive(self.PACKET)])
+            return
+
+        if tag != b"OKAY":
+            raise ProtocolError("Unexpected answer %r from fastboot during %s" % (bytes(data), self.phase))
+        if self.state == "getvar":
+            self.variables["max-download-size"] = message
+            self._next_image()
+        elif self.state == "data":
+            partition, image = self.images[self._image]
+            self.state = "flash"
+            self._actions.append(Enter("flash:%s" % (partition,)))
+            self._command("flash:%s" % (partition,))
+        elif self.state in ("flash", "reboot"):
+            self._next_image()
+        else:
+            raise RuntimeError("FastbootProtocol wasn't expecting anything in state %r" % (self.state,))
+
+    def timeout(self, now):
+        """
+        a Receive ran out of time without hearing anything
+        """
+        raise TimeoutError("Timed out waiting for fastboot during %s" % (self.phase,))
+
+class Fastboot(Driver):
+    """
+    flash a device that has come up in fastboot, e.g. after OMAP4.boot()ing it on a u-boot_fastboot.bin.
+
+    usage:
+        port = BulkUSB(fastboot.VENDOR, fastboot.PRODUCT, path="1-2.3")
+        Fastboot(port).flash([("boot", "boot.img"), ("system", "system.img.xz")])
+    """
+
+    variables = None #what the device said to getvar on the last flash()
+
+    def flash(self, images, reboot=False, deadlines=None):
+        """
+        images is a list of (partition, image) pairs (or a dict of them), where the images are
+        file names (raw or compressed) or imagecache.BootImages, as for OMAP4.boot().
+        If reboot, the device is rebooted afterwards.
+        deadlines is {phase: seconds} for how long each phase may take (see FastbootProtocol.DEADLINES).
+
+        closes the USB device when done, just as OMAP4.boot() does.
+        """
+        with contextlib.ExitStack() as stack:
+            self._run(self._protocol(stack, images, reboot, deadlines))
+        self._dev.close()
+
+    async def flash_async(self, images, reboot=False, deadlines=None):
+        """
+        flash(), for asyncio; see OMAP4.boot_async().
+        """
+        with contextlib.ExitStack() as stack:
+            await self._run_async(self._protocol(stack, images, reboot, deadlines))
+        self._dev.close()
+
+    def _protocol(self, stack, images, reboot, deadlines):
+        if isinstance(images, dict):
+            images = images.items()
+        self._shown = 0 #how many INFO messages have been passed on
+        return FastbootProtocol([(partition, stack.enter_context(image_buffer(image))) for partition, image in images],
+                                reboot, deadlines)
+
+    def _finish(self, protocol):
+        self.variables = protocol.variables
+
+    def _report(self, old, new, protocol):
+        for message in protocol.info[self._shown:]:
+            self._say("(bootloader) %s" % (message,), flush=True)
+        self._shown = len(protocol.info)
+        if old == new:
+            return
+        if old is not None and old.startswith(("download:", "flash:")):
+            self._say("done.", flush=True)
+        if new is not None and new.startswith("download:"):
+            self._say("Sending %s... " % (new.partition(":")[2],), end="", flush=True)
+        elif new is not None and new.startswith("flash:"):
+            self._say("Writing %s... " % (new.partition(":")[2],), end="", flush=True)
+        elif new == "reboot":
+            self._say("Rebooting.", flush=True)
@@ -0,0 +1,160 @@
+"""
+boot images, loaded once and kept in memory.
+
+When booting a rack of phones off the same aboot.2nd and u-boot.bin
+there's no sense in opening, stat()ing and reading them afresh every time.
+ImageCache hands out BootImages, which are read-only in-memory copies of
+image files, and only rereads a file when its mtime or size changes.
+Images are also indexed by content (SHA-256), so the same image under two
+names is only kept once.
+
+A BootImage can be shared between threads as it is. For when the boots are spread
+over worker processes instead, it can also be put in shared memory (BootImage.share())
+and picked up from another process (BootImage.attach()) without copying it again.
+
+Compressed image files (see compressed.py) are decompressed once, on loading,
+so a cached image costs the same to send whatever it's stored as.
+
+OMAP4.upload() and boot() take BootImages as well as file names.
+"""
+
+import os
+import threading
+from collections import namedtuple
+
+from compressed import CompressedImage, compression
+
+__all__ = ["BootImage", "ImageCache", "SharedImage"]
+
+# what BootImage.share() returns and BootImage.attach() takes; it's small and picklable
+SharedImage = namedtuple("SharedImage", ["name", "size", "digest", "path"])
+
+class BootImage:
+    """
+    a boot image in memory.
+
+    .data is a read-only memoryview of its contents,
+    .size its length, .digest the hex SHA-256 of it,
+    and .path where it came from, if anywhere.
+    """
+
+    def __init__(self, data, path=None, digest=None):
+        self.data = memoryview(data).cast("B").toreadonly()
+        self.size = len(self.data)
+        if digest is None:
+            import hashlib #only now: loading OpenSSL for it is a good part of omapboot's start-up
+            digest = hashlib.sha256(self.data).hexdigest()
+        self.digest = digest
+        self.path = path
+        self._shm = None
+        self._owner = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """
+        read the file at path into memory, decompressing it if it's compressed.
+        returns the image and the (st_mtime_ns, st_size) it had when we read it.
+        """
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if compression(f) is not None:
+                data = CompressedImage(path).read()
+            else:
+                data = bytearray(st.st_size)
+                f.readinto(data)
+        return cls(data, path), (st.st_mtime_ns, st.st_size)
+
+    def share(self):
+        """
+        copy this image into a new block of shared memory (unless it's in one already),
+        and return a SharedImage that other processes can attach() to.
+        The block lasts until close() is called on this image.
+        
+        .data becomes the shared copy; buffers of the old one that are still in use
+        (by a boot going on in another thread, say) stay good, and it goes once they're done with.
+        """
+        with self._lock:
+            if self._shm is None:
+                from multiprocessing import shared_memory #only imported when wanted; it's slow to
+                shm = shared_memory.SharedMemory(create=True, size=max(self.size, 1)) #0-sized blocks aren't allowed
+                shm.buf[:self.size] = self.data
+                self.data = shm.buf[:self.size].toreadonly()
+                self._shm = shm
+                self._owner = True #so we're the one to unlink it
+            return SharedImage(self._shm.name, self.size, self.digest, self.path)
+
+    @classmethod
+    def attach(cls, shared):
+        """
+        pick up an image another process share()d.
+        """
+        import multiprocessing
+        from multiprocessing import shared_memory, resource_tracker
+        shm = shared_memory.SharedMemory(name=shared.name)
+        # 3.8-3.12 register attached blocks with the resource tracker as if we'd created them,
+        # which would have it unlink the block out from under everyone else when we exit.
+        # multiprocessing's children share their parent's tracker, which already knows
+        # about the block, so it's only a problem for unrelated processes.
+        if multiprocessing.parent_process() is None:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        with shm.buf[:shared.size] as view:
+            image = cls(view, shared.path, shared.digest)
+        image._shm = shm
+        return image
+
+    def close(self):
+        """
+        let go of the memory; the image can't be used after this
+        (and this raises BufferError if anything still holds a buffer of it).
+        """
+        self.data.release()
+        if self._shm is not None:
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+            self._shm = None
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return "<BootImage %s (%d bytes, sha256 %s)>" % (self.path, self.size, self.digest[:12])
+
+class ImageCache:
+    """
+    hands out BootImages for file names, loading each file only once
+    (or again when its mtime or size changes).
+
+    Safe to share between threads.
+    """
+
+    def __init__(self):
+        self._by_path = {} #{realpath: ((st_mtime_ns, st_size), BootImage)}
+        self._by_digest = {} #{sha256: BootImage}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        return the BootImage for the file at path
+        """
+        key = os.path.realpath(path)
+        st = os.stat(key)
+        with self._lock:
+            cached = self._by_path.get(key)
+            if cached is not None and cached[0] == (st.st_mtime_ns, st.st_size):
+                return cached[1]
+
+        # do the reading without the lock held, so other images can be had in the meantime
+        image, stamp = BootImage.load(key)
+        with self._lock:
+            # the same contents under another name (or a file that was touched but not changed): keep only one copy
+            image = self._by_digest.setdefault(image.digest, image)
+            old = self._by_path.get(key)
+            self._by_path[key] = (stamp, image)
+            if old is not None and old[1] is not image and all(i is not old[1] for s, i in self._by_path.values()):
+                del self._by_digest[old[1].digest]
+        return image
+
+    def __len__(self):
+        return len(self._by_digest)
@@ -0,0 +1,128 @@
+"""
+hooks for watching where the time goes during a boot.
+
+OMAP4 reports to an Observer as it goes:
+ phase_start()/phase_end() bracket each step of the boot
+ ("get_id", "xloader_upload", "bringup", "battery", "uboot_upload",
+ and "reset" when omapboot has to start over; then, if flashing,
+ "fastboot" while u-boot comes up and fastboot.Fastboot's "getvar",
+ "download:<partition>", "flash:<partition>" and "reboot"),
+ and chunk() is called for every piece of an image written to the device.
+All times are time.monotonic() seconds, so they're only comparable within one run.
+
+Tee passes everything on to several observers at once.
+
+JSONLinesSink writes those out one JSON object per line, which is easy to
+append to from many boots and easy to slurp into anything that draws histograms.
+"""
+
+import json
+import time
+import threading
+
+class Observer:
+    """
+    base class for boot observers. It ignores everything;
+    override the methods for the events you're interested in.
+    """
+
+    def phase_start(self, phase, t):
+        pass
+
+    def phase_end(self, phase, t, nbytes=0, error=None):
+        """
+        nbytes is how much was transferred during the phase, if that means anything for it
+        error is the exception that ended the phase, if it failed
+        """
+        pass
+
+    def chunk(self, nbytes, latency):
+        """
+        one chunk of nbytes was written in latency seconds.
+        """
+        pass
+
+class Phase:
+    """
+    context manager that reports a phase to an Observer.
+
+    Set .nbytes inside the with block to report how much it transferred.
+    """
+
+    def __init__(self, observer, name):
+        self.observer = observer
+        self.name = name
+        self.nbytes = 0
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        self.observer.phase_start(self.name, self.start)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.end = time.monotonic()
+        self.observer.phase_end(self.name, self.end, self.nbytes, value)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+class Tee(Observer):
+    """
+    pass every event on to each of observers, in order.
+    """
+
+    def __init__(self, *observers):
+        self.observers = observers
+
+    def phase_start(self, phase, t):
+        for observer in self.observers:
+            observer.phase_start(phase, t)
+
+    def phase_end(self, phase, t, nbytes=0, error=None):
+        for observer in self.observers:
+            observer.phase_end(phase, t, nbytes, error)
+
+    def chunk(self, nbytes, latency):
+        for observer in self.observers:
+            observer.chunk(nbytes, latency)
+
+class JSONLinesSink(Observer):
+    """
+    write every event as a line of JSON to the text file f, e.g.
+     {"device": "1-2.3", "event": "phase_end", "phase": "xloader_upload", "t": 1234.5678, "nbytes": 22208}
+
+    Any keyword arguments are added to every line; tagged() makes
+    a sink that shares the same file (and lock) with extra tags,
+    which is how to log several devices into one file at once.
+    """
+
+    def __init__(self, f, **tags):
+        self._f = f
+        self._lock = threading.Lock()
+        self.tags = tags
+
+    def tagged(self, **tags):
+        sink = JSONLinesSink.__new__(JSONLinesSink)
+        sink._f = self._f
+        sink._lock = self._lock
+        sink.tags = dict(self.tags, **tags)
+        return sink
+
+    def _emit(self, **event):
+        line = json.dumps(dict(self.tags, **event))
+        with self._lock:
+            self._f.write(line + "\n")
+            self._f.flush()
+
+    def phase_start(self, phase, t):
+        self._emit(event="phase_start", phase=phase, t=t)
+
+    def phase_end(self, phase, t, nbytes=0, error=None):
+        event = dict(event="phase_end", phase=phase, t=t, nbytes=nbytes)
+        if error is not None:
+            event["error"] = str(error) or type(error).__name__
+        self._emit(**event)
+
+    def chunk(self, nbytes, latency):
+        self._emit(event="chunk", nbytes=nbytes, latency=latency)
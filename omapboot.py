@@ -2,8 +2,21 @@
 """
 omap44xx USB pre-bootloader loader.
 
-usage: omapboot [-a] aboot.bin uboot.bin
+usage: omapboot [-a] [--farm [-j JOBS]] [--retries N] [--deadline PHASE=SECONDS] [--flash PARTITION=IMAGE [--reboot]] [--capture DIR] [--tune] [--coalesce] aboot.bin uboot.bin
+       omapboot --daemon [-j JOBS] [aboot.bin uboot.bin]
+       omapboot --scan [--format csv|json] [--rules RULES.json]
+       omapboot --replay CAPTURE [--speed N] [--coalesce] [-a] aboot.bin uboot.bin
+       omapboot --serial TTY [--baud BAUD] [-a] aboot.bin uboot.bin
  -a means "don't wait for user input to upload u-boot"
+ --farm means "boot every attached omap44 at once" (implies -a)
+ --daemon means "stay running and boot whatever omapbootctl asks for"
+ --scan means "just list every attached omap44's ASIC ID (and which images its rule says to use)"
+ --flash means "then, once u-boot is up in fastboot, write IMAGE to PARTITION"
+ --capture means "record everything sent to and from each device into DIR"
+ --replay means "boot a recording made with --capture instead of a real device"
+ --serial means "boot over the ROM's UART3, wired to TTY, instead of over USB"
+ --tune means "try transfer sizes out on each port, and remember the fastest for later boots (see tuning.py)"
+ --coalesce means "send BOOT and the images' sizes in the same transfers as the images, to save round trips"
 
 See README.md for detailed usage.
 
@@ -15,71 +28,593 @@ Credits:
 * Texas Instruments, for publishing their canon, even though omapflash is spaghetticode from hell <https://gforge.ti.com/gf/project/flash/>
 """
 
+import os
 import sys
+import json
 import time
+import argparse
+import threading
 
-try:
-    from usbbulk import BulkUSB
-except ImportError:
-    raise SystemExit("No USB API available.")
+# the backend (and libusb, if it comes to that) only gets loaded on first use of usbbulk.BulkUSB
+# (or usbbulk.hotplug), so that e.g. --help doesn't have to wait for it
+import usbbulk
 
 from OMAP import *
+from instrument import Observer, Phase, JSONLinesSink
+from imagecache import ImageCache
+import tuning
+import fastboot
 
-def main():
-    if not len(sys.argv) in [3,4]:
-        print("usage: usbboot [-a] 2ndstage.bin 3rdstage.bin")
-        raise SystemExit(1)
+# USB IDs:
+# every usbbulk backend also takes lists of these, any of which will do (see usbbulk.base.matches())
+VENDOR = 0x0451
+PRODUCT = 0xd00f
+# for once u-boot is up in fastboot, see fastboot.VENDOR and fastboot.PRODUCT; those also have:
+#CLASS = [0xFF]
+#SUBCLASS = [0x42]
+#PROTOCOL = [0x03]
+
+
+# how long a device gets to come back after being reset, in seconds
+RESET_TIMEOUT = 5
+
+# how long u-boot gets to come up in fastboot after being uploaded, in seconds
+FASTBOOT_TIMEOUT = 30
+# how often to look whether the ROM's let go of the bus before then (see wait_for_fastboot()), in seconds
+ROM_GONE_POLL = 0.1
+
+def wait_for_device(timeout=None, path=None):
+    """
+    block until an omap44 is plugged in (at bus/port path, if given) and open it.
     
-    # quick hack implementation of a command line arg
-    # TODO: use the proper command parser, or at least getopt
-    # 
-    #this means "don't block at input() to let the user insert the battery"
-    # if you are doing rapid dev cycles, having to press two enters for each upload would get tedious
-    AUTOFLAG = False
-    if sys.argv[1] == "-a":
-        AUTOFLAG = True 
-        del sys.argv[1]
+    returns None if nothing showed up within timeout seconds.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with usbbulk.hotplug.Watcher(VENDOR, PRODUCT) as watcher:
+        while True:
+            found = watcher.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+            if found is None:
+                return None
+            if path is not None and found != path:
+                continue
+            try:
+                return open_device(found)
+            except OSError:
+                pass #gone again already; wait for the next one
+
+def open_device(path, vendor=VENDOR, product=PRODUCT):
+    """
+    open the omap44 (or whatever matches vendor and product) at bus/port path, which has just been plugged in.
+    """
+    # the hotplug event can beat udev to setting up the device node,
+    # so give it a few goes before deciding it's gone again
+    for i in range(50):
+        try:
+            return usbbulk.BulkUSB(vendor, product, path=path)
+        except OSError:
+            if i == 49:
+                raise
+            time.sleep(0.01)
+
+def retriable(e):
+    """
+    whether a boot that failed with exception e is worth another go.
     
-    aboot, uboot = sys.argv[1:]
+    I/O errors, timeouts and garbled banners (ProtocolErrors) are: the device (or the cable)
+    was probably just having a bad moment. Errors about files (which say
+    which .filename) won't go away by trying again, and nor will our bugs.
+    """
+    return isinstance(e, (OSError, ProtocolError)) and getattr(e, "filename", None) is None
+
+def reset_device(port, timeout=RESET_TIMEOUT, reopen=None):
+    """
+    reset the omap44 open on port, wait for it to come back, and open it again.
     
-    print("Waiting for omap44 device. Make sure you start with the battery out.")
+    port is closed either way; raises TimeoutError if the device
+    isn't back within timeout seconds.
+    reopen(path, timeout) is what waits for it and opens it, returning None if it doesn't turn up;
+    by default that's wait_for_device(), on the real bus.
+    """
+    path = port.path
+    try:
+        port.reset()
+    except (NotImplementedError, OSError):
+        pass #this backend can't, or the device is gone already; maybe it'll come back by itself
+    try:
+        port.close()
+    except OSError:
+        pass
+    port = reopen(path, timeout) if reopen is not None else wait_for_device(timeout, path)
+    if port is None:
+        raise TimeoutError("%s didn't come back within %gs of being reset" % (path, timeout))
+    return port
+
+def wait_for_fastboot(path, timeout=FASTBOOT_TIMEOUT):
+    """
+    wait for the omap44 just booted at bus/port path to come back as u-boot's fastboot, and open it.
     
-    # USB IDs:
-    #TODO: these need to be a list;
-    # pyusb has hooks that make it easy to implement this...
-    # but I'll have to write my own for ugen(4) doesn't
-    VENDOR = 0x0451
-    PRODUCT = 0xd00f 
-    # from TI's <https://gforge.ti.com/gf/project/flash>/trunk/omapflash/host/fastboot.c
-    # interestingly, they don't bother to use product IDs
-    #VENDOR = [0x18d1, 0x0451, 0x0bb4]
-    #CLASS = [0xFF]
-    #SUBCLASS = [0x42]
-    #PROTOCOL = [0x03]
+    raises TimeoutError if it isn't there within timeout seconds (None: wait forever).
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    # the ROM's own device has one of the fastboot vendor ids too,
+    # so wait for it to leave first, or we might mistake it for u-boot.
+    # The watchers only tell of arrivals, so this has to rescan the bus, but u-boot takes
+    # far longer than this to come up in fastboot anyway, so there's no need to do it often
+    while path in usbbulk.BulkUSB.enumerate(VENDOR, PRODUCT):
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError("%s was still in the ROM %gs after booting u-boot" % (path, timeout))
+        time.sleep(ROM_GONE_POLL)
+    with usbbulk.hotplug.Watcher(fastboot.VENDOR, fastboot.PRODUCT) as watcher:
+        while True:
+            found = watcher.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+            if found is None:
+                raise TimeoutError("%s didn't come up in fastboot within %gs of booting u-boot" % (path, timeout))
+            if found == path:
+                return open_device(path, fastboot.VENDOR, fastboot.PRODUCT)
+
+def boot_device(port, aboot, uboot, AUTOFLAG=False, xloader_deadline=None, deadlines=None, attempts=1,
+                verbose=True, observer=None, on_retry=None, tuner=None, coalesce=False, reopen=None,
+                flash=None, reboot=False, on_flashing=None, confirm=None):
+    """
+    OMAP4(port).boot(), but if it fails in a way that might not happen again (see retriable()),
+    reset the device and start over from GET_ID, up to attempts times in all;
+    then, if flash (a list of (partition, image) pairs) is given, wait for u-boot to come up
+    in fastboot (the "fastboot" phase) and fastboot.Fastboot().flash() it, rebooting it afterwards if reboot.
     
+    Each attempt is held to the per-phase deadlines (see BootProtocol.DEADLINES),
+    so a stuck device is given up on quickly rather than after minutes.
+    on_retry(attempt, e), if given, is called before each retry,
+    and on_flashing(omap) once it's booted, before waiting for fastboot.
+    confirm(prompt), if given, is used instead of OMAP4.confirm() (which only matters without AUTOFLAG).
+    tuner, if given, is a tuning.Tuner to pick the transfer size for each attempt with,
+    and coalesce is as for OMAP4; reopen is as for reset_device().
     
-    # As far as I can tell, without kernel hooks (which are too
-    # platform-specific for this code) USB has no way to register
-    # event handlers. So I'm stuck with polling:
+    returns the OMAP4 that did the booting; port is closed afterwards either way.
+    """
+    return _run_steps(_device_steps(port, aboot, uboot, AUTOFLAG, xloader_deadline, deadlines, attempts, verbose, observer,
+                                    on_retry, tuner, coalesce, reopen, flash, reboot, on_flashing, confirm))
+
+def _device_steps(port, aboot, uboot, AUTOFLAG=False, xloader_deadline=None, deadlines=None, attempts=1,
+                  verbose=True, observer=None, on_retry=None, tuner=None, coalesce=False, reopen=None,
+                  flash=None, reboot=False, on_flashing=None, confirm=None):
+    # boot_device() as a generator of the steps in it that block, so that it can be run
+    # blocking (_run_steps()) or on an event loop (daemon.py) alike. It yields
+    #  ("boot", omap, args) for omap.boot(*args) (or omap.boot_async(*args)),
+    #  ("flash", flasher, args) for flasher.flash(*args) (or flasher.flash_async(*args)),
+    #  ("open", fn, args) for fn(*args), which opens a port and returns it,
+    # and what the step returns is sent back in, or what it raises thrown in.
+    observer = observer if observer is not None else Observer()
+    deadlines = deadlines or {}
+    path = port.path
+    try:
+        for attempt in range(1, attempts + 1):
+            omap = OMAP4(port, verbose, tuner.tune(port, "omap44", observer) if tuner else observer, coalesce)
+            if confirm is not None:
+                omap.confirm = confirm
+            try:
+                yield ("boot", omap, (aboot, uboot, AUTOFLAG, xloader_deadline, deadlines))
+                break
+            except Exception as e:
+                if attempt == attempts or not retriable(e):
+                    raise
+                if on_retry is not None:
+                    on_retry(attempt, e)
+            with Phase(observer, "reset"):
+                port, old = None, port #reset_device() closes it either way
+                port = yield ("open", reset_device, (old, RESET_TIMEOUT, reopen))
+        port = None #boot() closed it
+
+        if flash:
+            if on_flashing is not None:
+                on_flashing(omap)
+            with Phase(observer, "fastboot"):
+                port = yield ("open", wait_for_fastboot, (path, deadlines.get("fastboot", FASTBOOT_TIMEOUT)))
+            flasher = fastboot.Fastboot(port, verbose, tuner.tune(port, "fastboot", observer) if tuner else observer)
+            yield ("flash", flasher, (flash, reboot, deadlines))
+            port = None #and so did flash()
+        return omap
+    finally:
+        if port is not None:
+            try:
+                port.close()
+            except OSError:
+                pass
+
+def _run_steps(steps):
+    # run a generator like _device_steps() to the end, blocking, and return what it returns
+    result, error = None, None
     while True:
         try:
-            port = BulkUSB(VENDOR, PRODUCT)
-            break
-        except OSError:
-            pass
-        time.sleep(0.1)
-        
+            what, target, args = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+        try:
+            result, error = (target(*args) if what == "open" else getattr(target, what)(*args)), None
+        except BaseException as e: #KeyboardInterrupt too, so that the port gets closed
+            result, error = None, e
+
+def farm(aboot, uboot, jobs, xloader_deadline=None, trace=None, deadlines=None, attempts=1, flash=None, reboot=False, tuner=None,
+         coalesce=False):
+    """
+    boot every omap44 currently attached, up to `jobs` of them at a time,
+    and then flash them, if flash (a list of (partition, image) pairs) is given.
+
+    Devices are told apart by their bus/port path, so the report
+    says which socket on the station failed, not which phone.
+    
+    trace, if given, is a JSONLinesSink to log every device's timings to.
+    The rest are as for boot_device().
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    # wait for at least one device to show up, then take everything that's there
+    with usbbulk.hotplug.Watcher(VENDOR, PRODUCT) as watcher:
+        watcher.wait()
+    try:
+        paths = usbbulk.BulkUSB.enumerate(VENDOR, PRODUCT)
+    except NotImplementedError:
+        raise SystemExit("This USB backend can't enumerate devices, so farm mode is unavailable.")
+
+    print("Found %d omap44 device(s): %s" % (len(paths), " ".join(paths)))
+
+    # read the images once for everyone, rather than once per device
+    cache = ImageCache()
+    aboot, uboot = cache.get(aboot), cache.get(uboot)
+
+    lock = threading.Lock() # keep the per-device reports from tearing
+
+    def boot_one(path):
+        start = time.monotonic()
+        def retrying(attempt, e):
+            with lock:
+                print("%s: attempt %d failed after %.1fs (%s); resetting it" % (path, attempt, time.monotonic() - start, e), flush=True)
+        def flashing(omap):
+            with lock:
+                print("%s: booted in %.1fs (x-loader up after %.2fs); flashing" % (path, time.monotonic() - start, omap.bringup_time), flush=True)
+        try:
+            port = usbbulk.BulkUSB(VENDOR, PRODUCT, path=path)
+            omap = boot_device(port, aboot, uboot, True, xloader_deadline, deadlines, attempts,
+                               verbose=False, observer=trace and trace.tagged(device=path), on_retry=retrying, tuner=tuner, coalesce=coalesce,
+                               flash=flash, reboot=reboot, on_flashing=flashing)
+        except Exception as e:
+            with lock:
+                print("%s: FAILED after %.1fs: %s" % (path, time.monotonic() - start, e), flush=True)
+            return False
+        with lock:
+            if flash:
+                print("%s: flashed %s in %.1fs" % (path, " ".join(partition for partition, image in flash), time.monotonic() - start), flush=True)
+            else:
+                print("%s: booted in %.1fs (x-loader up after %.2fs)" % (path, time.monotonic() - start, omap.bringup_time), flush=True)
+        return True
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(boot_one, paths))
+    elapsed = time.monotonic() - start
+
+    ok = sum(results)
+    print("Booted %d/%d device(s) in %.1fs (%.1f devices/minute)" % (ok, len(results), elapsed, ok * 60 / elapsed if elapsed else 0))
+    if ok != len(results):
+        raise SystemExit(1)
+
+def serial_boot(tty, baud, aboot, uboot, AUTOFLAG=False, xloader_deadline=None, deadlines=None, observer=None):
+    """
+    boot the omap44 on serial port tty (see uart.SerialPort), which has to be switched on after we start listening.
     
-    omap = OMAP4(port)
+    There's no resetting a device over a serial port, so there are no retries.
+    """
+    from uart import SerialPort
+    try:
+        port = SerialPort(tty, baud)
+    except (OSError, ValueError) as e:
+        raise SystemExit("Can't open %s: %s" % (tty, e))
+    # the ROM sends its ASIC ID at power-on, which is up to whoever's at the switch
+    deadlines = dict(deadlines or {})
+    deadlines.setdefault("get_id", None)
+    print("Waiting for omap44 on %s. Switch it on now." % (tty,))
+    boot_device(port, aboot, uboot, AUTOFLAG, xloader_deadline, deadlines, observer=observer)
+
+def _capture():
+    # usbbulk.capture, which omapboot.pyz leaves out (see build_pyz.py)
+    try:
+        from usbbulk import capture
+    except ImportError:
+        raise SystemExit("--capture and --replay aren't in this build of omapboot; run it from a checkout for them")
+    return capture
+
+def replay(capture, speed, aboot, uboot, AUTOFLAG=False, xloader_deadline=None, deadlines=None, observer=None, coalesce=False):
+    """
+    boot the device recorded in capture (see usbbulk.capture) at speed times the speed it went then,
+    to see how long it takes us, or whether we still do the same thing.
+    (A capture made with coalesce only replays with coalesce, and vice versa: the transfers are different.)
+    """
+    usbcapture = _capture()
+    Replay, ReplayError = usbcapture.Replay, usbcapture.ReplayError
+    try:
+        port = Replay(capture, speed)
+    except (OSError, ValueError) as e:
+        raise SystemExit("Can't replay %s: %s" % (capture, e))
+    start = time.monotonic()
+    try:
+        boot_device(port, aboot, uboot, AUTOFLAG, xloader_deadline, deadlines, observer=observer, coalesce=coalesce)
+    except ReplayError as e:
+        raise SystemExit("\nThe replay went differently after %.3fs: %s" % (time.monotonic() - start, e))
+    print("Replayed %s in %.3fs" % (capture, time.monotonic() - start))
+    if port.remaining:
+        print("(but the capture has %d more transfers after that)" % (port.remaining,))
+
+# what scan() reports on each device, in order, as columns for --format csv
+SCAN_FIELDS = ["path", "model", "rom_revision", "ch", "iden", "mpkh", "crc0", "crc1"]
+# what a rule (see load_rules()) says to use
+RULE_IMAGES = ["aboot", "uboot"]
+
+def scan(deadlines=None, rules=None):
+    """
+    ask every omap44 currently attached for its ASIC ID, all at once,
+    without booting any of them: they're left in the ROM, waiting to be booted.
     
-    # Read the chip ident. This isn't necessary for booting,
-    # but it's useful for debugging different peoples' results.
-    ASIC_ID = omap.id()
-    #print("ASIC_ID:")
-    #print(" ".join(hex(e) for e in ASIC_ID))
-    #assert ASIC_ID["ID"][0] == 0x44, "This code expects an OMAP44xx device"
+    returns a list of dicts, one per device in bus/port order, with "path"
+    and the fields of its ASICID.as_dict() (except that "model" is in hex, e.g. "4430"),
+    or with "error" if it couldn't be asked; if rules (see load_rules()) are given,
+    also with the "aboot" and "uboot" the first one the device matches says to use,
+    or None for both if it matches none.
+    deadlines is as for boot_device(); only "get_id" matters.
+    """
+    from concurrent.futures import ThreadPoolExecutor
     
-    omap.boot(aboot, uboot, AUTOFLAG)
+    # as in farm(): wait for at least one device to show up, then take everything that's there
+    with usbbulk.hotplug.Watcher(VENDOR, PRODUCT) as watcher:
+        watcher.wait()
+    try:
+        paths = usbbulk.BulkUSB.enumerate(VENDOR, PRODUCT)
+    except NotImplementedError:
+        raise SystemExit("This USB backend can't enumerate devices, so scan mode is unavailable.")
     
+    def identify(path):
+        device = dict(path=path)
+        try:
+            port = open_device(path)
+            try:
+                asic = OMAP4(port, verbose=False).id(deadlines)
+            finally:
+                port.close()
+        except Exception as e:
+            device["error"] = str(e) or type(e).__name__
+            return device
+        device.update(asic.as_dict())
+        if asic.model is not None:
+            device["model"] = "%04X" % (asic.model,)
+        if rules is not None:
+            device.update(dict.fromkeys(RULE_IMAGES), **choose_images(rules, device))
+        return device
+    
+    # one thread per device, so the whole rack takes one GET_ID's round trip rather than one each
+    with ThreadPoolExecutor(max_workers=max(len(paths), 1)) as pool:
+        return list(pool.map(identify, paths))
+
+def load_rules(path):
+    """
+    read a table of rules for which images to boot which devices with, from the JSON file at path.
+    
+    It's a list of objects, tried in order, e.g.
+     [{"model": "4430", "ch": true, "mpkh": "4041...5F", "aboot": "su760-aboot.2nd", "uboot": "su760-u-boot-signed.bin"},
+      {"aboot": "p940-aboot.2nd", "uboot": "p940-u-boot_fastboot.bin"}]
+    Every key but "aboot" and "uboot" is a field of the ASIC ID (as scan() reports it)
+    that has to match for the rule to apply; hex strings match whatever their case.
+    Relative image paths are taken relative to the rules file.
+    """
+    with open(path) as f:
+        rules = json.load(f)
+    if not isinstance(rules, list) or not all(isinstance(rule, dict) for rule in rules):
+        raise ValueError("%s should be a list of rules, each a JSON object" % (path,))
+    here = os.path.dirname(os.path.abspath(path))
+    for i, rule in enumerate(rules, 1):
+        for key in rule:
+            if key not in RULE_IMAGES and key not in SCAN_FIELDS[1:]:
+                raise ValueError("%s: rule %d can't match on %r; rules can on %s" % (path, i, key, ", ".join(SCAN_FIELDS[1:])))
+        for key in RULE_IMAGES:
+            if rule.get(key) is not None:
+                if not isinstance(rule[key], str):
+                    raise ValueError("%s: rule %d's %r should be a file name, not %s" % (path, i, key, json.dumps(rule[key])))
+                rule[key] = os.path.join(here, rule[key])
+    return rules
+
+def choose_images(rules, device):
+    """
+    the images (as {"aboot": ..., "uboot": ...}) the first of rules that device,
+    an entry of scan()'s list, matches says to use; {} if none match.
+    """
+    def same(wanted, actual):
+        if isinstance(wanted, str) and isinstance(actual, str):
+            return wanted.upper() == actual.upper()
+        return wanted == actual
+    for rule in rules:
+        if all(same(wanted, device.get(key)) for key, wanted in rule.items() if key not in RULE_IMAGES):
+            return {key: rule[key] for key in RULE_IMAGES if key in rule}
+    return {}
+
+def write_scan(devices, format, f=sys.stdout):
+    "print scan()'s list of devices to f, as CSV or JSON"
+    if format == "json":
+        json.dump(devices, f, indent=1)
+        f.write("\n")
+        return
+    import csv
+    fields = SCAN_FIELDS + [key for key in RULE_IMAGES + ["error"] if any(key in device for device in devices)]
+    writer = csv.DictWriter(f, fields, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(devices)
+
+# the default deadline of every phase --deadline can be given for
+DEADLINES = dict(BootProtocol.DEADLINES, fastboot=FASTBOOT_TIMEOUT, **fastboot.FastbootProtocol.DEADLINES)
+
+def seconds(arg):
+    "argparse type for a deadline: a number of seconds, which had better be more than none"
+    try:
+        value = float(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r isn't a number of seconds" % (arg,))
+    if not value > 0: #also catches nan
+        raise argparse.ArgumentTypeError("%r seconds is no time at all; every boot would time out" % (arg,))
+    return value
+
+def deadline(arg):
+    "argparse type for --deadline PHASE=SECONDS (or PHASE=never)"
+    phase, sep, value = arg.partition("=")
+    if phase not in DEADLINES or not sep:
+        raise argparse.ArgumentTypeError("expected PHASE=SECONDS, where PHASE is one of %s" % ", ".join(DEADLINES))
+    if value == "never":
+        return phase, None
+    return phase, seconds(value)
+
+def partition_image(arg):
+    "argparse type for --flash PARTITION=IMAGE"
+    partition, sep, image = arg.partition("=")
+    if not (partition and sep and image):
+        raise argparse.ArgumentTypeError("expected PARTITION=IMAGE, e.g. boot=boot.img")
+    return partition, image
+
+def main():
+    parser = argparse.ArgumentParser(prog="omapboot", description="omap44xx USB pre-bootloader loader.")
+    #this means "don't block at input() to let the user insert the battery"
+    # if you are doing rapid dev cycles, having to press two enters for each upload would get tedious
+    parser.add_argument("-a", dest="AUTOFLAG", action="store_true",
+                        help="don't wait for user input to upload u-boot")
+    parser.add_argument("--farm", action="store_true",
+                        help="boot every attached omap44 in parallel (implies -a)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="stay running and take boot jobs from omapbootctl over a Unix socket; "
+                             "the images, if given, are the default for jobs that don't name their own")
+    parser.add_argument("--scan", action="store_true",
+                        help="don't boot anything: ask every attached omap44 for its ASIC ID, all at once, and print them as a table")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv",
+                        help="with --scan, how to print the table (default: %(default)s)")
+    parser.add_argument("--rules", metavar="RULES.json",
+                        help="with --scan, add the images each device should be booted with, by the first rule in RULES.json it matches "
+                             "(see omapboot.load_rules())")
+    parser.add_argument("--serial", metavar="TTY",
+                        help="boot over the serial port TTY (wired to the phone's UART3) instead of USB; "
+                             "start omapboot first, then switch the phone on")
+    parser.add_argument("--baud", type=int, default=115200,
+                        help="with --serial, the port's speed (default: %(default)s, which is what the ROM speaks)")
+    parser.add_argument("--socket", metavar="PATH",
+                        help="in daemon mode, where to listen (default: %s)" % ("$XDG_RUNTIME_DIR/omapboot-$UID.sock",))
+    parser.add_argument("-j", "--jobs", type=int, default=8,
+                        help="in farm or daemon mode, how many devices to boot at once (default: %(default)s)")
+    parser.add_argument("--xloader-deadline", type=seconds, metavar="SECONDS",
+                        help="how long to give x-loader to come up after uploading it; short for --deadline bringup=SECONDS (default: %s)" % (OMAP4.XLOADER_DEADLINE,))
+    parser.add_argument("--deadline", type=deadline, action="append", default=[], metavar="PHASE=SECONDS",
+                        help="give up on (and maybe retry) a boot if PHASE takes longer than SECONDS; PHASE=never for no deadline. "
+                             "Can be given once per phase (defaults: %s)" % ", ".join("%s=%s" % (k, v or "never") for k, v in DEADLINES.items()))
+    parser.add_argument("--retries", type=int, default=2, metavar="N",
+                        help="if a boot fails or gets stuck, reset the device and try again up to N times (default: %(default)s)")
+    parser.add_argument("--flash", type=partition_image, action="append", default=[], metavar="PARTITION=IMAGE",
+                        help="once u-boot is up, wait for it to come back as fastboot and write IMAGE to PARTITION with it, "
+                             "over the same USB connection; can be given several times, and they're flashed in order")
+    parser.add_argument("--reboot", action="store_true",
+                        help="after --flash, have fastboot reboot the device")
+    parser.add_argument("--trace", type=argparse.FileType("a"), metavar="FILE",
+                        help="append the timing of each phase and chunk of the boot to FILE, as JSON lines")
+    parser.add_argument("--capture", metavar="DIR",
+                        help="record every transfer to and from every device into a file per device (and per reset) in DIR, "
+                             "for --replay later")
+    parser.add_argument("--replay", metavar="CAPTURE",
+                        help="instead of booting a device, boot the one recorded in CAPTURE (a file from --capture), "
+                             "checking that we send it exactly what was sent then")
+    parser.add_argument("--speed", type=float, default=1, metavar="N",
+                        help="with --replay, have the recorded device answer N times faster than it did; 0 means instantly (default: %(default)s)")
+    parser.add_argument("--tune", action="store_true",
+                        help="over the next few boots on each port, try out transfer sizes and remember the fastest in %s; "
+                             "a size the host won't take fails its boot (and is retried). Without this, only sizes "
+                             "already found that way are used, and other ports keep the USB backend's default" % (tuning.PROFILE,))
+    parser.add_argument("--coalesce", action="store_true",
+                        help="send BOOT and each image's size in the same USB transfer as the start of the image, "
+                             "rather than in transfers of their own; saves three round trips per boot, which is only "
+                             "worth having on slow links (e.g. behind several hubs), "
+                             "and check that your phones' ROM takes it before relying on it")
+    parser.add_argument("aboot", metavar="2ndstage.bin", nargs="?")
+    parser.add_argument("uboot", metavar="3rdstage.bin", nargs="?")
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.retries < 0:
+        parser.error("--retries can't be negative")
+    deadlines = dict(args.deadline)
+    if args.reboot and not args.flash:
+        parser.error("--reboot only means anything with --flash")
+    if args.scan and (args.farm or args.daemon or args.flash or args.replay or args.aboot):
+        parser.error("--scan doesn't boot anything, so it doesn't go with images, --farm, --daemon, --flash or --replay")
+    if args.rules and not args.scan:
+        parser.error("--rules only means anything with --scan")
+    if args.uboot is None and not args.scan and not (args.daemon and args.aboot is None):
+        parser.error("both 2ndstage.bin and 3rdstage.bin are required" + (" (or neither, with --daemon)" if args.daemon else ""))
+    if args.replay is not None and (args.farm or args.daemon or args.flash or args.capture):
+        parser.error("--replay replays a single boot, so it doesn't go with --farm, --daemon, --flash or --capture")
+    if args.serial is not None and (args.farm or args.daemon or args.scan or args.flash or args.replay or args.capture):
+        parser.error("--serial boots a single device, and has no fastboot, so it doesn't go with --farm, --daemon, --scan, --flash, --replay or --capture")
+    if args.speed < 0:
+        parser.error("--speed can't be negative")
+    
+    trace = JSONLinesSink(args.trace) if args.trace else None
+
+    if args.serial is not None:
+        return serial_boot(args.serial, args.baud, args.aboot, args.uboot, args.AUTOFLAG, args.xloader_deadline, deadlines,
+                           observer=trace and trace.tagged(device=args.serial))
+
+    if args.replay is not None:
+        return replay(args.replay, args.speed, args.aboot, args.uboot, args.AUTOFLAG, args.xloader_deadline, deadlines,
+                      observer=trace and trace.tagged(device=args.replay), coalesce=args.coalesce)
+
+    try:
+        usbbulk.BulkUSB
+    except ImportError:
+        raise SystemExit("No USB API available.")
+    if args.capture:
+        # every port opened from here on, in whichever mode, goes through this
+        usbbulk.BulkUSB = _capture().recording(usbbulk.BulkUSB, args.capture)
+
+    if args.scan:
+        try:
+            rules = load_rules(args.rules) if args.rules else None
+        except (OSError, ValueError) as e:
+            raise SystemExit("Can't read the rules: %s" % (e,))
+        print("Waiting for omap44 devices.", file=sys.stderr)
+        devices = scan(deadlines, rules)
+        write_scan(devices, args.format)
+        if any("error" in device for device in devices):
+            raise SystemExit(1)
+        return
+
+    tuner = tuning.Tuner(explore=args.tune)
+    try:
+        if args.daemon:
+            import daemon
+            return daemon.serve(args.socket or daemon.SOCKET, args.aboot, args.uboot, args.jobs, args.xloader_deadline, trace,
+                                deadlines, args.retries + 1, args.flash, args.reboot, tuner, args.coalesce)
+
+        print("Waiting for omap44 device. Make sure you start with the battery out.")
+
+        if args.farm:
+            return farm(args.aboot, args.uboot, args.jobs, args.xloader_deadline, trace, deadlines, args.retries + 1,
+                        args.flash, args.reboot, tuner, args.coalesce)
+
+        port = wait_for_device()
+
+        # (boot() reads and prints the chip ident first thing, which is useful for debugging different peoples' results)
+        def retrying(attempt, e):
+            print()
+            print("Attempt %d failed: %s" % (attempt, e))
+            print("Resetting the device and trying again. Take the battery out if you put it in.")
+
+        def flashing(omap):
+            print("Waiting for u-boot to come up in fastboot...")
+
+        boot_device(port, args.aboot, args.uboot, args.AUTOFLAG, args.xloader_deadline, deadlines, args.retries + 1,
+                    observer=trace and trace.tagged(device=port.path), on_retry=retrying, tuner=tuner, coalesce=args.coalesce,
+                    flash=args.flash, reboot=args.reboot, on_flashing=flashing)
+    finally:
+        tuner.close() #saves what --tune found, now that no boot is waiting on it
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
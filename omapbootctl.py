@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+submit boot jobs to a running `omapboot --daemon`.
+
+usage: omapbootctl [-a] [--port PATH] [--timeout SECONDS] [--retries N] [--flash PARTITION=IMAGE [--reboot]] [--coalesce] [aboot.bin uboot.bin]
+       omapbootctl --status
+
+The daemon already has the USB stack loaded and the images in memory,
+so all this has to do is say which phone to boot with what, which is why
+it imports nothing but the standard library: it's meant to be cheap enough
+to run once per phone from line-control scripts, or to be imported and
+kept connected (see Client) when even that is too slow.
+
+The daemon speaks JSON, one object per line, over a Unix socket.
+Requests:
+ {"op": "boot", "id": 1, "aboot": "/abs/aboot.2nd", "uboot": "/abs/u-boot.bin",
+  "autoflag": true, "port": "1-2.3", "timeout": 30, "xloader_deadline": 10,
+  "deadlines": {"get_id": 2, ...}, "retries": 2, "flash": [["boot", "/abs/boot.img"], ...], "reboot": false,
+  "coalesce": false}
+   everything but "op" is optional: the images default to the ones the daemon
+   was started with, "port" to whichever omap44 turns up first, "timeout"
+   (how long to wait for it to) to forever, "autoflag" to true, and
+   "xloader_deadline", "deadlines", "retries", "flash" (what to write to which
+   partition once u-boot's up in fastboot), "reboot" and "coalesce" to the daemon's (see omapboot --help).
+ {"op": "confirm", "id": 1}
+   go ahead with u-boot, in reply to a "confirm" (only happens without autoflag)
+ {"op": "status"}
+Replies, which carry the "id" of the request they're about:
+ {"id": 1, "status": "accepted"}
+ {"id": 1, "status": "started", "port": "1-2.3"}
+ {"id": 1, "status": "confirm", "prompt": "Insert battery and press enter to upload u-boot > "}
+ {"id": 1, "status": "retrying", "port": "1-2.3", "attempt": 1, "error": "..."}
+ {"id": 1, "status": "flashing", "port": "1-2.3"}
+ {"id": 1, "status": "booted", "port": "1-2.3", "seconds": 2.31, "bringup": 0.31, "flashed": ["boot", ...]}
+ {"id": 1, "status": "failed", "port": "1-2.3", "seconds": 0.52, "error": "..."}
+ {"id": 2, "status": "ok", "busy": ["1-2.3"], "images": 2}
+ {"id": 3, "status": "error", "error": "..."}
+ {"status": "error", "error": "..."}
+   a request the daemon couldn't even find the "id" of, so it could have been any of them
+Several jobs can be in flight on one connection; tell them apart by "id".
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+
+SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp", "omapboot-%d.sock" % os.getuid())
+
+class DaemonError(RuntimeError):
+    "the daemon couldn't make sense of a request, and couldn't say which"
+
+class Client:
+    """
+    a connection to the daemon.
+
+    usage:
+        with Client() as daemon:
+            reply = daemon.boot("/abs/aboot.2nd", "/abs/u-boot.bin", port="1-2.3")
+            assert reply["status"] == "booted"
+    """
+
+    def __init__(self, path=SOCKET):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+        except OSError:
+            self._sock.close()
+            raise
+        self._replies = self._sock.makefile("rb")
+        self._id = 0
+
+    def request(self, **request):
+        """
+        send a request; returns its id.
+        """
+        if "id" not in request:
+            self._id += 1
+            request["id"] = self._id
+        self._sock.sendall(json.dumps(request).encode() + b"\n")
+        return request["id"]
+
+    def reply(self):
+        """
+        the next reply from the daemon, whichever request it's about.
+
+        Raises DaemonError for an error that isn't about any request in particular,
+        since whichever request it was about would otherwise be waited on forever.
+        """
+        line = self._replies.readline()
+        if not line:
+            raise ConnectionError("The omapboot daemon hung up")
+        reply = json.loads(line)
+        if reply.get("status") == "error" and "id" not in reply:
+            raise DaemonError(reply.get("error", "The omapboot daemon refused a request"))
+        return reply
+
+    def boot(self, aboot=None, uboot=None, autoflag=True, port=None, timeout=None, xloader_deadline=None,
+             deadlines=None, retries=None, confirm=input, progress=None, flash=None, reboot=None, coalesce=None):
+        """
+        boot a device and wait for it to finish; returns the final
+        ("booted" or "failed") reply.
+
+        flash is a list of (partition, image) pairs (or a dict of them) to write once u-boot's up in fastboot.
+        Image paths are made absolute, since the daemon doesn't share our working directory.
+        confirm(prompt) is called if the daemon wants the battery put in (only without autoflag),
+        and progress(reply), if given, with every reply along the way.
+        """
+        job = dict(op="boot", autoflag=autoflag)
+        if aboot is not None:
+            job["aboot"] = os.path.abspath(aboot)
+        if uboot is not None:
+            job["uboot"] = os.path.abspath(uboot)
+        if flash is not None:
+            job["flash"] = [(partition, os.path.abspath(image)) for partition, image in (flash.items() if isinstance(flash, dict) else flash)]
+        for k, v in (("port", port), ("timeout", timeout), ("xloader_deadline", xloader_deadline),
+                     ("deadlines", deadlines), ("retries", retries), ("reboot", reboot), ("coalesce", coalesce)):
+            if v is not None:
+                job[k] = v
+        id = self.request(**job)
+        while True:
+            reply = self.reply()
+            if reply.get("id") != id:
+                continue
+            if progress is not None:
+                progress(reply)
+            if reply["status"] == "confirm":
+                confirm(reply["prompt"])
+                self.request(op="confirm", id=id)
+            elif reply["status"] in ("booted", "failed", "error"):
+                return reply
+
+    def status(self):
+        id = self.request(op="status")
+        while True:
+            reply = self.reply()
+            if reply.get("id") == id:
+                return reply
+
+    def close(self):
+        self._replies.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(prog="omapbootctl", description="Submit boot jobs to a running omapboot --daemon.")
+    parser.add_argument("-a", dest="AUTOFLAG", action="store_true",
+                        help="don't wait for user input to upload u-boot")
+    parser.add_argument("--port", metavar="PATH",
+                        help="boot the device at this bus/port path, e.g. 1-2.3 (default: whichever turns up first)")
+    parser.add_argument("--timeout", type=float, metavar="SECONDS",
+                        help="give up if no device turns up within SECONDS (default: wait forever)")
+    parser.add_argument("--xloader-deadline", type=float, metavar="SECONDS",
+                        help="how long to give x-loader to come up (default: the daemon's)")
+    parser.add_argument("--retries", type=int, metavar="N",
+                        help="if the boot fails or gets stuck, reset the device and try again up to N times (default: the daemon's)")
+    parser.add_argument("--flash", action="append", metavar="PARTITION=IMAGE",
+                        help="once u-boot is up in fastboot, write IMAGE to PARTITION; can be given several times (default: the daemon's)")
+    parser.add_argument("--reboot", action="store_true", default=None,
+                        help="after --flash, have fastboot reboot the device (default: the daemon's)")
+    parser.add_argument("--coalesce", action="store_true", default=None,
+                        help="send BOOT and the images' sizes in the same transfers as the images (default: the daemon's)")
+    parser.add_argument("--socket", default=SOCKET,
+                        help="the daemon's socket (default: %(default)s)")
+    parser.add_argument("--status", action="store_true",
+                        help="just report what the daemon is up to")
+    parser.add_argument("aboot", metavar="2ndstage.bin", nargs="?",
+                        help="(default: the daemon's)")
+    parser.add_argument("uboot", metavar="3rdstage.bin", nargs="?",
+                        help="(default: the daemon's)")
+    args = parser.parse_args()
+    flash = None
+    if args.flash:
+        flash = [arg.partition("=")[::2] for arg in args.flash]
+        if not all(partition and image for partition, image in flash):
+            parser.error("--flash takes PARTITION=IMAGE, e.g. boot=boot.img")
+
+    try:
+        daemon = Client(args.socket)
+    except OSError as e:
+        raise SystemExit("No omapboot daemon at %s: %s" % (args.socket, e.strerror or e))
+
+    with daemon:
+        if args.status:
+            try:
+                print(json.dumps(daemon.status()))
+            except DaemonError as e:
+                raise SystemExit("omapboot: %s" % (e,))
+            return
+
+        def progress(reply):
+            if reply["status"] == "started":
+                print("%s: booting" % (reply["port"],), flush=True)
+            elif reply["status"] == "flashing":
+                print("%s: booted; flashing" % (reply["port"],), flush=True)
+            elif reply["status"] == "retrying":
+                print("%s: attempt %d failed (%s); resetting it" % (reply["port"], reply["attempt"], reply["error"]), flush=True)
+
+        try:
+            reply = daemon.boot(args.aboot, args.uboot, args.AUTOFLAG, args.port, args.timeout, args.xloader_deadline,
+                                retries=args.retries, progress=progress, flash=flash, reboot=args.reboot,
+                                coalesce=args.coalesce)
+        except DaemonError as e:
+            raise SystemExit("omapboot: %s" % (e,))
+    if reply["status"] == "booted" and reply.get("flashed"):
+        print("%s: flashed %s in %.1fs" % (reply["port"], " ".join(reply["flashed"]), reply["seconds"]))
+    elif reply["status"] == "booted":
+        print("%s: booted in %.1fs (x-loader up after %.2fs)" % (reply["port"], reply["seconds"], reply["bringup"]))
+    else:
+        raise SystemExit("%s: FAILED: %s" % (reply.get("port", "omapboot"), reply["error"]))
+
+if __name__ == '__main__':
+    main()
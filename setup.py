@@ -20,6 +20,7 @@ setup(
     entry_points={
         'console_scripts': [
             'omapboot = omapboot:main',
+            'omapbootctl = omapbootctl:main',
         ]
     },
     scripts=[],
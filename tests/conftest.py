@@ -0,0 +1,15 @@
+import os
+import sys
+
+# omapboot's modules live at the top of the checkout rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture
+def images(tmp_path):
+    "an (x-loader, u-boot) pair of made-up images, as file names"
+    aboot, uboot = tmp_path / "aboot.2nd", tmp_path / "u-boot.bin"
+    aboot.write_bytes(os.urandom(40 * 1024 + 3))
+    uboot.write_bytes(os.urandom(200 * 1024 + 1))
+    return str(aboot), str(uboot)
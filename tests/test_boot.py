@@ -0,0 +1,142 @@
+"""
+booting the simulated OMAP4 in usbbulk.sim, end to end.
+"""
+
+import errno
+import struct
+import asyncio
+
+import pytest
+
+from OMAP import OMAP4, ProtocolError
+from imagecache import ImageCache
+from usbbulk.sim import SimulatedOMAP4
+from omapboot import retriable, boot_device
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_id():
+    dev = SimulatedOMAP4(xloader_latency=0)
+    asic_id = OMAP4(dev, verbose=False).id()
+    assert asic_id.model == 0x4430
+    assert asic_id.ch is True
+    assert asic_id.mpkh == bytes(range(0x40, 0x40 + 32))
+    assert dev.state == "rom" and not dev.closed
+
+@pytest.mark.parametrize("coalesce", [False, True])
+def test_boot(images, coalesce):
+    aboot, uboot = images
+    dev = SimulatedOMAP4(xloader_latency=0.01)
+    OMAP4(dev, verbose=False, coalesce=coalesce).boot(aboot, uboot, AUTOFLAG=True)
+    assert dev.state == "booted"
+    assert dev.images["x-loader"] == read(aboot)
+    assert dev.images["u-boot"] == read(uboot)
+    assert dev.closed
+
+def test_boot_cached(images):
+    aboot, uboot = images
+    cache = ImageCache()
+    for i in range(3):
+        dev = SimulatedOMAP4(xloader_latency=0)
+        OMAP4(dev, verbose=False).boot(cache.get(aboot), cache.get(uboot), AUTOFLAG=True)
+        assert dev.state == "booted" and dev.images["u-boot"] == read(uboot)
+    assert len(cache) == 2
+
+def test_boot_async(images):
+    aboot, uboot = images
+    devs = [SimulatedOMAP4(xloader_latency=0.05, path="1-%d" % (i,)) for i in range(4)]
+    async def boot_all():
+        await asyncio.gather(*(OMAP4(dev, verbose=False).boot_async(aboot, uboot, AUTOFLAG=True) for dev in devs))
+    asyncio.run(boot_all())
+    assert all(dev.state == "booted" and dev.images["u-boot"] == read(uboot) for dev in devs)
+
+def test_xloader_hangs(images):
+    aboot, uboot = images
+    dev = SimulatedOMAP4(xloader_hangs=True)
+    with pytest.raises(TimeoutError):
+        OMAP4(dev, verbose=False).boot(aboot, uboot, AUTOFLAG=True, xloader_deadline=0.2)
+    assert dev.state == "bringup"
+    assert "u-boot" not in dev.images
+
+def test_bad_banner(images):
+    class Garbled(SimulatedOMAP4):
+        BANNER = struct.pack("I", 0x12345678)
+    aboot, uboot = images
+    with pytest.raises(ProtocolError) as e:
+        OMAP4(Garbled(xloader_latency=0), verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+    assert retriable(e.value)
+
+@pytest.mark.parametrize("asic_id", [SimulatedOMAP4.ASIC_ID[:-3], SimulatedOMAP4.ASIC_ID + b"\x00"], ids=["truncated", "trailing"])
+def test_garbled_asic_id(images, asic_id):
+    class Garbled(SimulatedOMAP4):
+        ASIC_ID = asic_id
+    aboot, uboot = images
+    with pytest.raises(ProtocolError) as e:
+        OMAP4(Garbled(xloader_latency=0), verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+    assert isinstance(e.value.__cause__, ValueError)
+    assert retriable(e.value)
+    with pytest.raises(ProtocolError):
+        OMAP4(Garbled(), verbose=False).id()
+
+def test_unplugged(images):
+    aboot, uboot = images
+    dev = SimulatedOMAP4(unplug_after=10000)
+    with pytest.raises(OSError) as e:
+        OMAP4(dev, verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+    assert e.value.errno == errno.ENODEV
+    assert retriable(e.value)
+
+def test_missing_image(images):
+    aboot, uboot = images
+    with pytest.raises(OSError) as e:
+        OMAP4(SimulatedOMAP4(), verbose=False).boot(aboot + ".nope", uboot, AUTOFLAG=True)
+    assert not retriable(e.value)
+
+def test_coalesce_commands_alone(images):
+    # a ROM that only takes a command (or a size) in a transfer of its own boots as usual without coalesce...
+    aboot, uboot = images
+    dev = SimulatedOMAP4(xloader_latency=0, commands_alone=True)
+    OMAP4(dev, verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+    assert dev.state == "booted" and dev.images["u-boot"] == read(uboot)
+    # ...but with it, loses the start of x-loader along with BOOT, and waits for the rest forever
+    dev = SimulatedOMAP4(xloader_latency=0, commands_alone=True)
+    with pytest.raises(TimeoutError):
+        OMAP4(dev, verbose=False, coalesce=True).boot(aboot, uboot, AUTOFLAG=True, xloader_deadline=0.2)
+    assert dev.state == "x-loader"
+    assert len(dev.images["x-loader"]) < len(read(aboot))
+    assert "u-boot" not in dev.images
+
+def reopener(dev):
+    "a reopen= for boot_device() that finds dev back where it was after a reset, as the bus would"
+    def reopen(path, timeout):
+        dev.closed = False
+        return dev
+    return reopen
+
+def test_retry(images):
+    aboot, uboot = images
+    dev = SimulatedOMAP4(xloader_latency=0, xloader_hangs=1)
+    retries = []
+    boot_device(dev, aboot, uboot, AUTOFLAG=True, xloader_deadline=0.2, attempts=2, verbose=False,
+                on_retry=lambda attempt, e: retries.append((attempt, type(e))), reopen=reopener(dev))
+    assert dev.resets == 1
+    assert retries == [(1, TimeoutError)]
+    assert dev.state == "booted" and dev.images["u-boot"] == read(uboot)
+
+def test_retry_not_retriable(images):
+    aboot, uboot = images
+    dev = SimulatedOMAP4(xloader_latency=0)
+    with pytest.raises(FileNotFoundError):
+        boot_device(dev, aboot + ".nope", uboot, AUTOFLAG=True, attempts=3, verbose=False, reopen=reopener(dev))
+    assert dev.resets == 0
+    assert dev.closed
+
+def test_retry_runs_out(images):
+    aboot, uboot = images
+    dev = SimulatedOMAP4(xloader_latency=0, xloader_hangs=True)
+    with pytest.raises(TimeoutError):
+        boot_device(dev, aboot, uboot, AUTOFLAG=True, xloader_deadline=0.1, attempts=3, verbose=False, reopen=reopener(dev))
+    assert dev.resets == 2
+    assert dev.closed
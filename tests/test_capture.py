@@ -0,0 +1,61 @@
+"""
+recording a simulated boot with usbbulk.capture, and playing it back.
+"""
+
+import pytest
+
+from OMAP import OMAP4
+from util import is_timeout
+from usbbulk.sim import SimulatedOMAP4
+from usbbulk.capture import Recorder, Replay, ReplayError, records
+
+@pytest.fixture
+def capture(tmp_path, images):
+    "a capture of booting a simulated OMAP4 with images"
+    aboot, uboot = images
+    path = str(tmp_path / "boot.omapcap")
+    dev = SimulatedOMAP4(xloader_latency=0.01, path="1-2")
+    OMAP4(Recorder(dev, path), verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+    assert dev.state == "booted" and dev.closed
+    return path
+
+def test_round_trip(capture, images, tmp_path):
+    aboot, uboot = images
+    again = str(tmp_path / "again.omapcap")
+    port = Replay(capture, speed=0)
+    # recording the replay should make the same capture, bar the timings
+    OMAP4(Recorder(port, again), verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+    assert port.remaining == 0
+    assert port.closed
+    header, recorded = records(capture)
+    assert header["path"] == "1-2"
+    assert records(again)[0]["path"] == "1-2"
+    assert [(kind, size, extra, data) for kind, size, extra, start, duration, data in records(again)[1]] == \
+           [(kind, size, extra, data) for kind, size, extra, start, duration, data in recorded]
+
+def test_changed_image(capture, images, tmp_path):
+    aboot, uboot = images
+    with open(uboot, "rb") as f:
+        data = bytearray(f.read())
+    data[0] ^= 0xff
+    changed = tmp_path / "u-boot.changed"
+    changed.write_bytes(data)
+    port = Replay(capture, speed=0)
+    with pytest.raises(ReplayError, match="CRC"):
+        OMAP4(port, verbose=False).boot(aboot, str(changed), AUTOFLAG=True)
+    assert port.remaining > 0 #caught at the first chunk of it, not at the end
+
+def test_timeout(tmp_path):
+    path = str(tmp_path / "timeout.omapcap")
+    port = Recorder(SimulatedOMAP4(), path)
+    port.setTimeout(10)
+    with pytest.raises(OSError) as recorded:
+        port.read(4096) #the ROM doesn't say anything until it's asked
+    assert is_timeout(recorded.value)
+    port.close()
+
+    port = Replay(path, speed=0)
+    with pytest.raises(TimeoutError) as replayed:
+        port.read(4096)
+    assert replayed.value.errno == recorded.value.errno
+    assert port.remaining == 0
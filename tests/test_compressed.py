@@ -0,0 +1,85 @@
+"""
+compressed boot images: working out how big they are, and booting off them.
+"""
+
+import gzip
+import lzma
+
+import pytest
+
+from OMAP import OMAP4
+from compressed import CompressedImage
+from usbbulk.sim import SimulatedOMAP4
+
+def zstd(data):
+    zstandard = pytest.importorskip("zstandard")
+    return zstandard.ZstdCompressor().compress(data) #which fills in the content size, as zstd(1) does for files
+
+COMPRESS = {"gzip": (".gz", gzip.compress),
+            "xz": (".xz", lzma.compress),
+            "zstd": (".zst", zstd)}
+
+def compress(path, format):
+    "compress the file at path with format, next to it; returns what it's called"
+    suffix, compressor = COMPRESS[format]
+    with open(path, "rb") as f:
+        data = compressor(f.read())
+    with open(path + suffix, "wb") as f:
+        f.write(data)
+    return path + suffix
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+@pytest.mark.parametrize("format", sorted(COMPRESS))
+def test_size(images, format):
+    aboot, uboot = images
+    image = CompressedImage(compress(uboot, format))
+    assert image.format == format
+    assert len(image) == len(read(uboot))
+    assert image.read() == read(uboot)
+
+def test_sidecar(images):
+    aboot, uboot = images
+    # the gzip trailer only has the last member's size, so this needs telling
+    data = read(uboot)
+    with open(uboot + ".gz", "wb") as f:
+        f.write(gzip.compress(data[:1000]) + gzip.compress(data[1000:]))
+    assert len(CompressedImage(uboot + ".gz")) == len(data) - 1000
+    with open(uboot + ".gz.size", "w") as f:
+        f.write("%d\n" % len(data))
+    image = CompressedImage(uboot + ".gz")
+    assert len(image) == len(data)
+    assert image.read() == data
+
+def test_size_mismatch(images):
+    aboot, uboot = images
+    path = compress(uboot, "xz")
+    for size in (len(read(uboot)) - 1, len(read(uboot)) + 1):
+        with open(path + ".size", "w") as f:
+            f.write(str(size))
+        image = CompressedImage(path)
+        with pytest.raises(ValueError, match="decompress"):
+            image.read()
+        with pytest.raises(ValueError, match="decompresses to"):
+            for chunk in image.chunks():
+                pass
+
+def test_boot(images):
+    aboot, uboot = images
+    dev = SimulatedOMAP4(xloader_latency=0.01)
+    OMAP4(dev, verbose=False).boot(compress(aboot, "gzip"), compress(uboot, "xz"), AUTOFLAG=True)
+    assert dev.state == "booted"
+    assert dev.images["x-loader"] == read(aboot)
+    assert dev.images["u-boot"] == read(uboot)
+
+def test_boot_size_mismatch(images):
+    aboot, uboot = images
+    path = compress(uboot, "gzip")
+    with open(path + ".size", "w") as f:
+        f.write(str(len(read(uboot)) + 1))
+    dev = SimulatedOMAP4(xloader_latency=0.01)
+    with pytest.raises(ValueError, match="decompresses to"):
+        OMAP4(dev, verbose=False).boot(aboot, path, AUTOFLAG=True)
+    assert dev.state != "booted"
@@ -0,0 +1,131 @@
+"""
+the daemon, on a Unix socket of its own, booting simulated devices for omapbootctl.Client.
+"""
+
+import os
+import time
+import asyncio
+import threading
+
+import pytest
+
+import daemon
+from omapbootctl import Client, DaemonError
+from usbbulk.sim import SimulatedOMAP4
+
+class SimDaemon(daemon.Daemon):
+    "a Daemon that boots the simulated devices it's given rather than whatever's on the bus"
+
+    def __init__(self, devices, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.devices = devices
+
+    async def _claim(self, path, timeout):
+        for dev in self.devices:
+            if dev.state == "rom" and not dev.closed and dev.path not in self.busy and path in (None, dev.path):
+                self.busy.add(dev.path)
+                return dev
+        raise TimeoutError("No omap44 turned up at %s" % (path or "any port",))
+
+@pytest.fixture
+def serve(tmp_path, images):
+    "serve(devices, **kwargs) starts a SimDaemon with images as its defaults; returns the socket to reach it at"
+    running = []
+
+    def serve(devices, **kwargs):
+        path = str(tmp_path / "omapboot.sock")
+        loop = asyncio.new_event_loop()
+        server = loop.create_task(SimDaemon(devices, *images, **kwargs).serve(path))
+        def run():
+            try:
+                loop.run_until_complete(server)
+            except asyncio.CancelledError:
+                pass
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        running.append((loop, server, thread))
+        while not os.path.exists(path):
+            assert thread.is_alive()
+            time.sleep(0.01)
+        return path
+
+    yield serve
+    for loop, server, thread in running:
+        loop.call_soon_threadsafe(server.cancel)
+        thread.join()
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_boot(serve, images):
+    aboot, uboot = images
+    dev = SimulatedOMAP4(xloader_latency=0.01, path="1-2")
+    with Client(serve([dev])) as client:
+        replies = []
+        reply = client.boot(port="1-2", progress=replies.append)
+    assert reply["status"] == "booted" and reply["port"] == "1-2"
+    assert [reply["status"] for reply in replies] == ["accepted", "started", "booted"]
+    assert dev.state == "booted" and dev.images["u-boot"] == read(uboot)
+    assert dev.closed
+
+def test_confirm(serve, images):
+    aboot, uboot = images
+    dev = SimulatedOMAP4(xloader_latency=0.01)
+    prompts = []
+    with Client(serve([dev])) as client:
+        reply = client.boot(autoflag=False, confirm=prompts.append)
+    assert reply["status"] == "booted"
+    assert len(prompts) == 1
+    assert dev.state == "booted" and dev.images["u-boot"] == read(uboot)
+
+def test_status(serve):
+    with Client(serve([])) as client:
+        reply = client.status()
+    assert reply["status"] == "ok"
+    assert reply["busy"] == []
+    assert reply["images"] == 2 #the defaults, read in up front
+
+def test_unknown_op(serve):
+    with Client(serve([])) as client:
+        id = client.request(op="bogus")
+        reply = client.reply()
+        assert reply["id"] == id and reply["status"] == "error" and "bogus" in reply["error"]
+        # and it's still listening
+        assert client.status()["status"] == "ok"
+
+@pytest.mark.parametrize("line", [b"nonsense\n", b"[1, 2]\n"])
+def test_malformed(serve, line):
+    with Client(serve([])) as client:
+        client._sock.sendall(line)
+        with pytest.raises(DaemonError, match="Bad request"):
+            client.reply()
+        assert client.status()["status"] == "ok"
+
+def test_missing_image(serve, images):
+    aboot, uboot = images
+    dev = SimulatedOMAP4(xloader_latency=0.01)
+    with Client(serve([dev])) as client:
+        reply = client.boot(aboot + ".nope", uboot)
+    assert reply["status"] == "failed"
+    assert "aboot.2nd.nope" in reply["error"]
+    assert dev.state == "rom" and not dev.closed #never got as far as claiming it
+
+def test_client_goes_away(serve):
+    # slow enough that the client's long gone before u-boot's half way there
+    dev = SimulatedOMAP4(bandwidth=100e3, xloader_latency=0.01)
+    path = serve([dev])
+    with Client(path) as client:
+        client.request(op="boot")
+        while client.reply()["status"] != "started":
+            pass
+    # the job's called off, and the device let go of
+    deadline = time.monotonic() + 5
+    while not dev.closed:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert dev.state != "booted"
+    with Client(path) as client:
+        assert client.status()["busy"] == []
@@ -0,0 +1,63 @@
+"""
+flashing the simulated fastboot device in usbbulk.sim.
+"""
+
+import pytest
+
+from fastboot import Fastboot, FastbootError
+from usbbulk.sim import SimulatedFastboot
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_flash(images):
+    aboot, uboot = images
+    dev = SimulatedFastboot()
+    flasher = Fastboot(dev, verbose=False)
+    flasher.flash([("xloader", aboot), ("bootloader", uboot)])
+    assert dev.partitions["xloader"] == read(aboot)
+    assert dev.partitions["bootloader"] == read(uboot)
+    assert dev.commands == ["getvar:max-download-size",
+                            "download:%08x" % len(read(aboot)), "flash:xloader",
+                            "download:%08x" % len(read(uboot)), "flash:bootloader"]
+    assert int(flasher.variables["max-download-size"], 16) == dev.max_download_size
+    assert dev.state == "command" and dev.closed
+
+def test_reboot(images):
+    aboot, uboot = images
+    dev = SimulatedFastboot()
+    Fastboot(dev, verbose=False).flash({"boot": uboot}, reboot=True)
+    assert dev.commands[-2:] == ["flash:boot", "reboot"]
+    assert dev.state == "rebooted"
+
+def test_fail(images):
+    aboot, uboot = images
+    dev = SimulatedFastboot(fail=["system"])
+    with pytest.raises(FastbootError, match="flash:system failed: write failed"):
+        Fastboot(dev, verbose=False).flash([("boot", aboot), ("system", uboot), ("cache", aboot)])
+    assert dev.partitions["boot"] == read(aboot)
+    assert dev.partitions["system"] is None
+    assert "flash:cache" not in dev.commands #gave up there
+
+def test_info(images, capsys):
+    aboot, uboot = images
+    dev = SimulatedFastboot()
+    Fastboot(dev).flash([("boot", aboot)])
+    assert "(bootloader) writing 'boot'..." in capsys.readouterr().out
+
+def test_too_big(images):
+    aboot, uboot = images
+    dev = SimulatedFastboot(max_download_size=len(read(uboot)) - 1)
+    with pytest.raises(ValueError, match="max-download-size"):
+        Fastboot(dev, verbose=False).flash([("boot", aboot), ("system", uboot)])
+    assert dev.partitions["boot"] == read(aboot)
+    assert not any(command.startswith("download:%08x" % len(read(uboot))) for command in dev.commands)
+
+def test_no_max_download_size(images):
+    aboot, uboot = images
+    dev = SimulatedFastboot(max_download_size=None) #getvar FAILs, so there's no telling how much is too much
+    flasher = Fastboot(dev, verbose=False)
+    flasher.flash([("boot", uboot)])
+    assert flasher.variables == {}
+    assert dev.partitions["boot"] == read(uboot)
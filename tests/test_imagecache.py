@@ -0,0 +1,48 @@
+"""
+imagecache's BootImages, in shared memory.
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+from imagecache import BootImage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# picks up the SharedImage in argv from a process of its own, and says what it found
+ATTACH = """
+import sys, json, hashlib
+sys.path.insert(0, sys.argv[1])
+from imagecache import BootImage, SharedImage
+try:
+    image = BootImage.attach(SharedImage(*json.loads(sys.argv[2])))
+except FileNotFoundError:
+    print(json.dumps(None))
+    sys.exit()
+print(json.dumps([image.size, image.digest, hashlib.sha256(image.data).hexdigest()]))
+image.close()
+"""
+
+def attach_elsewhere(shared):
+    out = subprocess.run([sys.executable, "-c", ATTACH, ROOT, json.dumps(shared)], capture_output=True, check=True).stdout
+    return json.loads(out)
+
+def test_share(images):
+    aboot, uboot = images
+    image, stamp = BootImage.load(uboot)
+    digest = image.digest
+    held = image.data[:100] #as if a boot in another thread were partway through sending it
+    shared = image.share()
+    assert image.share() == shared #only the once
+    assert shared.size == image.size and shared.digest == digest
+    assert held.tobytes() == image.data[:100].tobytes()
+    held.release()
+
+    # ...and twice, to be sure the first one going doesn't take the block with it
+    for i in range(2):
+        assert attach_elsewhere(shared) == [image.size, digest, digest]
+
+    image.close()
+    assert attach_elsewhere(shared) is None
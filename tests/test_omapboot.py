@@ -0,0 +1,110 @@
+"""
+omapboot's command line, and what it does besides booting.
+"""
+
+import re
+import json
+import errno
+import types
+import argparse
+
+import pytest
+
+import usbbulk
+import omapboot
+from usbbulk.sim import SimulatedOMAP4
+
+def test_deadline():
+    assert omapboot.deadline("bringup=2.5") == ("bringup", 2.5)
+    assert omapboot.deadline("bringup=never") == ("bringup", None)
+    for arg in ("bringup=0", "bringup=-1", "bringup=nan", "bringup=soon", "bringup", "nonsense=3"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            omapboot.deadline(arg)
+
+def write_rules(tmp_path, rules):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps(rules))
+    return str(path)
+
+def test_load_rules(tmp_path):
+    rules = omapboot.load_rules(write_rules(tmp_path, [
+        {"model": "4430", "ch": True, "aboot": "su760-aboot.2nd", "uboot": "/boot/su760-u-boot.bin"},
+        {"aboot": "p940-aboot.2nd", "uboot": None}]))
+    assert rules == [{"model": "4430", "ch": True,
+                      "aboot": str(tmp_path / "su760-aboot.2nd"), "uboot": "/boot/su760-u-boot.bin"},
+                     {"aboot": str(tmp_path / "p940-aboot.2nd"), "uboot": None}]
+
+@pytest.mark.parametrize("rules, message", [
+    ({"aboot": "aboot.2nd"}, "list of rules"),
+    (["aboot.2nd"], "list of rules"),
+    ([{"aboot": "aboot.2nd"}, {"serial": "1234", "aboot": "aboot.2nd"}], "rule 2 can't match on 'serial'"),
+    ([{"aboot": ["aboot.2nd"]}], "rule 1's 'aboot' should be a file name"),
+    ([{"model": "4430", "aboot": "aboot.2nd"}, {"uboot": 1}], "rule 2's 'uboot' should be a file name"),
+])
+def test_bad_rules(tmp_path, rules, message):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        omapboot.load_rules(write_rules(tmp_path, rules))
+
+RULES = [{"model": "4460", "aboot": "4460-aboot.2nd", "uboot": "4460-u-boot.bin"},
+         {"model": "4430", "mpkh": bytes(range(0x40, 0x60)).hex(), "aboot": "su760-aboot.2nd"}, #lower case
+         {"model": "4430", "aboot": "p940-aboot.2nd", "uboot": "p940-u-boot.bin"}]
+
+def test_choose_images():
+    device = dict(path="1-2", model="4430", ch=True, mpkh=bytes(range(0x40, 0x60)).hex().upper())
+    assert omapboot.choose_images(RULES, device) == {"aboot": "su760-aboot.2nd"} #the first that matches
+    device["mpkh"] = "00" * 32
+    assert omapboot.choose_images(RULES, device) == {"aboot": "p940-aboot.2nd", "uboot": "p940-u-boot.bin"}
+    assert omapboot.choose_images(RULES[1:], dict(path="1-3", model="4460")) == {}
+    assert omapboot.choose_images([], device) == {}
+
+class SimulatedOMAP4460(SimulatedOMAP4):
+    ASIC_ID = SimulatedOMAP4.ASIC_ID.replace(b"\x44\x30\x07\x04", b"\x44\x60\x07\x04")
+
+class FakeWatcher:
+    "a usbbulk.hotplug.Watcher for devices that are already plugged in"
+    def __init__(self, vendor, product):
+        pass
+    def wait(self, timeout=None):
+        return "1-1"
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        pass
+
+@pytest.fixture
+def devices(monkeypatch):
+    "simulated devices at 1-1 and 1-2 (an omap4430) and 1-3 (an omap4460), and 1-4 (gone before it could be opened)"
+    devices = {"1-1": SimulatedOMAP4(path="1-1"), "1-2": SimulatedOMAP4(path="1-2"),
+               "1-3": SimulatedOMAP4460(path="1-3"), "1-4": None}
+    def open_device(path, *args):
+        if devices[path] is None:
+            raise OSError(errno.ENODEV, "No such device")
+        return devices[path]
+    monkeypatch.setattr(usbbulk, "hotplug", types.SimpleNamespace(Watcher=FakeWatcher), raising=False)
+    monkeypatch.setattr(usbbulk, "BulkUSB", types.SimpleNamespace(enumerate=lambda vendor, product: sorted(devices)),
+                        raising=False)
+    monkeypatch.setattr(omapboot, "open_device", open_device)
+    return devices
+
+def test_scan(devices):
+    found = omapboot.scan()
+    assert [device["path"] for device in found] == ["1-1", "1-2", "1-3", "1-4"]
+    for device in found[:2]:
+        assert device["model"] == "4430"
+        assert device["ch"] is True
+        assert device["mpkh"] == bytes(range(0x40, 0x60)).hex().upper()
+        assert "aboot" not in device #no rules, no images
+    assert found[2]["model"] == "4460"
+    assert found[3] == {"path": "1-4", "error": "[Errno %d] No such device" % (errno.ENODEV,)}
+    assert all(dev.state == "rom" and dev.closed for dev in devices.values() if dev is not None) #asked, not booted
+
+def test_scan_rules(devices):
+    found = omapboot.scan(rules=RULES[2:] + RULES[:1])
+    assert [(device.get("aboot"), device.get("uboot")) for device in found] == \
+           [("p940-aboot.2nd", "p940-u-boot.bin")] * 2 + [("4460-aboot.2nd", "4460-u-boot.bin"), (None, None)]
+
+def test_scan_no_match(devices):
+    # a device that matches no rule still gets both, as None
+    found = omapboot.scan(rules=RULES[:1])
+    assert [(device["aboot"], device["uboot"]) for device in found[:2]] == [(None, None)] * 2
+    assert "aboot" not in found[3] #couldn't be asked, so there's no telling
@@ -0,0 +1,144 @@
+"""
+tuning.Tuner: trying transfer sizes out, settling on one, and remembering it.
+"""
+
+import json
+import errno
+
+import pytest
+
+from OMAP import OMAP4
+from tuning import Tuner, CANDIDATES, SAMPLES
+from usbbulk.sim import SimulatedOMAP4
+
+KEY = "sim 1-2 omap44"
+
+@pytest.fixture
+def profile(tmp_path):
+    return str(tmp_path / "transfer-sizes.json")
+
+def speed(size):
+    "made-up throughput for size: 64K is the fastest"
+    return {4096: 1e6, 16384: 3e6, 65536: 5e6, 262144: 4e6}[size]
+
+def test_explore(profile):
+    tuner = Tuner(profile, explore=True)
+    tried = []
+    for i in range(len(CANDIDATES) * SAMPLES):
+        assert tuner.profile.get(KEY, {}).get("best") is None
+        size = tuner.transfer_size(KEY)
+        tried.append(size)
+        tuner.record(KEY, size, speed(size), 0.001)
+    assert sorted(tried) == sorted(CANDIDATES * SAMPLES) #each of them as often as the others
+    assert tuner.profile[KEY]["best"] == 65536
+    assert tuner.transfer_size(KEY) == 65536
+    # and once it's settled, it stays settled
+    tuner.record(KEY, 4096, 100e6, 0.001)
+    assert tuner.transfer_size(KEY) == 65536
+
+def test_choose(profile):
+    tuner = Tuner(profile, explore=True)
+    for size in CANDIDATES:
+        tuner.record(KEY, size, speed(size), 0.001)
+    assert "best" not in tuner.profile[KEY] #not until every size has had SAMPLES goes
+    for size in CANDIDATES[:-1]:
+        for i in range(SAMPLES - 1):
+            tuner.record(KEY, size, speed(size), 0.001)
+    assert "best" not in tuner.profile[KEY]
+    tuner.record(KEY, 4096, 10e6, 0.001) #averages, so one fast go doesn't make a size
+    tuner.record(KEY, 262144, 8e6, 0.001)
+    assert tuner.profile[KEY]["best"] == 262144 #(4e6 + 8e6) / 2 beats 65536's 5e6
+
+def test_not_exploring(profile):
+    tuner = Tuner(profile)
+    assert tuner.transfer_size(KEY) is None
+    dev = SimulatedOMAP4(path="1-2")
+    default = dev.TRANSFER_SIZE
+    observer = object()
+    assert tuner.tune(dev, "omap44", observer) is observer
+    assert dev.TRANSFER_SIZE == default
+
+def test_too_big(profile):
+    tuner = Tuner(profile, explore=True)
+    dev = SimulatedOMAP4(path="1-2")
+    key = Tuner.key(dev, "omap44")
+    while tuner.transfer_size(key) != 262144:
+        tuner.record(key, tuner.transfer_size(key), 1e6, 0.001)
+    observer = tuner.tune(dev, "omap44")
+    assert dev.TRANSFER_SIZE == 262144
+    observer.phase_start("uboot_upload", 0)
+    observer.phase_end("uboot_upload", 1, error=OSError(errno.EINVAL, "Invalid argument"))
+    assert tuner.profile[key]["bad"] == [262144]
+    assert "262144" not in tuner.profile[key]["sizes"]
+    # never tried again, and the rest are enough to choose from
+    for i in range(len(CANDIDATES) * SAMPLES):
+        size = tuner.transfer_size(key)
+        assert size != 262144
+        tuner.record(key, size, speed(size), 0.001)
+    assert tuner.profile[key]["best"] == 65536
+
+def test_other_errors(profile):
+    tuner = Tuner(profile, explore=True)
+    dev = SimulatedOMAP4(path="1-2")
+    observer = tuner.tune(dev, "omap44")
+    observer.phase_start("uboot_upload", 0)
+    observer.phase_end("uboot_upload", 1, error=TimeoutError(errno.ETIMEDOUT, "Timed out"))
+    assert not tuner.profile.get(Tuner.key(dev, "omap44"), {}).get("bad")
+
+def test_boots(profile, images):
+    aboot, uboot = images
+    tuner = Tuner(profile, explore=True)
+    key = Tuner.key(SimulatedOMAP4(path="1-2"), "omap44")
+    sizes = []
+    for i in range(len(CANDIDATES) * SAMPLES):
+        dev = SimulatedOMAP4(xloader_latency=0, path="1-2")
+        observer = tuner.tune(dev, "omap44")
+        sizes.append(dev.TRANSFER_SIZE)
+        OMAP4(dev, verbose=False, observer=observer).boot(aboot, uboot, AUTOFLAG=True)
+        assert dev.state == "booted"
+    assert sorted(sizes) == sorted(CANDIDATES * SAMPLES)
+    best = tuner.profile[key]["best"]
+    assert best in CANDIDATES
+    dev = SimulatedOMAP4(path="1-2")
+    observer = object()
+    assert tuner.tune(dev, "omap44", observer) is observer #nothing left to measure
+    assert dev.TRANSFER_SIZE == best
+
+def test_save(profile):
+    first, second = Tuner(profile, explore=True), Tuner(profile, explore=True)
+    for size in CANDIDATES * SAMPLES:
+        first.record("sim 1-1 omap44", size, speed(size), 0.001)
+    second.record("sim 1-2 omap44", 4096, 1e6, 0.001)
+    first.save()
+    second.save() #rereads the profile, so doesn't undo what first saved
+    with open(profile) as f:
+        saved = json.load(f)
+    assert sorted(saved) == ["sim 1-1 omap44", "sim 1-2 omap44"]
+    assert saved["sim 1-1 omap44"]["best"] == 65536
+    # and the next run starts out with it
+    assert Tuner(profile).transfer_size("sim 1-1 omap44") == 65536
+    assert Tuner(profile).transfer_size("sim 1-2 omap44") is None
+
+def test_garbled(profile):
+    with open(profile, "w") as f:
+        f.write("{not json")
+    tuner = Tuner(profile, explore=True)
+    assert tuner.profile == {}
+    tuner.record(KEY, 4096, 1e6, 0.001)
+    tuner.save()
+    with open(profile) as f:
+        assert list(json.load(f)) == [KEY]
+
+def test_close(tmp_path, profile):
+    Tuner(profile, explore=True).close()
+    assert not (tmp_path / "transfer-sizes.json").exists() #nothing measured, nothing written
+    tuner = Tuner(profile, explore=True)
+    tuner.record(KEY, 4096, 1e6, 0.001)
+    tuner.close()
+    with open(profile) as f:
+        assert json.load(f)[KEY]["sizes"]["4096"]["throughput"] == [1e6]
+    # a profile that can't be read or written just isn't
+    (tmp_path / "file").write_text("")
+    tuner = Tuner(str(tmp_path / "file" / "transfer-sizes.json"), explore=True)
+    tuner.record(KEY, 4096, 1e6, 0.001)
+    tuner.close()
@@ -0,0 +1,90 @@
+"""
+uart.SerialPort, on a pty pair, with the simulated OMAP4 (or just us) on the other end.
+"""
+
+import os
+import pty
+import select
+import termios
+import threading
+
+import pytest
+
+import uart
+from uart import SerialPort
+from OMAP import OMAP4
+from usbbulk.sim import SimulatedOMAP4
+
+@pytest.fixture
+def tty():
+    "a pty pair: the master's fd, and the name of the slave to open a SerialPort on"
+    master, slave = pty.openpty()
+    yield master, os.ttyname(slave)
+    os.close(master)
+    os.close(slave)
+
+def serve(dev, master, stop):
+    # what bench.py's uart bench does: be the ROM on the far end of the line
+    while True:
+        if select.select([master], [], [], 0.001)[0]:
+            dev.timeout = None #take as long as the simulated line takes
+            dev.write(os.read(master, 1 << 16))
+        elif stop.is_set():
+            break #once whatever was still in the pty has been had
+        dev.timeout = 1 #but don't wait around for the simulated x-loader to come up
+        while True:
+            try:
+                os.write(master, dev.read(1 << 16))
+            except OSError:
+                break
+
+@pytest.fixture
+def drains(monkeypatch):
+    "a list of the fds tcdrain() is called on"
+    calls = []
+    tcdrain = termios.tcdrain
+    def counting(fd):
+        calls.append(fd)
+        return tcdrain(fd)
+    monkeypatch.setattr(uart.termios, "tcdrain", counting)
+    return calls
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_boot(tty, images, drains):
+    master, slave = tty
+    aboot, uboot = images
+    port = SerialPort(slave, 3000000) #first, as it throws away anything already sent
+    dev = SimulatedOMAP4(xloader_latency=0.01, announce_id=True)
+    stop = threading.Event()
+    server = threading.Thread(target=serve, args=(dev, master, stop))
+    server.start()
+    try:
+        OMAP4(port, verbose=False).boot(aboot, uboot, AUTOFLAG=True)
+    finally:
+        stop.set()
+        server.join()
+    assert dev.state == "booted"
+    assert dev.images["x-loader"] == read(aboot)
+    assert dev.images["u-boot"] == read(uboot)
+    assert len(drains) >= 2 #at the end of each image, at least
+
+def test_read_timeout(tty):
+    master, slave = tty
+    port = SerialPort(slave)
+    port.setTimeout(50)
+    with pytest.raises(TimeoutError):
+        port.read(64)
+    os.write(master, b"hello")
+    assert port.read(64) == b"hello" #once the line's gone quiet, rather than waiting for 64 bytes
+    port.close()
+
+def test_write_stream_drains(tty, drains):
+    master, slave = tty
+    port = SerialPort(slave)
+    assert port.write_stream([b"abc", memoryview(b"defg")]) == 7
+    assert len(drains) == 1 #once, at the end
+    assert os.read(master, 64) == b"abcdefg" #all of it out, not still waiting in our buffer
+    port.close()
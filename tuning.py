@@ -0,0 +1,235 @@
+"""
+working out the best transfer size for each USB port, and remembering it.
+
+How big the pieces an image is written in should be (BaseBulkUSB.TRANSFER_SIZE)
+depends on the backend, the kernel, the host controller and whatever hubs
+are in between, so there's no one right answer. Tuner finds out: for the
+first few uploads to each device on each port it tries each of CANDIDATES
+in turn (SAMPLES uploads apiece), measures how fast the upload went
+and how long each chunk kept us waiting, and from then on uses whichever was fastest.
+
+What it's found is kept in a small JSON profile (PROFILE, by default),
+keyed by backend, bus/port path and what's on the other end, e.g.
+ {"usbfs 1-2.3 omap44": {"best": 65536,
+                         "bad": [262144],
+                         "sizes": {"4096": {"throughput": [1181234.5, ...], "latency": [0.0031, ...]}, ...}}}
+so later boots start out with the size that was found, rather than finding it again.
+Delete the profile (or an entry from it) to have it tuned afresh.
+Once a port has its size, its uploads aren't measured any more.
+
+Trying sizes out is only done when asked for (Tuner(explore=True), omapboot --tune),
+since it's an experiment on real boots: a size the backend won't take at all
+(the kernel says EINVAL or ENOMEM to a transfer that big) is marked bad and
+never tried again, but the upload it broke fails, and it's up to omapboot's
+retries to make up for that. Without it, a Tuner only hands out sizes already found.
+
+Measurements are kept in memory and only written out by close(),
+so that no boot waits on the profile being rewritten.
+"""
+
+import os
+import json
+import errno
+import threading
+
+from instrument import Observer, Tee
+
+__all__ = ["Tuner", "PROFILE", "CANDIDATES"]
+
+PROFILE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "omapboot", "transfer-sizes.json")
+
+# the transfer sizes to choose between, in bytes; all whole numbers of any USB packet size
+CANDIDATES = [4*1024, 16*1024, 64*1024, 256*1024]
+
+# how many uploads each candidate gets before the best is picked
+SAMPLES = 2
+
+# uploads smaller than this are over too quickly to tell anything from (x-loader usually is)
+MIN_BYTES = 64*1024
+
+# which phases are uploads worth measuring; see instrument.py
+UPLOADS = ("xloader_upload", "uboot_upload", "download:")
+
+# what a backend says to a transfer that's too big for it
+TOO_BIG = (errno.EINVAL, errno.ENOMEM, errno.EMSGSIZE)
+
+# how many measurements of each size to keep
+HISTORY = 8
+
+class Tuner:
+    """
+    path is the profile to load and save (it's fine if it doesn't exist yet, or is garbled: it's only a cache);
+    if explore is false, sizes are only taken from it, never tried out,
+    so untuned ports keep their backend's default.
+    close() it when done, to save what was measured.
+
+    Safe to share between threads, so one Tuner can serve a whole farm.
+
+    usage:
+        tuner = Tuner(explore=True)
+        port = usbbulk.BulkUSB(VENDOR, PRODUCT)
+        observer = tuner.tune(port, "omap44", observer)
+        OMAP4(port, observer=observer).boot("aboot.2nd", "u-boot.bin")
+        tuner.close()
+    """
+
+    def __init__(self, path=PROFILE, explore=False):
+        self.path = path
+        self.explore = explore
+        self._lock = threading.Lock()
+        self._touched = set() #keys we've measured something for, which are what save() writes
+        self.profile = _load(path)
+
+    @staticmethod
+    def key(port, target):
+        "what port's entry in the profile is called, for talking to target (e.g. \"omap44\" or \"fastboot\"); None if it can't have one"
+        backend = getattr(port, "backend", None)
+        if backend is None or port.path is None:
+            return None
+        return "%s %s %s" % (backend, port.path, target)
+
+    def transfer_size(self, key):
+        """
+        the transfer size to use next for key: the best one found, if it's been tuned,
+        otherwise the candidate with the fewest measurements so far (or None, if not exploring).
+        """
+        with self._lock:
+            entry = self.profile.get(key, {})
+            if entry.get("best"):
+                return entry["best"]
+            if not self.explore:
+                return None
+            sizes = entry.get("sizes", {})
+            bad = entry.get("bad", [])
+            untried = [size for size in CANDIDATES if size not in bad]
+            if not untried:
+                return None
+            return min(untried, key=lambda size: len(sizes.get(str(size), {}).get("throughput", [])))
+
+    def tune(self, port, target, observer=None):
+        """
+        set port's transfer size to the one to use next (see transfer_size()),
+        and, if it's still being tried out, return an observer that passes everything on to observer and measures the uploads.
+        Otherwise (the port's tuned already, or can't be, or isn't to be) observer is returned as it is.
+        """
+        observer = observer if observer is not None else Observer()
+        key = self.key(port, target)
+        if key is None:
+            return observer
+        size = self.transfer_size(key)
+        if size is None:
+            return observer
+        port.TRANSFER_SIZE = size
+        with self._lock:
+            if self.profile.get(key, {}).get("best"):
+                return observer
+        return Tee(observer, _Measure(self, key, size))
+
+    def record(self, key, size, throughput, latency):
+        """
+        note that an upload to key in size pieces went at throughput bytes per second, with each chunk taking latency seconds,
+        and if that was the last measurement wanted, pick the best size.
+        """
+        with self._lock:
+            entry = self.profile.setdefault(key, {})
+            samples = entry.setdefault("sizes", {}).setdefault(str(size), {"throughput": [], "latency": []})
+            samples["throughput"] = (samples["throughput"] + [throughput])[-HISTORY:]
+            samples["latency"] = (samples["latency"] + [latency])[-HISTORY:]
+            if not entry.get("best"):
+                self._choose(entry)
+            self._touched.add(key)
+
+    def failed(self, key, size):
+        "note that key's backend won't take transfers of size at all"
+        with self._lock:
+            entry = self.profile.setdefault(key, {})
+            if size not in entry.setdefault("bad", []):
+                entry["bad"].append(size)
+            entry.get("sizes", {}).pop(str(size), None)
+            if not entry.get("best"):
+                self._choose(entry)
+            self._touched.add(key)
+
+    def _choose(self, entry):
+        # once every usable candidate has had its SAMPLES, the one with the best average throughput wins
+        sizes = entry.get("sizes", {})
+        bad = entry.get("bad", [])
+        candidates = [size for size in CANDIDATES if size not in bad]
+        if not candidates or any(len(sizes.get(str(size), {}).get("throughput", [])) < SAMPLES for size in candidates):
+            return
+        def speed(size):
+            throughput = sizes[str(size)]["throughput"]
+            return sum(throughput) / len(throughput)
+        entry["best"] = max(candidates, key=speed)
+
+    def close(self):
+        """
+        save() what's been measured, if anything has; a profile that can't be written
+        only means tuning again next time, so that's not an error.
+        """
+        if not self._touched:
+            return
+        try:
+            self.save()
+        except OSError:
+            pass
+
+    def save(self):
+        """
+        write what's been measured to the profile.
+
+        Other processes (another omapboot, say) may be tuning other ports into the same profile,
+        so it's reread first and only our own entries replaced; the file is replaced whole, never half-written.
+        """
+        with self._lock:
+            profile = _load(self.path)
+            for key in self._touched:
+                profile[key] = self.profile[key]
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temporary = "%s.%d.%d" % (self.path, os.getpid(), threading.get_ident())
+            with open(temporary, "w") as f:
+                json.dump(profile, f, indent=1, sort_keys=True)
+            os.replace(temporary, self.path)
+
+def _load(path):
+    # it's only a cache: one that's missing, unreadable or garbled is as good as empty
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return profile if isinstance(profile, dict) else {}
+
+class _Measure(Observer):
+    # what Tuner.tune() adds to a boot's observer: times each big enough upload and tells the tuner how it went
+
+    def __init__(self, tuner, key, size):
+        self.tuner = tuner
+        self.key = key
+        self.size = size
+        self._start = None
+        self._waited = 0 #seconds spent in chunks this upload
+        self._chunks = 0
+
+    def phase_start(self, phase, t):
+        if phase.startswith(UPLOADS):
+            self._start = t
+            self._waited = 0
+            self._chunks = 0
+
+    def chunk(self, nbytes, latency):
+        self._waited += latency
+        self._chunks += 1
+
+    def phase_end(self, phase, t, nbytes=0, error=None):
+        if self._start is None or not phase.startswith(UPLOADS):
+            return
+        start, self._start = self._start, None
+        if error is not None:
+            if isinstance(error, OSError) and error.errno in TOO_BIG:
+                self.tuner.failed(self.key, self.size)
+            return
+        if nbytes >= MIN_BYTES and t > start and self._chunks:
+            self.tuner.record(self.key, self.size, nbytes / (t - start), self._waited / self._chunks)
@@ -0,0 +1,191 @@
+"""
+serial ports, for booting omap44s over UART3 instead of USB.
+
+The ROM listens on UART3 (115200 8N1) as well as USB, which is handy on
+stations whose USB is what's broken. SerialPort wraps a termios tty
+(e.g. a USB-serial adapter at /dev/ttyUSB0, wired to the phone's UART3)
+in the same read()/write() interface as usbbulk's ports, so OMAP4 can
+drive it just the same. Two differences the protocol has to know about:
+ * over UART the ROM sends its ASIC ID by itself, straight after power-on,
+   rather than waiting to be asked with GET_ID (hence .announces_id);
+ * there are no packets, just a stream of bytes, so read() decides a reply
+   is over when the line has been quiet for .gap seconds.
+
+To keep the line busy, writes are collected in userspace and handed
+to the kernel in large pieces, and reads take whatever the kernel has
+in one go. The end of an image is marked with tcdrain(), which returns
+when the last byte has actually left the UART, rather than after however
+long we guess it took.
+
+Only POSIX (termios) serial ports so far.
+"""
+
+import os
+import time
+import errno
+import select
+import termios
+
+__all__ = ["SerialPort"]
+
+class SerialPort:
+    """
+    usage:
+        port = SerialPort("/dev/ttyUSB0")
+        OMAP4(port).boot("aboot.2nd", "u-boot.bin") #and then switch the phone on
+    """
+
+    # the ROM sends its ASIC ID unasked over UART; see OMAP.BootProtocol
+    announces_id = True
+
+    # how much write() collects before passing it to the kernel, and how much read() asks the kernel for at once
+    TRANSFER_SIZE = 64*1024
+
+    def __init__(self, path, baud=115200, rtscts=False, gap=0.02):
+        """
+        path is the tty, baud its speed in bits per second (one the platform's termios knows, e.g. 115200 or 3000000),
+        and rtscts whether to use hardware flow control.
+        gap is how many seconds of silence end a read(); it has to be longer than the
+        latency of whatever's in between, which is 16ms by default for FTDI's USB-serial adapters.
+        """
+        speed = getattr(termios, "B%d" % (baud,), None)
+        if speed is None:
+            raise ValueError("%d baud isn't a speed this system's serial ports do" % (baud,))
+        self.path = path
+        self.baud = baud
+        self.gap = gap
+        self._timeout = None
+        self._out = bytearray() #written, but not yet handed to the kernel
+        self._in = bytearray() #read from the kernel, but not yet by our caller
+        self._fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            self._saved = termios.tcgetattr(self._fd)
+            iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(self._fd)
+            # raw 8N1: no echo, no line editing, no translating CRs, no XON/XOFF, no signals from ^C
+            iflag = termios.IGNBRK
+            oflag = 0
+            lflag = 0
+            cflag = termios.CS8 | termios.CREAD | termios.CLOCAL | (termios.CRTSCTS if rtscts else 0)
+            cc[termios.VMIN] = 0
+            cc[termios.VTIME] = 0
+            termios.tcsetattr(self._fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+            termios.tcflush(self._fd, termios.TCIOFLUSH) #whatever was lying around from before isn't for us
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _wait(self, events, seconds):
+        # wait until the tty's ready for events, or seconds (None: forever) run out; says which
+        poller = select.poll()
+        poller.register(self._fd, events)
+        return bool(poller.poll(None if seconds is None else max(seconds * 1000, 0)))
+
+    def _deadline(self):
+        return None if self._timeout is None else time.monotonic() + self._timeout / 1000
+
+    def _write_all(self, data, deadline):
+        with memoryview(data) as view:
+            while view:
+                if not self._wait(select.POLLOUT, None if deadline is None else deadline - time.monotonic()):
+                    raise OSError(errno.ETIMEDOUT, "Timed out writing to %s" % (self.path,))
+                try:
+                    n = os.write(self._fd, view)
+                except BlockingIOError:
+                    continue
+                view = view[n:]
+
+    def flush(self):
+        """
+        hand everything write()n so far to the kernel.
+        """
+        if self._out:
+            self._write_all(self._out, self._deadline())
+            self._out = bytearray()
+
+    def drain(self):
+        """
+        flush(), then wait for the last byte to leave the UART.
+        """
+        self.flush()
+        termios.tcdrain(self._fd)
+
+    def write(self, data):
+        """
+        send data, or rather, queue it up to be sent with whatever comes next;
+        it goes out at the latest when the next read() needs an answer to it.
+        """
+        n = len(data)
+        if not self._out and n >= self.TRANSFER_SIZE:
+            self._write_all(data, self._deadline()) #big enough on its own: no sense copying it
+        else:
+            self._out += data
+            if len(self._out) >= self.TRANSFER_SIZE:
+                self.flush()
+        return n
+
+    def writev(self, buffers):
+        """
+        write() each of buffers; there are no transfers on a serial line, so that's all it takes to send them together.
+        """
+        return sum(self.write(b) for b in buffers)
+
+    def write_stream(self, chunks, depth=None):
+        """
+        write() each of chunks, then drain(): a whole image is only sent once it's all out of the UART.
+        """
+        total = 0
+        for chunk in chunks:
+            total += self.write(chunk)
+        self.drain()
+        return total
+
+    def read(self, size):
+        """
+        read up to size bytes: whatever arrives, as soon as some has and then the line goes quiet for .gap seconds
+        (or size bytes have arrived). Raises OSError(ETIMEDOUT) if nothing does within .timeout.
+        """
+        self.flush() #whatever we're expecting an answer to has to go out first
+        deadline = self._deadline()
+        while len(self._in) < size:
+            if self._in:
+                wait = self.gap #we've got the start of something: wait for the rest
+            elif deadline is not None:
+                wait = deadline - time.monotonic()
+            else:
+                wait = None
+            if not self._wait(select.POLLIN, wait):
+                break
+            try:
+                data = os.read(self._fd, max(size - len(self._in), self.TRANSFER_SIZE))
+            except BlockingIOError:
+                continue
+            if not data:
+                raise OSError(errno.EIO, "%s hung up" % (self.path,))
+            self._in += data
+        if not self._in:
+            raise OSError(errno.ETIMEDOUT, "Timed out reading from %s" % (self.path,))
+        data, self._in = bytes(self._in[:size]), self._in[size:]
+        return data
+
+    def reset(self):
+        raise NotImplementedError("There's no resetting a device over a serial port")
+
+    def close(self):
+        if self._fd is None:
+            return
+        try:
+            self.drain()
+            termios.tcsetattr(self._fd, termios.TCSANOW, self._saved)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    @property
+    def transfer_size(self):
+        return self.TRANSFER_SIZE
+
+    def setTimeout(self, timeout):
+        "in milliseconds, as for usbbulk's ports; None (or 0) means forever"
+        self._timeout = timeout or None
+
+    timeout = property(lambda self: self._timeout, lambda self, value: self.setTimeout(value))
@@ -1,10 +1,44 @@
-from . import pyusb
-from . import ugen
+"""
+bulk USB endpoints as file-like objects, on whatever USB API this system has.
+
+BulkUSB is the best backend available, worked out (and imported) the first
+time it's asked for rather than on import, so that programs which only
+sometimes touch USB (omapboot --help, for one) don't pay for loading
+every backend, libusb and all, just to throw most of them away.
+Likewise hotplug, which has to go looking for libusb.
+"""
+
+import sys
+import importlib
 
 __all__ = ["BulkUSB"]
 
-if hasattr(pyusb, 'BulkUSB'):
-    BulkUSB = pyusb.BulkUSB
+# in order of preference, with whether it's worth even trying to import it here
+_BACKENDS = [
+    ("ugen", "bsd" in sys.platform),
+    # talking to usbfs ourselves saves going through libusb, and through ctypes to get to libusb
+    ("usbfs", sys.platform.startswith("linux")),
+    ("pyusb", True),
+]
+
+def _backend():
+    for name, possible in _BACKENDS:
+        if not possible:
+            continue
+        try:
+            module = importlib.import_module("." + name, __name__)
+        except ImportError:
+            continue
+        if hasattr(module, "BulkUSB"):
+            return module.BulkUSB
+    raise ImportError("No USB API available")
 
-if hasattr(ugen, 'BulkUSB'):
-    BulkUSB = ugen.BulkUSB
\ No newline at end of file
+def __getattr__(name):
+    # PEP 562: only called for attributes the module doesn't have (yet)
+    global BulkUSB
+    if name == "BulkUSB":
+        BulkUSB = _backend()
+        return BulkUSB
+    if name == "hotplug":
+        return importlib.import_module(".hotplug", __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -1,4 +1,28 @@
 
+def matches(id, wanted):
+    """
+    whether USB vendor (or product) id `id` is the one `wanted`.
+    
+    wanted can also be a collection of ids, any of which will do
+    (e.g. the several vendor ids fastboot devices turn up with), or None for any id at all.
+    """
+    if wanted is None:
+        return True
+    if isinstance(wanted, int):
+        return id == wanted
+    return id in wanted
+
+def format_ids(vendor, product):
+    "vendor:product as lsusb would put it, for error messages; lists come out as 18d1|0451, None as *"
+    def fmt(wanted):
+        if wanted is None:
+            return "*"
+        if isinstance(wanted, int):
+            return "%04x" % wanted
+        return "|".join("%04x" % id for id in wanted)
+    return "%s:%s" % (fmt(vendor), fmt(product))
+
+
 class BaseBulkUSB:
     """
     abstract base class for file-like bulk-USB endpoint wrappers.
@@ -11,10 +35,13 @@ class BaseBulkUSB:
     implementations should support the unimplemented methods below,
      and 
     """
-    def __init__(self, vendor, product, endpoint=1):
+    def __init__(self, vendor, product, endpoint=1, path=None):
         """
+        vendor and product are USB ids, or lists of them (see matches())
         endpoint is a 4-bit integer identifying which particular piece of the device this bulk port talks to
         timeout is in milliseconds
+        path is a bus/port path as returned by enumerate(), e.g. "1-2.3";
+         None means "whichever matching device turns up first".
         """
         if not (0 <= endpoint < (1<<4)):
             raise ValueError("USB endpoints are only 4 bits long")
@@ -25,6 +52,19 @@ class BaseBulkUSB:
         
         self.device = None #??
         self._endpoint = endpoint #endpoint address (a 4-bit integer)
+        self._path = path
+    
+    @classmethod
+    def enumerate(cls, vendor, product):
+        """
+        return a list of the bus/port paths of every attached device matching (vendor, product) (see matches()).
+        
+        Paths are strings in the same format Linux uses in sysfs:
+        "<bus>-<port>.<port>...", e.g. "1-2.3" is port 3 of the hub on port 2 of bus 1.
+        Unlike device addresses, these stay put when a device re-enumerates,
+        so they name a physical socket on the station and not a particular phone.
+        """
+        raise NotImplementedError
     
     def read(self, len):
         raise NotImplementedError
@@ -32,6 +72,47 @@ class BaseBulkUSB:
     def write(self, data):
         raise NotImplementedError
     
+    def writev(self, buffers):
+        """
+        write the buffers in the sequence buffers, one after the other, as a single transfer,
+        the way writev(2) does for files: e.g. a command, its header and the start of what it's about.
+        
+        Implementations that can should gather them straight into the transfer;
+        this fallback joins them up and write()s that.
+        
+        returns the total number of bytes written
+        """
+        return self.write(b"".join(buffers))
+    
+    def write_stream(self, chunks, depth=None):
+        """
+        write each of the buffers in the iterable chunks, in order.
+        
+        Implementations that can should keep up to `depth` transfers in flight at once
+        so that the bus never sits idle waiting for us to hand over the next chunk;
+        this fallback just write()s them one after the other.
+        Either way, a writable chunk is finished with by the time the next one is asked for,
+        so it's safe for chunks to reuse its buffers (as util.read_ahead() does);
+        a read-only one (a slice of a mmap or an imagecache.BootImage, say) might be sent
+        straight out of, so it has to stay as it is until write_stream() returns.
+        
+        returns the total number of bytes written
+        """
+        total = 0
+        for chunk in chunks:
+            self.write(chunk)
+            total += len(chunk)
+        return total
+    
+    def reset(self):
+        """
+        reset the device, as if it had been unplugged and plugged back in.
+        
+        The device re-enumerates, so don't expect to be able to keep using this port:
+        close() it and open the device afresh (at the same .path) when it comes back.
+        """
+        raise NotImplementedError
+    
     def close(self):
         raise NotImplementedError
     
@@ -39,12 +120,43 @@ class BaseBulkUSB:
         "return device *address* (a 8-bit integer)"
         raise NotImplementedError
     
+    @property
+    def path(self):
+        "the bus/port path this port was opened on (see enumerate()), or None if unknown"
+        return self._path
+    
+    @property
+    def backend(self):
+        "the name of the usbbulk backend this port comes from, e.g. \"usbfs\""
+        return type(self).__module__.rpartition(".")[2]
+    
     @property
     def endpoint(self):
         "read-only endpoint address (a 4-bit integer)"
         "this is *not* the same as bEndpointAddress, which is an 8 bit integer but really only uses one of those 4 extra bits to declare the direction, which is really just overengineering"
         return self._endpoint
     
+    # wMaxPacketSize of the endpoint: the size of a single USB packet.
+    # 512 is what USB 2.0 high-speed bulk endpoints use; implementations
+    # that can ask the device should override this.
+    max_packet_size = 512
+    
+    # how much a single write() should be handed, in bytes, for best throughput.
+    # Every write() is a syscall (and for pyusb a trip through ctypes), so bigger is better,
+    # up until the kernel starts splitting our writes up for us anyway.
+    TRANSFER_SIZE = 16*1024
+    
+    @property
+    def transfer_size(self):
+        """
+        TRANSFER_SIZE, rounded down to a whole number of packets.
+        
+        Anything else makes every write() end in a short packet,
+        which in USB means "end of transfer", which is not what we mean at all.
+        """
+        mps = self.max_packet_size
+        return max(self.TRANSFER_SIZE // mps, 1) * mps
+    
     def setTimeout(self, timeout):
         """
         a timeout of None means infinity
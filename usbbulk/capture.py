@@ -0,0 +1,352 @@
+"""
+recording what goes over the wire, and playing it back.
+
+Recorder wraps any BaseBulkUSB and logs every read(), write() and reset()
+to a capture file: when it started (monotonic, since the port was opened),
+how long it took, how big it was, and for reads what came back; writes
+only get a CRC-32 of what was sent, so captures of multi-megabyte uploads
+stay small. Records are packed into memory and written out in batches
+from another thread, so recording costs the transfers themselves next to nothing.
+
+Replay is a BaseBulkUSB that plays a capture back: reads return what the
+device said then, and every write is checked against what the host sent
+then (a ReplayError if it differs), taking as long as they did, or that
+divided by speed, or no time at all. That makes a boot that was slow or
+failed in the field something that can be rerun, and timed, at a desk.
+
+recording() makes a backend that records every port it opens
+(omapboot --capture), and `python -m usbbulk.capture FILE` prints a capture out.
+
+The format, all little-endian:
+ header: MAGIC, version (u16), length of path (u16), max_packet_size (u32),
+         transfer_size (u32), wall clock time at the start (f64), then the path, UTF-8
+ then records: kind (1 byte), 3 bytes padding, size (u32), extra (u32),
+               start (i64 ns since the header's time), duration (i64 ns)
+   "R" a read: size bytes came back, extra were asked for; the size bytes follow
+   "W" a write: of size bytes, whose CRC-32 is extra
+   "X" a reset()
+   "r", "w", "x": the same, but it failed with errno extra (size is what was asked for)
+"""
+
+import os
+import sys
+import time
+import zlib
+import errno
+import queue
+import struct
+import threading
+import itertools
+
+from .base import *
+
+__all__ = ["Recorder", "Replay", "ReplayError", "recording", "records"]
+
+MAGIC = b"OMAPcap\0"
+VERSION = 1
+_HEADER = struct.Struct("<8sHHIId")
+_RECORD = struct.Struct("<c3xIIqq")
+
+class ReplayError(RuntimeError):
+    "the host didn't do what it did when the capture was made"
+
+class Recorder(BaseBulkUSB):
+    """
+    port, recording everything it does to f, a binary file (or the name of one) which close() closes.
+
+    usage:
+        port = Recorder(BulkUSB(VENDOR, PRODUCT), "boot.omapcap")
+        OMAP4(port).boot("aboot.2nd", "u-boot.bin")
+    """
+
+    # how much to collect before handing it to the writer thread, in bytes
+    BATCH = 256*1024
+
+    def __init__(self, port, f):
+        self._port = port
+        self._path = port.path
+        self._endpoint = port.endpoint
+        self._timeout = port.timeout
+        self._f = open(f, "wb") if isinstance(f, (str, bytes, os.PathLike)) else f
+        self._start = time.monotonic_ns()
+        self._when = time.time()
+        self._batch = None #until the header's written; see _header()
+        self._batches = queue.Queue()
+        self._writer = threading.Thread(target=self._write_batches, name="capture", daemon=True)
+        self._writer.start()
+
+    def _header(self):
+        # only written once there's something to record, so that it has the transfer size
+        # the port was actually used with, should that have been changed after opening it (see tuning.py)
+        path = (self._path or "").encode("utf-8")
+        self._batch = bytearray(_HEADER.pack(MAGIC, VERSION, len(path), self.max_packet_size, self.transfer_size, self._when) + path)
+
+    def _write_batches(self):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                break
+            self._f.write(batch)
+
+    def _record(self, kind, size, extra, start, payload=None):
+        if self._batch is None:
+            self._header()
+        self._batch += _RECORD.pack(kind, size, extra, start - self._start, time.monotonic_ns() - start)
+        if payload is not None:
+            self._batch += payload
+        if len(self._batch) >= self.BATCH:
+            self._batches.put(self._batch)
+            self._batch = bytearray()
+
+    def read(self, wanted):
+        start = time.monotonic_ns()
+        try:
+            data = self._port.read(wanted)
+        except OSError as e:
+            self._record(b"r", wanted, e.errno or 0, start)
+            raise
+        self._record(b"R", len(data), wanted, start, data)
+        return data
+
+    def write(self, data):
+        start = time.monotonic_ns()
+        try:
+            n = self._port.write(data)
+        except OSError as e:
+            self._record(b"w", len(data), e.errno or 0, start)
+            raise
+        self._record(b"W", len(data), zlib.crc32(data), start)
+        return n
+
+    def writev(self, buffers):
+        start = time.monotonic_ns()
+        n = sum(len(b) for b in buffers)
+        try:
+            self._port.writev(buffers)
+        except OSError as e:
+            self._record(b"w", n, e.errno or 0, start)
+            raise
+        crc = 0
+        for b in buffers:
+            crc = zlib.crc32(b, crc)
+        self._record(b"W", n, crc, start) #one transfer, so one record, just as if it had been write()n joined up
+        return n
+
+    def write_stream(self, chunks, depth=None):
+        # record each chunk as it's taken; with the writes pipelined, how long
+        # each one "took" is how long the port kept us waiting before it wanted the next
+        last = None
+        def recorded():
+            nonlocal last
+            for chunk in chunks:
+                last = len(chunk)
+                start = time.monotonic_ns()
+                yield chunk
+                self._record(b"W", len(chunk), zlib.crc32(chunk), start) #it's still ours until we ask for the next
+                last = None
+        start = time.monotonic_ns()
+        try:
+            return self._port.write_stream(recorded(), depth)
+        except OSError as e:
+            if last is not None:
+                self._record(b"w", last, e.errno or 0, start)
+            raise
+
+    def reset(self):
+        start = time.monotonic_ns()
+        try:
+            self._port.reset()
+        except OSError as e:
+            self._record(b"x", 0, e.errno or 0, start)
+            raise
+        self._record(b"X", 0, 0, start)
+
+    def close(self):
+        try:
+            self._port.close()
+        finally:
+            if self._writer is not None:
+                if self._batch is None:
+                    self._header()
+                self._batches.put(self._batch)
+                self._batches.put(None)
+                self._writer.join()
+                self._writer = None
+                self._f.close()
+
+    def setTimeout(self, timeout):
+        self._port.setTimeout(timeout)
+        self._timeout = self._port.timeout
+
+    @property
+    def max_packet_size(self):
+        return self._port.max_packet_size
+
+    @property
+    def transfer_size(self):
+        return self._port.transfer_size
+
+    @property
+    def TRANSFER_SIZE(self):
+        return self._port.TRANSFER_SIZE
+
+    @TRANSFER_SIZE.setter
+    def TRANSFER_SIZE(self, size):
+        self._port.TRANSFER_SIZE = size
+
+    @property
+    def backend(self):
+        return self._port.backend
+
+def recording(backend, directory):
+    """
+    a BulkUSB backend that opens ports with backend and records each of them into a new capture file in directory,
+    named after its bus/port path and when it was opened, e.g. 1-2.3.20131104-162206.0.omapcap
+    """
+    os.makedirs(directory, exist_ok=True)
+    counter = itertools.count()
+
+    class RecordingBulkUSB(Recorder):
+        def __init__(self, vendor, product, endpoint=1, path=None):
+            port = backend(vendor, product, endpoint, path)
+            name = "%s.%s.%d.omapcap" % (port.path or "usb", time.strftime("%Y%m%d-%H%M%S"), next(counter))
+            try:
+                super().__init__(port, os.path.join(directory, name))
+            except BaseException:
+                port.close()
+                raise
+
+        @classmethod
+        def enumerate(cls, vendor, product):
+            return backend.enumerate(vendor, product)
+
+    return RecordingBulkUSB
+
+def records(f):
+    """
+    read a capture from f, a binary file or the name of one.
+
+    returns its header, as a dict, and a list of its records, which are (kind, size, extra, start, duration, data) tuples,
+    data being None for everything but successful reads, and the times in seconds.
+    """
+    if isinstance(f, (str, bytes, os.PathLike)):
+        with open(f, "rb") as f:
+            return records(f)
+    data = f.read()
+    if len(data) < _HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s isn't a capture" % (getattr(f, "name", "this"),))
+    magic, version, pathlen, max_packet_size, transfer_size, when = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("%s is a version %d capture; only version %d is understood" % (getattr(f, "name", "this"), version, VERSION))
+    pos = _HEADER.size + pathlen
+    header = dict(path=data[_HEADER.size:pos].decode("utf-8") or None, max_packet_size=max_packet_size,
+                  transfer_size=transfer_size, time=when)
+
+    result = []
+    view = memoryview(data)
+    while pos < len(data):
+        if pos + _RECORD.size > len(data):
+            break #cut short; the program recording it must have died mid-batch
+        kind, size, extra, start, duration = _RECORD.unpack_from(data, pos)
+        pos += _RECORD.size
+        payload = None
+        if kind == b"R":
+            payload = bytes(view[pos:pos + size])
+            pos += size
+        result.append((kind, size, extra, start / 1e9, duration / 1e9, payload))
+    return header, result
+
+class Replay(BaseBulkUSB):
+    """
+    a device that does exactly what the one in a capture did.
+
+    f is the capture (see records()); speed is how much faster than recorded to take:
+    each read and write takes as long as it did (speed 1), or that divided by speed,
+    or no time at all (speed 0). Only the device's share of the time is replayed:
+    the gaps between transfers were the host's doing, and are up to the host doing the replaying.
+    (Deadlines are kept by the host's clock, so a capture of a boot that timed out
+    only plays back the same way at speed 1.)
+
+    usage:
+        port = Replay("1-2.3.20131104-162206.0.omapcap", speed=0)
+        OMAP4(port).boot("aboot.2nd", "u-boot.bin", AUTOFLAG=True)
+        assert port.remaining == 0
+    """
+
+    def __init__(self, f, speed=1.0):
+        header, self.records = records(f)
+        super().__init__(None, None, 1, header["path"])
+        self.max_packet_size = header["max_packet_size"]
+        self.TRANSFER_SIZE = header["transfer_size"]
+        self.speed = speed
+        self.closed = False
+        self._next = 0 #index into records of what's to happen next
+
+    @property
+    def remaining(self):
+        "how many of the capture's records haven't been replayed yet"
+        return len(self.records) - self._next
+
+    def _expect(self, what, *kinds):
+        if self.closed:
+            raise ValueError("I/O operation on closed device")
+        if self._next == len(self.records):
+            raise ReplayError("The host tried to %s after the end of the capture" % (what,))
+        record = self.records[self._next]
+        if record[0] not in kinds:
+            raise ReplayError("The host tried to %s where the capture has %s (record %d)" % (what, _describe(record), self._next))
+        self._next += 1
+        if self.speed:
+            time.sleep(record[4] / self.speed)
+        return record
+
+    def read(self, wanted):
+        kind, size, extra, start, duration, data = self._expect("read %d bytes" % (wanted,), b"R", b"r")
+        if kind == b"r":
+            raise OSError(extra, os.strerror(extra) + " (replayed)")
+        if size > wanted:
+            raise ReplayError("The host read only %d bytes where the capture has %d (record %d)" % (wanted, size, self._next - 1))
+        return data
+
+    def write(self, data):
+        crc = zlib.crc32(data)
+        kind, size, extra, start, duration, _ = self._expect("write %d bytes" % (len(data),), b"W", b"w")
+        if size != len(data) or (kind == b"W" and extra != crc):
+            raise ReplayError("The host wrote %d bytes (CRC %08x) where the capture has %s (record %d)" % (len(data), crc, _describe(self.records[self._next - 1]), self._next - 1))
+        if kind == b"w":
+            raise OSError(extra, os.strerror(extra) + " (replayed)")
+        return size
+
+    def reset(self):
+        kind, size, extra, start, duration, _ = self._expect("reset the device", b"X", b"x")
+        if kind == b"x":
+            raise OSError(extra, os.strerror(extra) + " (replayed)")
+
+    def close(self):
+        self.closed = True
+
+def _describe(record):
+    kind, size, extra, start, duration, data = record
+    if kind in (b"r", b"w", b"x"):
+        return "a failed %s (%s)" % ({b"r": "read", b"w": "write", b"x": "reset"}[kind], errno.errorcode.get(extra, extra))
+    if kind == b"R":
+        return "a read of %d bytes" % (size,)
+    if kind == b"W":
+        return "a write of %d bytes (CRC %08x)" % (size, extra)
+    if kind == b"X":
+        return "a reset"
+    return "something unknown (%r)" % (kind,)
+
+def main():
+    if len(sys.argv) != 2:
+        raise SystemExit("usage: python -m usbbulk.capture FILE")
+    header, transfers = records(sys.argv[1])
+    print("%s: %s, recorded %s (max packet size %d, transfer size %d)" % (
+        sys.argv[1], header["path"] or "unknown port", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(header["time"])),
+        header["max_packet_size"], header["transfer_size"]))
+    for record in transfers:
+        kind, size, extra, start, duration, data = record
+        print("%12.6f %10.6f %s%s" % (start, duration, _describe(record), ": " + data[:16].hex() if data else ""))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+find out about USB devices the moment they are plugged in.
+
+The OMAP ROM only listens for a peripheral boot for a moment after it
+powers up, so the faster we notice it the better. In order of preference:
+
+* LibusbWatcher asks libusb to call us back on attach (libusb >= 1.0.16)
+* UeventWatcher listens to the Linux kernel's uevent netlink socket directly,
+  which is what udev does
+* PollingWatcher rescans the bus every so often, which is what we used to do.
+
+All of them report devices already plugged in when they start watching,
+so there's no window in which a device can slip past unnoticed.
+
+usage:
+    with Watcher(VENDOR, PRODUCT) as w:
+        path = w.wait()
+    port = BulkUSB(VENDOR, PRODUCT, path=path)
+"""
+
+import sys
+import time
+import socket
+import collections
+
+from . import sysfs
+from .base import matches
+
+__all__ = ["Watcher"]
+
+
+class BaseWatcher:
+    """
+    abstract base class for hotplug watchers.
+
+    A watcher collects the bus/port paths (see BaseBulkUSB.enumerate())
+    of matching devices as they arrive; wait() hands them out in order.
+    vendor and product can be lists of ids (see base.matches()).
+    """
+
+    def __init__(self, vendor, product):
+        self.vendor = vendor
+        self.product = product
+        self._arrived = collections.deque()
+
+    def wait(self, timeout=None):
+        """
+        block until a matching device arrives and return its path.
+        timeout is in seconds; None means forever.
+        returns None if the timeout ran out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._arrived:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self._pump(remaining)
+        return self._arrived.popleft()
+
+    def _pump(self, timeout):
+        """
+        wait up to timeout seconds (None: forever) for events and queue up arrivals in self._arrived.
+        it's fine to return early, with or without having found anything.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            yield self.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PollingWatcher(BaseWatcher):
+    """
+    the last resort: rescan the bus every `interval` seconds.
+    """
+
+    def __init__(self, vendor, product, interval=0.1):
+        super().__init__(vendor, product)
+        from . import BulkUSB
+        self._enumerate = BulkUSB.enumerate
+        self._interval = interval
+        self._present = set()
+        self._scan()
+
+    def _scan(self):
+        present = set(self._enumerate(self.vendor, self.product))
+        self._arrived.extend(sorted(present - self._present))
+        self._present = present
+
+    def _pump(self, timeout):
+        time.sleep(self._interval if timeout is None else min(self._interval, timeout))
+        self._scan()
+
+
+if sys.platform.startswith("linux"):
+
+    class UeventWatcher(BaseWatcher):
+        """
+        listen for the kernel's "add" uevents on a NETLINK_KOBJECT_UEVENT socket.
+
+        This is the same feed udev listens to, so it needs no privileges,
+        but beware: it can arrive *before* udev has gotten around to
+        fixing up the permissions on /dev/bus/usb/, so the first attempt
+        to open the device may fail with EACCES for a few milliseconds.
+        """
+
+        NETLINK_KOBJECT_UEVENT = 15
+        KERNEL_GROUP = 1 #as opposed to 2, which is udev's re-broadcast
+
+        def __init__(self, vendor, product):
+            super().__init__(vendor, product)
+            self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_KOBJECT_UEVENT)
+            try:
+                self._sock.bind((0, self.KERNEL_GROUP)) #0: let the kernel pick our port id
+            except OSError:
+                self._sock.close()
+                raise
+            # now that we're listening, catch up with what's already there
+            self._arrived.extend(sysfs.devices(vendor, product))
+
+        def _pump(self, timeout):
+            self._sock.settimeout(timeout)
+            try:
+                msg = self._sock.recv(1 << 16)
+            except socket.timeout:
+                return
+            # "add@/devices/...\0ACTION=add\0DEVPATH=...\0SUBSYSTEM=usb\0..."
+            env = dict(field.split("=", 1) for field in msg.decode("utf-8", "replace").split("\0") if "=" in field)
+            if (env.get("ACTION") == "add" and env.get("SUBSYSTEM") == "usb"
+                and env.get("DEVTYPE") == "usb_device"):
+                # PRODUCT= is "<vendor>/<product>/<bcdDevice>", in unpadded hex
+                try:
+                    vendor, product = (int(id, 16) for id in env["PRODUCT"].split("/")[:2])
+                except (KeyError, ValueError):
+                    return
+                if matches(vendor, self.vendor) and matches(product, self.product):
+                    self._arrived.append(env["DEVPATH"].rsplit("/", 1)[-1])
+
+        def close(self):
+            self._sock.close()
+
+
+try:
+    import ctypes
+
+    class _timeval(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long)]
+
+    _hotplug_cb = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p)
+
+    class _device_descriptor(ctypes.Structure):
+        _fields_ = [("bLength", ctypes.c_uint8), ("bDescriptorType", ctypes.c_uint8), ("bcdUSB", ctypes.c_uint16),
+                    ("bDeviceClass", ctypes.c_uint8), ("bDeviceSubClass", ctypes.c_uint8), ("bDeviceProtocol", ctypes.c_uint8),
+                    ("bMaxPacketSize0", ctypes.c_uint8), ("idVendor", ctypes.c_uint16), ("idProduct", ctypes.c_uint16),
+                    ("bcdDevice", ctypes.c_uint16), ("iManufacturer", ctypes.c_uint8), ("iProduct", ctypes.c_uint8),
+                    ("iSerialNumber", ctypes.c_uint8), ("bNumConfigurations", ctypes.c_uint8)]
+
+    _libusb = None #see _load_libusb(); False if there isn't a usable one
+
+    def _load_libusb():
+        """
+        find libusb-1.0 and declare the functions we use from it.
+        
+        This is put off until a LibusbWatcher is actually wanted, since
+        ctypes.util.find_library() can mean running ldconfig, which is slow.
+        raises OSError if there's no libusb, or it's too old for hotplug.
+        """
+        global _libusb
+        if _libusb is None:
+            import ctypes.util
+            path = ctypes.util.find_library("usb-1.0")
+            lib = ctypes.CDLL(path) if path is not None else None
+            if lib is None or not hasattr(lib, "libusb_hotplug_register_callback"): #libusb < 1.0.16 doesn't have it
+                _libusb = False
+            else:
+                lib.libusb_init.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
+                lib.libusb_exit.argtypes = [ctypes.c_void_p]
+                lib.libusb_exit.restype = None
+                lib.libusb_has_capability.argtypes = [ctypes.c_uint32]
+                lib.libusb_hotplug_register_callback.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, _hotplug_cb, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+                lib.libusb_hotplug_deregister_callback.argtypes = [ctypes.c_void_p, ctypes.c_int]
+                lib.libusb_hotplug_deregister_callback.restype = None
+                lib.libusb_handle_events_timeout_completed.argtypes = [ctypes.c_void_p, ctypes.POINTER(_timeval), ctypes.POINTER(ctypes.c_int)]
+                lib.libusb_get_bus_number.argtypes = [ctypes.c_void_p]
+                lib.libusb_get_bus_number.restype = ctypes.c_uint8
+                lib.libusb_get_port_numbers.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint8), ctypes.c_int]
+                lib.libusb_get_device_descriptor.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+                _libusb = lib
+        if not _libusb:
+            raise OSError("libusb-1.0 (>= 1.0.16) not found")
+        return _libusb
+
+    class LibusbWatcher(BaseWatcher):
+        """
+        libusb's hotplug API: <http://libusb.sourceforge.net/api-1.0/hotplug.html>
+
+        pyusb doesn't wrap this (yet?) so we talk to libusb with ctypes,
+        on a libusb context of our own.
+        """
+
+        _CAP_HAS_HOTPLUG = 0x0001
+        _EVENT_ARRIVED = 0x01
+        _ENUMERATE = 0x01 #fire for devices that are already there, too
+        _MATCH_ANY = -1
+
+        def __init__(self, vendor, product):
+            super().__init__(vendor, product)
+            _load_libusb()
+            if not _libusb.libusb_has_capability(self._CAP_HAS_HOTPLUG):
+                raise OSError("This libusb does not support hotplug on this platform.")
+            self._ctx = ctypes.c_void_p()
+            r = _libusb.libusb_init(ctypes.byref(self._ctx))
+            if r < 0:
+                raise OSError("libusb_init failed: %d" % r)
+
+            # this must stay referenced for as long as libusb might call it
+            self._cb = _hotplug_cb(self._on_event)
+            self._handle = ctypes.c_int()
+            # libusb can only filter on a single id; for lists, _on_event() does the filtering
+            r = _libusb.libusb_hotplug_register_callback(self._ctx, self._EVENT_ARRIVED, self._ENUMERATE,
+                                                         vendor if isinstance(vendor, int) else self._MATCH_ANY,
+                                                         product if isinstance(product, int) else self._MATCH_ANY,
+                                                         self._MATCH_ANY,
+                                                         self._cb, None, ctypes.byref(self._handle))
+            if r < 0:
+                _libusb.libusb_exit(self._ctx)
+                raise OSError("libusb_hotplug_register_callback failed: %d" % r)
+
+        def _on_event(self, ctx, dev, event, user_data):
+            # libusb says not to do anything heavy in here, so just take note of the path.
+            if not (isinstance(self.vendor, int) and isinstance(self.product, int)):
+                desc = _device_descriptor()
+                if (_libusb.libusb_get_device_descriptor(dev, ctypes.byref(desc)) < 0
+                    or not (matches(desc.idVendor, self.vendor) and matches(desc.idProduct, self.product))):
+                    return 0
+            ports = (ctypes.c_uint8 * 7)() #USB allows at most 7 tiers
+            n = _libusb.libusb_get_port_numbers(dev, ports, len(ports))
+            bus = _libusb.libusb_get_bus_number(dev)
+            self._arrived.append("%d-%s" % (bus, ".".join(str(p) for p in ports[:max(n, 0)])))
+            return 0 #keep the callback registered
+
+        def _pump(self, timeout):
+            # wake up at least every so often, so that a Ctrl-C gets a look in.
+            if timeout is None or timeout > 0.5:
+                timeout = 0.5
+            tv = _timeval(int(timeout), int((timeout % 1) * 1e6))
+            r = _libusb.libusb_handle_events_timeout_completed(self._ctx, ctypes.byref(tv), None)
+            if r < 0 and r != -10: #LIBUSB_ERROR_INTERRUPTED
+                raise OSError("libusb_handle_events failed: %d" % r)
+
+        def close(self):
+            if self._ctx:
+                _libusb.libusb_hotplug_deregister_callback(self._ctx, self._handle)
+                _libusb.libusb_exit(self._ctx)
+                self._ctx = None
+
+except ImportError:
+    pass
+
+
+def Watcher(vendor, product):
+    """
+    construct the best watcher this system supports.
+    """
+    for cls in ("LibusbWatcher", "UeventWatcher"):
+        cls = globals().get(cls)
+        if cls is None:
+            continue
+        try:
+            return cls(vendor, product)
+        except OSError:
+            pass
+    return PollingWatcher(vendor, product)
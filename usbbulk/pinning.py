@@ -0,0 +1,64 @@
+"""
+helpers for pointing the USB stack straight at the memory behind a python buffer, uncopied.
+
+ctypes' from_buffer() only takes writable buffers, and the images we send are
+mostly read-only (mmaps, and imagecache.BootImages), so this goes through
+CPython's own buffer protocol instead.
+"""
+
+import ctypes
+
+# CPython's Py_buffer
+class _Py_buffer(ctypes.Structure):
+    _fields_ = [("buf", ctypes.c_void_p),
+                ("obj", ctypes.c_void_p),
+                ("len", ctypes.c_ssize_t),
+                ("itemsize", ctypes.c_ssize_t),
+                ("readonly", ctypes.c_int),
+                ("ndim", ctypes.c_int),
+                ("format", ctypes.c_char_p),
+                ("shape", ctypes.c_void_p),
+                ("strides", ctypes.c_void_p),
+                ("suboffsets", ctypes.c_void_p),
+                ("internal", ctypes.c_void_p)]
+
+_get_buffer = ctypes.PYFUNCTYPE(ctypes.c_int, ctypes.py_object, ctypes.POINTER(_Py_buffer), ctypes.c_int)(("PyObject_GetBuffer", ctypes.pythonapi))
+_release_buffer = ctypes.PYFUNCTYPE(None, ctypes.POINTER(_Py_buffer))(("PyBuffer_Release", ctypes.pythonapi))
+
+class Pinned:
+    """
+    the memory behind contiguous buffer data, held on to (so it can't be released
+    or resized) from when this is made until release() (or the end of a `with`).
+
+    It looks enough like an array.array, which is only ever asked for its
+    buffer_info() and itemsize, to be handed to pyusb's libusb1 backend as one.
+
+    Pinning a memoryview stops it from being release()d in the meantime;
+    pin a memoryview(view) of your own to leave whoever owns view free to.
+    """
+    itemsize = 1
+
+    def __init__(self, data):
+        self._view = _Py_buffer()
+        _get_buffer(data, ctypes.byref(self._view), 0) #PyBUF_SIMPLE: just the bytes, contiguous, or a BufferError
+
+    @property
+    def address(self):
+        return self._view.buf or 0 #NULL for some empty buffers
+
+    def __len__(self):
+        return self._view.len
+
+    def buffer_info(self):
+        return self.address, self._view.len
+
+    def release(self):
+        if self._view is not None:
+            _release_buffer(ctypes.byref(self._view))
+            self._view = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -4,23 +4,132 @@ try:
     import usb.core #old pyusbs are incompatible and do not have this module
     # TODO: check version explicitly. 
     
+    import array
+    
     from .base import *
+    from . import sysfs
+    from .pinning import Pinned
 
+    import ctypes
+    import errno
+    import collections
+    
+    # libusb's asynchronous API, which pyusb doesn't wrap.
+    # See <http://libusb.sourceforge.net/api-1.0/group__asyncio.html>
+    
+    class _libusb_transfer(ctypes.Structure):
+        pass
+    
+    _transfer_cb = ctypes.CFUNCTYPE(None, ctypes.POINTER(_libusb_transfer))
+    
+    _libusb_transfer._fields_ = [("dev_handle", ctypes.c_void_p),
+                                 ("flags", ctypes.c_uint8),
+                                 ("endpoint", ctypes.c_ubyte),
+                                 ("type", ctypes.c_ubyte),
+                                 ("timeout", ctypes.c_uint),
+                                 ("status", ctypes.c_int),
+                                 ("length", ctypes.c_int),
+                                 ("actual_length", ctypes.c_int),
+                                 ("callback", _transfer_cb),
+                                 ("user_data", ctypes.c_void_p),
+                                 ("buffer", ctypes.c_void_p),
+                                 ("num_iso_packets", ctypes.c_int)]
+    
+    class _timeval(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long)]
+    
+    _LIBUSB_TRANSFER_TYPE_BULK = 2
+    _LIBUSB_TRANSFER_COMPLETED = 0
+    # libusb_transfer_status -> errno, so that util.is_timeout() and friends work on the USBErrors we raise
+    _transfer_errno = {1: errno.EIO,       #ERROR
+                       2: errno.ETIMEDOUT, #TIMED_OUT
+                       3: errno.ECANCELED, #CANCELLED
+                       4: errno.EPIPE,     #STALL
+                       5: errno.ENODEV,    #NO_DEVICE
+                       6: errno.EOVERFLOW} #OVERFLOW
+    
+    def _libusb_async(lib):
+        """
+        look up the async functions in pyusb's copy of libusb.
+        These get prototypes of their own so as to not disturb the ones pyusb sets up.
+        """
+        proto = lambda restype, name, *argtypes: ctypes.CFUNCTYPE(restype, *argtypes)((name, lib))
+        return dict(
+            alloc=proto(ctypes.POINTER(_libusb_transfer), "libusb_alloc_transfer", ctypes.c_int),
+            free=proto(None, "libusb_free_transfer", ctypes.POINTER(_libusb_transfer)),
+            submit=proto(ctypes.c_int, "libusb_submit_transfer", ctypes.POINTER(_libusb_transfer)),
+            cancel=proto(ctypes.c_int, "libusb_cancel_transfer", ctypes.POINTER(_libusb_transfer)),
+            handle_events=proto(ctypes.c_int, "libusb_handle_events_timeout_completed", ctypes.c_void_p, ctypes.POINTER(_timeval), ctypes.POINTER(ctypes.c_int)),
+        )
+    
+    def _libusb1(dev):
+        """
+        pyusb's libusb1 backend for usb.core.Device dev, if that's what it's using
+        and pyusb's internals are laid out the way BulkUSB expects, since it goes around
+        Device.write() to get at it; otherwise None, and BulkUSB sticks to Device.write().
+        """
+        try:
+            ctx = dev._ctx
+            backend = ctx.backend
+            backend.lib, backend.ctx, backend.bulk_write, ctx.setup_request, ctx.managed_open().handle
+        except AttributeError:
+            return None
+        if type(backend).__module__ != "usb.backend.libusb1":
+            return None
+        return backend
+    
+    def _path(dev):
+        """
+        compute the sysfs-style bus/port path ("1-2.3") of a usb.core.Device
+        
+        raises OSError if there's no finding it out: anything else (the device address, say)
+        would never match the paths that the other backends and hotplug.Watcher hand out.
+        """
+        ports = getattr(dev, "port_numbers", None) #only in pyusb >= 1.0.0b2, and only if libusb is new enough to tell it
+        if ports:
+            return "%d-%s" % (dev.bus, ".".join(str(p) for p in ports))
+        # ask Linux which of its devices has this address
+        for path in sysfs.devices(dev.idVendor, dev.idProduct):
+            if sysfs.attr(path, "busnum") == str(dev.bus) and sysfs.attr(path, "devnum") == str(dev.address):
+                return path
+        raise OSError("Can't tell which port the USB device at bus %s address %s is on: "
+                      "that needs pyusb >= 1.0 on libusb >= 1.0.16, or Linux's sysfs" % (dev.bus, dev.address))
+    
+    def _find(vendor, product):
+        """
+        every usb.core.Device matching (vendor, product), which can be lists (see matches())
+        """
+        return usb.core.find(find_all=True, custom_match=lambda dev: matches(dev.idVendor, vendor) and matches(dev.idProduct, product))
+    
     class BulkUSB(BaseBulkUSB):
         """
         pyusb is essentially just a wrapper around libusb
         it has one other 'backend' but its API is sooo close.
         """
         
-        def __init__(self, vendor, product, endpoint=1):
+        def __init__(self, vendor, product, endpoint=1, path=None):
             """
             
             """
-            super().__init__(vendor, product, endpoint)
+            super().__init__(vendor, product, endpoint, path)
             
-            self._dev = usb.core.find(idVendor=vendor, idProduct=product)
-            if self._dev is None:
-                raise OSError("Unable to find USB Device %04x:%04x" % (vendor, product))
+            for dev in _find(vendor, product):
+                if path is None:
+                    # any device will do, so it doesn't matter if we can't say where it is
+                    try:
+                        self._path = _path(dev)
+                    except OSError:
+                        self._path = None
+                    self._dev = dev
+                    break
+                if _path(dev) == path:
+                    self._dev = dev
+                    self._path = path
+                    break
+            else:
+                if path is None:
+                    raise OSError("Unable to find USB Device %s" % format_ids(vendor, product))
+                raise OSError("Unable to find USB Device %s at %s" % (format_ids(vendor, product), path))
             
             #print(self._dev) #DEBUG
             
@@ -31,7 +140,27 @@ try:
             
             # Device.{read,write}() implicitly calls libusb_claim_interface as needed.
             
+            # checked now rather than on every write, so a pyusb (or libusb) that isn't what we expect
+            # gets the plain Device.write() path from the start instead of falling over partway through an upload
+            self._libusb1 = _libusb1(self._dev)
+            self._async = None #libusb's asynchronous API, for write_stream()
+            if self._libusb1 is not None:
+                try:
+                    self._async = _libusb_async(self._libusb1.lib)
+                except AttributeError:
+                    pass #a libusb from before libusb_handle_events_timeout_completed()
+            
+            # look up the real packet size of our endpoint
+            for intf in self._dev.get_active_configuration():
+                for ep in intf:
+                    if ep.bEndpointAddress == self.endpoint: #the OUT side, which is the side we upload on
+                        self.max_packet_size = ep.wMaxPacketSize
             
+            
+        @classmethod
+        def enumerate(cls, vendor, product):
+            return [_path(dev) for dev in _find(vendor, product)]
+        
         def read(self, len):
             """
             returns a bytes object
@@ -46,9 +175,142 @@ try:
         
         def write(self, data):
             """
-            data should be a bytes object
+            data can be any buffer (bytes, a memoryview of an mmap, ...).
+            
+            On libusb1, it goes to libusb as it is, without being copied;
+            otherwise Device.write() wants an array.array, so it's copied into one.
             """
-            return self._dev.write(self.endpoint, data, timeout=self.timeout) #careful: pyusb returns array objects, but because of the magic of iterators and polymorphism, *hidden inside this call*, data can be a bytes
+            if self._libusb1 is not None:
+                # what Device.write() does, minus turning data into an array.array
+                intf, ep = self._dev._ctx.setup_request(self._dev, self.endpoint)
+                with Pinned(data) as buf: #pyusb takes it for an array.array, and libusb gets data's own memory
+                    return self._libusb1.bulk_write(self._dev._ctx.handle, ep.bEndpointAddress, intf.bInterfaceNumber, buf,
+                                                    self._dev.default_timeout if self.timeout is None else self.timeout)
+            if not isinstance(data, array.array):
+                # pyusb would build its array.array out of this one element at a time; memcpy it in one go instead
+                buf = array.array("B")
+                buf.frombytes(data)
+                data = buf
+            return self._dev.write(self.endpoint, data, timeout=self.timeout)
+        
+        def reset(self):
+            self._dev.reset()
+        
+        # how many transfers write_stream() keeps in flight
+        STREAM_DEPTH = 4
+        
+        def write_stream(self, chunks, depth=None):
+            """
+            pipelined version of BaseBulkUSB.write_stream(), on libusb's asynchronous transfers.
+            
+            Each chunk is submitted as it is, if it's read-only (see BaseBulkUSB.write_stream()),
+            or else copied into one of `depth` transfer buffers first, since its buffer's about to be reused;
+            we only block when all of them are in flight, so the host controller always has the next one queued up.
+            Without libusb1 (see _libusb1()), or its asynchronous API, this falls back on write()ing them one at a time.
+            """
+            if self._async is None:
+                # not the libusb1 backend, or a pyusb whose internals look different from what we expect
+                return super().write_stream(chunks)
+            ctx = self._libusb1.ctx
+            # this is what Device.write() does under the hood: open, claim the interface, and find the endpoint
+            handle = self._dev._ctx.managed_open().handle.value
+            self._dev._ctx.setup_request(self._dev, self.endpoint)
+            
+            f = self._async
+            depth = depth or self.STREAM_DEPTH
+            timeout = self.timeout or 0 #0 is libusb for 'forever'
+            
+            done = [ctypes.c_int(0) for i in range(depth)]
+            @_transfer_cb
+            def callback(transfer):
+                done[transfer.contents.user_data or 0].value = 1 #user_data is the transfer's index
+            
+            transfers = []
+            buffers = [] #for copies of the chunks that can't be sent out of as they are
+            pinned = [None] * depth #the ones that can, held on to until they've gone
+            free = collections.deque(range(depth))
+            inflight = collections.deque()
+            total = 0
+            try:
+                def unpin(i):
+                    if pinned[i] is not None:
+                        pinned[i].release()
+                        pinned[i] = None
+                
+                def reap():
+                    # transfers on one endpoint complete in the order they were submitted, so wait on the oldest
+                    i = inflight.popleft()
+                    while not done[i].value:
+                        tv = _timeval(1, 0)
+                        r = f["handle_events"](ctx, ctypes.byref(tv), ctypes.byref(done[i]))
+                        if r < 0 and r != -10: #LIBUSB_ERROR_INTERRUPTED
+                            raise usb.core.USBError("libusb_handle_events failed", r)
+                    t = transfers[i].contents
+                    if t.status != _LIBUSB_TRANSFER_COMPLETED:
+                        raise usb.core.USBError("Bulk transfer failed (libusb_transfer_status %d)" % t.status,
+                                                None, _transfer_errno.get(t.status, errno.EIO))
+                    if t.actual_length != t.length:
+                        raise usb.core.USBError("Short bulk write: %d of %d bytes" % (t.actual_length, t.length),
+                                                None, errno.EIO)
+                    unpin(i)
+                    free.append(i)
+                
+                for chunk in chunks:
+                    if not free:
+                        reap()
+                    i = free.popleft()
+                    n = len(chunk)
+                    if i == len(transfers):
+                        # allocate lazily, so short streams (and short images) don't pay for all of them
+                        transfers.append(f["alloc"](0))
+                        if not transfers[i]:
+                            raise MemoryError("libusb_alloc_transfer failed")
+                        buffers.append(None)
+                    if memoryview(chunk).readonly:
+                        # pin a view of our own, so that the caller can still release theirs
+                        pinned[i] = Pinned(memoryview(chunk))
+                        buf = pinned[i].address
+                    else:
+                        if buffers[i] is None or len(buffers[i]) < n:
+                            buffers[i] = (ctypes.c_ubyte * max(n, self.transfer_size))()
+                        memoryview(buffers[i]).cast("B")[:n] = chunk
+                        buf = ctypes.addressof(buffers[i])
+                    
+                    t = transfers[i].contents
+                    t.dev_handle = handle
+                    t.endpoint = self.endpoint
+                    t.type = _LIBUSB_TRANSFER_TYPE_BULK
+                    t.timeout = timeout
+                    t.length = n
+                    t.buffer = buf
+                    t.callback = callback
+                    t.user_data = i
+                    done[i].value = 0
+                    r = f["submit"](transfers[i])
+                    if r < 0:
+                        unpin(i)
+                        free.appendleft(i)
+                        raise usb.core.USBError("libusb_submit_transfer failed", r)
+                    inflight.append(i)
+                    total += n
+                
+                while inflight:
+                    reap()
+            finally:
+                if inflight:
+                    # we're bailing out; take back what's still queued before freeing it underneath libusb
+                    for i in inflight:
+                        f["cancel"](transfers[i])
+                    for i in inflight:
+                        while not done[i].value:
+                            tv = _timeval(1, 0)
+                            if f["handle_events"](ctx, ctypes.byref(tv), ctypes.byref(done[i])) < 0:
+                                break
+                for t in transfers:
+                    f["free"](t)
+                for i in range(depth):
+                    unpin(i)
+            return total
         
         def close(self):
             
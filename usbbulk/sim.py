@@ -0,0 +1,317 @@
+"""
+a pretend OMAP4, for trying omapboot out without a phone on hand.
+
+SimulatedOMAP4 speaks the ROM's side of the peripheral boot protocol
+(as OMAP.OMAP4 understands it) over the BaseBulkUSB interface:
+ * GET_ID gets an ASIC ID back,
+ * BOOT, a size and an image start "x-loader",
+ * which after a while says 0xAABBCCDD and takes a size and an image of u-boot.
+By default the ROM takes these as a stream, however they're split into transfers,
+so it takes OMAP4's coalesced writes too; with commands_alone it only takes
+a command (or a size) in a transfer of its own, which is the other thing a ROM might do.
+
+It can be made slow (per-transfer latency and limited bandwidth, to model
+the bus) and unreliable (random I/O errors, unplugging partway through,
+an x-loader that never comes up), so it's useful for benchmarks too.
+
+SimulatedFastboot is what a u-boot_fastboot.bin turns into afterwards:
+the device's side of fastboot (see fastboot.py), with partitions to flash.
+
+Neither is ever picked as the BulkUSB; you have to ask for them.
+"""
+
+import time
+import errno
+import struct
+import random
+
+from .base import *
+
+__all__ = ["SimulatedOMAP4", "SimulatedFastboot"]
+
+def _subblock(type, data):
+    return bytes([type, len(data) + 1, 1]) + data #the 1 is a fixed value; see TRM table 27-19
+
+class _SimulatedDevice(BaseBulkUSB):
+    """
+    the bus, as far as the simulated devices are concerned: how long transfers take, and whether they work.
+    Subclasses call _transfer(nbytes) at the start of every read() and write().
+    """
+
+    def __init__(self, vendor, product, bandwidth=None, latency=0, error_rate=0, seed=None,
+                 max_packet_size=512, path="sim"):
+        super().__init__(vendor, product, 1, path)
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_packet_size = max_packet_size
+        self._random = random.Random(seed)
+        self.state = None #"gone" once the device has left the bus
+        self.closed = False
+        self.transfers = 0 #how many read()s and write()s there have been
+        self._busy_until = 0 #when the bus will be free again
+
+    def _transfer(self, nbytes):
+        # account for time on the bus, and maybe fall over
+        if self.closed:
+            raise ValueError("I/O operation on closed device")
+        if self.state == "gone":
+            raise OSError(errno.ENODEV, "No such device (simulated)")
+        self.transfers += 1
+        start = max(time.monotonic(), self._busy_until)
+        self._busy_until = start + self.latency + (nbytes / self.bandwidth if self.bandwidth else 0)
+        delay = self._busy_until - time.monotonic()
+        if self.timeout is not None and delay > self.timeout / 1000:
+            time.sleep(self.timeout / 1000)
+            raise OSError(errno.ETIMEDOUT, "Operation timed out (simulated)")
+        if delay > 0:
+            time.sleep(delay)
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise OSError(errno.EIO, "Input/output error (simulated)")
+
+    def _nothing_to_read(self):
+        if self.timeout is not None:
+            time.sleep(self.timeout / 1000)
+        raise OSError(errno.ETIMEDOUT, "Operation timed out (simulated)")
+
+    def close(self):
+        self.closed = True
+
+class SimulatedOMAP4(_SimulatedDevice):
+    """
+    usage:
+        dev = SimulatedOMAP4(bandwidth=40e6, xloader_latency=0.3)
+        OMAP4(dev).boot("aboot.2nd", "u-boot.bin", AUTOFLAG=True)
+        assert dev.state == "booted"
+    """
+
+    # what an omap4430 with a closed-up (CH enabled) ROM revision 4 says to GET_ID
+    # (the IDEN, MPKH and CRCs are made up)
+    ASIC_ID = bytes([5]) \
+              + _subblock(0x01, b"\x44\x30\x07\x04") \
+              + _subblock(0x13, b"\x00") \
+              + _subblock(0x12, bytes(range(0x10, 0x10 + 20))) \
+              + _subblock(0x14, bytes(range(0x40, 0x40 + 32))) \
+              + _subblock(0x15, b"\xde\xad\xbe\xef\xca\xfe\xf0\x0d")
+
+    BANNER = struct.pack("I", 0xAABBCCDD)
+
+    GET_ID = struct.pack("I", 0xF0030003)
+    BOOT = struct.pack("I", 0xF0030002)
+    BOOT_NEXT = struct.pack("I", 0xFFFFFFFF)
+
+    def __init__(self, bandwidth=None, latency=0, xloader_latency=0.3,
+                 error_rate=0, unplug_after=None, xloader_hangs=False,
+                 seed=None, max_packet_size=512, path="sim", announce_id=False, commands_alone=False):
+        """
+        bandwidth: bytes/second the bus carries; None for infinitely fast
+        latency: seconds of overhead for every transfer, either direction
+        xloader_latency: seconds between x-loader arriving and its banner
+        error_rate: probability that any given transfer fails with EIO
+        unplug_after: number of bytes written after which the device vanishes (ENODEV)
+        xloader_hangs: if true, x-loader never says anything;
+                       if a number, it only hangs that many times (a reset() gets it going again)
+        seed: for the random number generator behind error_rate, to get repeatable faults
+        announce_id: if true, the ROM sends its ASIC ID unasked as soon as it starts, as it does over UART
+        commands_alone: if true, a transfer that starts with a command or a size is taken to be only that,
+                        and whatever else is in it is lost, so OMAP4(coalesce=True) can't boot it
+        """
+        super().__init__(0x0451, 0xd00f, bandwidth, latency, error_rate, seed, max_packet_size, path)
+        self.xloader_latency = xloader_latency
+        self.unplug_after = unplug_after
+        self.xloader_hangs = xloader_hangs
+        self.announce_id = announce_id
+        self.commands_alone = commands_alone
+        self._hanging = False
+
+        self.state = "rom" #rom, size, x-loader, bringup, u-boot size, u-boot, booted, or gone
+        self.images = {} #what was uploaded: {"x-loader": bytearray, "u-boot": bytearray}
+        self.resets = 0 #how many times it's been reset()
+        self.written = 0 #how many bytes have been write()n
+        self._pending = bytearray() #bytes written that don't make up a whole command yet
+        self._outbox = [self.ASIC_ID] if announce_id else [] #what read() will return next
+        self._remaining = 0 #bytes still to come of the image being uploaded
+        self._ready_at = None #when x-loader will say hello
+
+    def write(self, data):
+        n = len(data)
+        self._transfer(n)
+        if self.unplug_after is not None and self.written + n > self.unplug_after:
+            self.state = "gone"
+            raise OSError(errno.ENODEV, "No such device (simulated unplug)")
+        self.written += n
+        if self.commands_alone and self.state in ("rom", "size", "u-boot size") and not self._pending:
+            data = data[:4] #the ROM read 4 bytes, and the rest of the transfer went nowhere
+        self._pending += data
+        self._consume()
+        return n
+
+    def _consume(self):
+        # run the ROM (and x-loader) over whatever's been written so far
+        while self._pending:
+            if self.state in ("rom", "size", "u-boot size"):
+                if len(self._pending) < 4:
+                    return
+                word, self._pending = bytes(self._pending[:4]), self._pending[4:]
+                if self.state == "rom":
+                    if word == self.GET_ID:
+                        self._outbox.append(self.ASIC_ID)
+                    elif word == self.BOOT:
+                        self.state = "size"
+                    elif word == self.BOOT_NEXT:
+                        self.state = "gone" #off it goes to boot from somewhere else
+                    else:
+                        raise OSError(errno.EPROTO, "ROM doesn't understand %r (simulated)" % (word,))
+                else:
+                    self._remaining, = struct.unpack("I", word)
+                    stage = "x-loader" if self.state == "size" else "u-boot"
+                    self.images[stage] = bytearray()
+                    self.state = stage
+                    self._image_done()
+            elif self.state in ("x-loader", "u-boot"):
+                piece = self._pending[:self._remaining]
+                self._pending = self._pending[len(piece):]
+                self.images[self.state] += piece
+                self._remaining -= len(piece)
+                self._image_done()
+            else:
+                # talking to x-loader before it's said it's ready, or to a device that's already booted
+                state, self.state = self.state, "gone"
+                raise OSError(errno.EPROTO, "Device crashed: unexpected data in state %r (simulated)" % (state,))
+
+    def _image_done(self):
+        if self._remaining:
+            return
+        if self.state == "x-loader":
+            self.state = "bringup"
+            self._ready_at = time.monotonic() + self.xloader_latency
+            self._hanging = bool(self.xloader_hangs)
+            if self.xloader_hangs is not True and self.xloader_hangs:
+                self.xloader_hangs -= 1
+        elif self.state == "u-boot":
+            self.state = "booted"
+
+    def read(self, len):
+        self._transfer(0)
+        if not self._outbox and self.state == "bringup" and not self._hanging:
+            wait = self._ready_at - time.monotonic()
+            if self.timeout is None or wait <= self.timeout / 1000:
+                time.sleep(max(wait, 0))
+                self._outbox.append(self.BANNER)
+                self.state = "u-boot size"
+        if not self._outbox:
+            self._nothing_to_read()
+        data = self._outbox.pop(0)
+        data, rest = data[:len], data[len:]
+        if rest:
+            self._outbox.insert(0, rest)
+        return data
+
+    def reset(self):
+        """
+        start over from the ROM, which is what we hope a port reset does to a real one
+        """
+        self._transfer(0)
+        self.resets += 1
+        self.state = "rom"
+        self._pending = bytearray()
+        self._outbox = [self.ASIC_ID] if self.announce_id else []
+        self._remaining = 0
+        self._ready_at = None
+
+class SimulatedFastboot(_SimulatedDevice):
+    """
+    usage:
+        dev = SimulatedFastboot(bandwidth=40e6)
+        Fastboot(dev).flash([("boot", "boot.img")])
+        assert dev.partitions["boot"] == open("boot.img", "rb").read()
+    """
+
+    PARTITIONS = ("xloader", "bootloader", "boot", "recovery", "system", "cache", "userdata")
+
+    def __init__(self, bandwidth=None, latency=0, flash_latency=0, max_download_size=256 << 20,
+                 partitions=PARTITIONS, fail=(), error_rate=0, seed=None, max_packet_size=512,
+                 path="sim", vendor=0x18d1, product=0x4e40):
+        """
+        flash_latency: seconds it takes to write a partition
+        max_download_size: what getvar:max-download-size says, and the most download: accepts; None for no limit
+        partitions: the partitions flash: knows
+        fail: partitions flash: fails on anyway
+        the rest are as for SimulatedOMAP4
+        """
+        super().__init__(vendor, product, bandwidth, latency, error_rate, seed, max_packet_size, path)
+        self.flash_latency = flash_latency
+        self.max_download_size = max_download_size
+        self.fail = set(fail)
+
+        self.state = "command" #command, data, rebooted, or gone
+        self.partitions = dict.fromkeys(partitions) #{name: what was flashed there, or None}
+        self.commands = [] #every command received, in order
+        self._download = None #the last thing download:ed
+        self._remaining = 0 #bytes still to come of it
+        self._outbox = []
+
+    def write(self, data):
+        n = len(data)
+        self._transfer(n)
+        if self.state == "data":
+            if n > self._remaining:
+                self.state = "gone"
+                raise OSError(errno.EPROTO, "Device crashed: %d bytes more than download: said (simulated)" % (n - self._remaining,))
+            self._download += data
+            self._remaining -= n
+            if not self._remaining:
+                self.state = "command"
+                self._outbox.append(b"OKAY")
+            return n
+        if self.state != "command":
+            state, self.state = self.state, "gone"
+            raise OSError(errno.EPROTO, "Device crashed: unexpected data in state %r (simulated)" % (state,))
+        if n > 64:
+            self._outbox.append(b"FAILcommand too long")
+            return n
+        command = bytes(data).decode("ascii", "replace")
+        self.commands.append(command)
+        verb, _, arg = command.partition(":")
+        if verb == "getvar":
+            if arg == "max-download-size" and self.max_download_size is not None:
+                self._outbox.append(b"OKAY0x%08x" % self.max_download_size)
+            elif arg == "version":
+                self._outbox.append(b"OKAY0.5")
+            else:
+                self._outbox.append(b"FAILunknown variable")
+        elif verb == "download":
+            size = int(arg, 16)
+            if self.max_download_size is not None and size > self.max_download_size:
+                self._outbox.append(b"FAILdata too large")
+            else:
+                self._download, self._remaining = bytearray(), size
+                self.state = "data" if size else "command"
+                self._outbox.append(b"DATA%08x" % size)
+                if not size:
+                    self._outbox.append(b"OKAY")
+        elif verb == "flash":
+            if self._download is None:
+                self._outbox.append(b"FAILno image downloaded")
+            elif arg not in self.partitions:
+                self._outbox.append(b"FAILpartition '%s' not found" % arg.encode())
+            else:
+                self._outbox.append(b"INFOwriting '%s'..." % arg.encode())
+                time.sleep(self.flash_latency)
+                if arg in self.fail:
+                    self._outbox.append(b"FAILwrite failed")
+                else:
+                    self.partitions[arg] = bytes(self._download)
+                    self._outbox.append(b"OKAY")
+        elif verb == "reboot":
+            self._outbox.append(b"OKAY")
+            self.state = "rebooted"
+        else:
+            self._outbox.append(b"FAILunknown command")
+        return n
+
+    def read(self, len):
+        self._transfer(0)
+        if not self._outbox:
+            self._nothing_to_read()
+        return self._outbox.pop(0)[:len]
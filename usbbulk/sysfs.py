@@ -0,0 +1,44 @@
+"""
+helpers for reading Linux's view of the USB bus out of sysfs.
+
+Every USB device shows up as /sys/bus/usb/devices/<path>, where <path>
+is the "1-2.3" style bus/port path that BaseBulkUSB.enumerate() returns,
+with its descriptor fields as little text files inside.
+"""
+
+import os
+
+from .base import matches
+
+ROOT = "/sys/bus/usb/devices"
+
+def attr(path, name):
+    """
+    read sysfs attribute `name` of the device at bus/port `path` as a string,
+    or None if it doesn't have one (or has vanished in the meantime).
+    """
+    try:
+        with open(os.path.join(ROOT, path, name)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def devices(vendor, product):
+    """
+    list the bus/port paths of every device matching (vendor, product) (see base.matches())
+    """
+    try:
+        entries = os.listdir(ROOT)
+    except OSError:
+        return []
+    paths = []
+    for path in sorted(entries):
+        # interfaces ("1-2.3:1.0") and root hubs ("usb1") live here too
+        if ":" in path or not path[:1].isdigit():
+            continue
+        try:
+            if matches(int(attr(path, "idVendor"), 16), vendor) and matches(int(attr(path, "idProduct"), 16), product):
+                paths.append(path)
+        except (TypeError, ValueError):
+            continue # it unplugged while we were looking
+    return paths
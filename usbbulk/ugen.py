@@ -3,9 +3,183 @@ import os
 
 if "BSD" in os.uname().sysname:
     import fcntl, struct
-    import warnings
+    import glob
+    import time
+    import errno
+    import ctypes
+    import threading
     from .base import *
     
+    # <sys/ioccom.h>'s _IOW() and friends, so that the ioctl codes below are
+    # worked out from the structs they pass instead of copied out of a C compiler.
+    _IOCPARM_MASK = 0x1fff
+    _IOC_OUT = 0x40000000
+    _IOC_IN = 0x80000000
+    
+    def _IOC(inout, group, num, ctype):
+        return inout | ((ctypes.sizeof(ctype) & _IOCPARM_MASK) << 16) | (ord(group) << 8) | num
+    
+    _IOR = lambda group, num, ctype: _IOC(_IOC_OUT, group, num, ctype)
+    _IOW = lambda group, num, ctype: _IOC(_IOC_IN, group, num, ctype)
+    _IOWR = lambda group, num, ctype: _IOC(_IOC_IN | _IOC_OUT, group, num, ctype)
+    
+    _USB_MAX_STRING_LEN = 127
+    _USB_MAX_DEVNAMES = 4
+    _USB_MAX_DEVNAMELEN = 16
+    _USB_MAX_DEVICES = 128
+    
+    class _usb_device_info(ctypes.Structure):
+        # as in OpenBSD's <dev/usb/usb.h>. The size of this is part of the ioctl codes
+        # that use it, so if it's wrong for this kernel they fail with ENOTTY rather than
+        # scribbling over memory.
+        _fields_ = [("udi_bus", ctypes.c_uint8),
+                    ("udi_addr", ctypes.c_uint8),
+                    ("udi_product", ctypes.c_char * _USB_MAX_STRING_LEN),
+                    ("udi_vendor", ctypes.c_char * _USB_MAX_STRING_LEN),
+                    ("udi_release", ctypes.c_char * 8),
+                    ("udi_productNo", ctypes.c_uint16),
+                    ("udi_vendorNo", ctypes.c_uint16),
+                    ("udi_releaseNo", ctypes.c_uint16),
+                    ("udi_class", ctypes.c_uint8),
+                    ("udi_subclass", ctypes.c_uint8),
+                    ("udi_protocol", ctypes.c_uint8),
+                    ("udi_config", ctypes.c_uint8),
+                    ("udi_speed", ctypes.c_uint8),
+                    ("udi_power", ctypes.c_int),
+                    ("udi_nports", ctypes.c_int),
+                    ("udi_devnames", ctypes.c_char * _USB_MAX_DEVNAMELEN * _USB_MAX_DEVNAMES),
+                    ("udi_ports", ctypes.c_uint8 * 8), #hubs only: the address of the device on each port, or a USB_PORT_* status
+                    ("udi_serial", ctypes.c_char * _USB_MAX_STRING_LEN),
+                    ("udi_port", ctypes.c_uint8)]
+    
+    _USB_DEVICEINFO = _IOWR('U', 4, _usb_device_info) #on /dev/usbN, for any address on that bus
+    _USB_GET_DEVICEINFO = _IOR('U', 112, _usb_device_info) #on /dev/ugenN.00, for the device itself
+    
+    def _device_info(unit):
+        """
+        ask ugen unit for the USB_GET_DEVICEINFO of the device attached to it.
+        raises OSError (ENXIO) if there isn't one.
+        """
+        info = _usb_device_info()
+        fd = os.open("/dev/ugen%d.00" % unit, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, _USB_GET_DEVICEINFO, info)
+        finally:
+            os.close(fd)
+        return info
+    
+    def _topology(bus):
+        """
+        {device address: bus/port path} for every device on bus, worked out
+        the way usbdevs(8) does, by walking down the hubs from the root hub (address 1).
+        Empty if /dev/usbN can't be opened, which usually takes root.
+        """
+        paths = {}
+        try:
+            fd = os.open("/dev/usb%d" % bus, os.O_RDONLY)
+        except OSError:
+            return paths
+        try:
+            hubs = [(1, None)]
+            while hubs:
+                addr, path = hubs.pop()
+                info = _usb_device_info(udi_addr=addr)
+                try:
+                    fcntl.ioctl(fd, _USB_DEVICEINFO, info)
+                except OSError:
+                    continue
+                for port, child in enumerate(info.udi_ports[:info.udi_nports], 1):
+                    if 0 < child < _USB_MAX_DEVICES: #the rest are USB_PORT_* status codes, i.e. nothing there
+                        paths[child] = "%d-%d" % (bus, port) if path is None else "%s.%d" % (path, port)
+                        hubs.append((child, paths[child]))
+        finally:
+            os.close(fd)
+        return paths
+    
+    class _DeviceIndex:
+        """
+        which device is attached to which ugen(4) unit.
+        
+        The only way to find out is to open a unit's control endpoint, /dev/ugenN.00,
+        and ask. For a unit with nothing attached that fails straight away, but
+        opening one with a device on it is neither free nor polite (it may be in
+        the middle of a boot), so this remembers what's where: a refresh only asks
+        the units that were empty last time, and the occupied ones are only asked
+        again once their entries are MAX_AGE seconds old, or when find() is about
+        to open one, to make sure the device there is still the one we think.
+        
+        Entries are (vendor, product, path), where path is the bus/port path of
+        BaseBulkUSB.enumerate() when /dev/usbN will tell us the topology, and
+        "<bus>:<address>" as a last resort when it won't.
+        
+        Safe to share between threads (farm and scan mode open devices from several at once):
+        refresh(), lookup() and find() each hold a lock for as long as they're reading or changing the entries.
+        """
+        
+        # how long, in seconds, to take it on trust that a unit still has the same device on it
+        MAX_AGE = 1.0
+        
+        def __init__(self):
+            self._units = {} #{unit number: (vendor, product, path)}, for units with something attached
+            self._checked = None #time.monotonic() of the last time every unit was asked
+            self._lock = threading.RLock() #reentrant, since find() calls lookup() calls refresh()
+        
+        def refresh(self):
+            with self._lock:
+                full = self._checked is None or time.monotonic() - self._checked > self.MAX_AGE
+                if full:
+                    self._checked = time.monotonic()
+                topology = {} #{bus: _topology(bus)}, so that's done at most once per bus per refresh
+                for node in glob.glob("/dev/ugen*.00"):
+                    unit = int(os.path.basename(node)[len("ugen"):-len(".00")])
+                    if full or unit not in self._units:
+                        self._query(unit, topology)
+        
+        def _query(self, unit, topology=None):
+            """
+            ask unit what's attached to it, and update its entry; returns the entry, or None if nothing is.
+            """
+            try:
+                info = _device_info(unit)
+            except OSError as e:
+                if e.errno in (errno.EBUSY, errno.EACCES, errno.EPERM):
+                    return self._units.get(unit) #someone else has it open; it's still whatever it was
+                self._units.pop(unit, None)
+                return None
+            if topology is None:
+                topology = {}
+            if info.udi_bus not in topology:
+                topology[info.udi_bus] = _topology(info.udi_bus)
+            path = topology[info.udi_bus].get(info.udi_addr, "%d:%d" % (info.udi_bus, info.udi_addr))
+            self._units[unit] = entry = (info.udi_vendorNo, info.udi_productNo, path)
+            return entry
+        
+        def lookup(self, vendor, product, path=None):
+            """
+            list (path, unit) for every device matching (vendor, product) (and at path, if given), by path.
+            """
+            with self._lock:
+                self.refresh()
+                return sorted((p, unit) for unit, (v, d, p) in self._units.items()
+                              if matches(v, vendor) and matches(d, product) and (path is None or p == path))
+        
+        def find(self, vendor, product, path=None):
+            """
+            (path, unit) of the first device matching (vendor, product) (and at path, if given)
+            that is definitely still there, or None if there isn't one.
+            """
+            with self._lock:
+                for attempt in range(2):
+                    for p, unit in self.lookup(vendor, product, path):
+                        entry = self._query(unit)
+                        if entry is not None and entry[2] == p and matches(entry[0], vendor) and matches(entry[1], product):
+                            return p, unit
+                    # something moved; make the next lookup ask everyone again
+                    self._checked = None
+                return None
+    
+    _index = _DeviceIndex()
+    
     class BulkUSB(BaseBulkUSB):
         """
         wrap BSD's ugen(4) device into a file-like python class.
@@ -21,31 +195,38 @@ if "BSD" in os.uname().sysname:
         
         """
         
-        # DANGEROUS!
-        # these ioctl codes were extracted by writing a C program that
-        # essentially just did #include <dev/usb/usb.h> + printf().
-        # Googling suggests people have done things like ported the _IOW macro to python.
-        _USB_SET_SHORT_XFER = 0x80045571 
-        _USB_SET_TIMEOUT = 0x80045572
+        _USB_SET_SHORT_XFER = _IOW('U', 113, ctypes.c_int) #0x80045571
+        _USB_SET_TIMEOUT = _IOW('U', 114, ctypes.c_int) #0x80045572
+        
+        # ugen(4) chops big writes into packets itself, in the kernel,
+        # so the bigger the write() the fewer syscalls
+        TRANSFER_SIZE = 64*1024
 
-        def __init__(self, vendor, product, endpoint=1):
+        def __init__(self, vendor, product, endpoint=1, path=None):
             """
             
             endpoint defaults to '1' because that's the
             most common endpoint to have a bulk interface.
             """
-            super().__init__(vendor, product, endpoint)
+            super().__init__(vendor, product, endpoint, path)
             
-            warnings.warn("bsd_ugen_bulk does not implement device and endpoint scanning yet; it just assumes that you only have one USB device you want to work with at a time.")
-            #TODO: instead we should scan the devices with ioctl()s on /dev/ugen$I.00 for (VENDOR, PRODUCT)
-            device = 0
+            found = _index.find(vendor, product, path)
+            if found is None:
+                if path is None:
+                    raise OSError("Unable to find USB Device %s" % format_ids(vendor, product))
+                raise OSError("Unable to find USB Device %s at %s" % (format_ids(vendor, product), path))
+            self._path, unit = found
             
-            # rewrite (device: USB int id, endpoint: USB int id) to (device: unix device)
-            device = "/dev/ugen%d.%02d" % (device, endpoint)
+            # rewrite (device: ugen unit, endpoint: USB int id) to (device: unix device)
+            device = "/dev/ugen%d.%02d" % (unit, endpoint)
             
             self._dev = open(device, "wb+", 0)
             self._setShortTransfer()
-            self._setTimeout(self.timeout)
+            self.setTimeout(self.timeout)
+        
+        @classmethod
+        def enumerate(cls, vendor, product):
+            return [path for path, unit in _index.lookup(vendor, product)]
         
         def read(self, len):
             return self._dev.read(len)
@@ -53,6 +234,10 @@ if "BSD" in os.uname().sysname:
         def write(self, data):
             return self._dev.write(data)
         
+        def writev(self, buffers):
+            # one write(2) is one transfer on ugen(4), and writev(2) is one write(2)
+            return os.writev(self._dev.fileno(), buffers)
+        
         def close(self):
             return self._dev.close()
         
@@ -84,6 +269,8 @@ if "BSD" in os.uname().sysname:
         def setTimeout(self, timeout):
             """
             """
+            super().setTimeout(timeout) #validate, and remember it for the timeout property
+            timeout = self._timeout
             if timeout is None:
                 #  "The value 0 is used to indicate that there is no timeout."
                 timeout = 0 #
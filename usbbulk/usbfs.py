@@ -0,0 +1,226 @@
+import os
+import sys
+
+if sys.platform.startswith("linux") and os.path.isdir("/dev/bus/usb"):
+    import ctypes
+    import errno
+    import select
+    import collections
+
+    from .base import *
+    from . import sysfs
+    from .pinning import Pinned
+
+    # <linux/ioctl.h>, which python doesn't have a copy of
+    def _IOC(dir, type, nr, size):
+        return (dir << 30) | (size << 16) | (ord(type) << 8) | nr
+    _IO = lambda type, nr: _IOC(0, type, nr, 0)
+    _IOW = lambda type, nr, struct: _IOC(1, type, nr, ctypes.sizeof(struct))
+    _IOR = lambda type, nr, struct: _IOC(2, type, nr, ctypes.sizeof(struct))
+    _IOWR = lambda type, nr, struct: _IOC(3, type, nr, ctypes.sizeof(struct))
+
+    # <linux/usbdevice_fs.h>
+    class _usbdevfs_bulktransfer(ctypes.Structure):
+        _fields_ = [("ep", ctypes.c_uint),
+                    ("len", ctypes.c_uint),
+                    ("timeout", ctypes.c_uint), #in milliseconds
+                    ("data", ctypes.c_void_p)]
+
+    class _usbdevfs_urb(ctypes.Structure):
+        _fields_ = [("type", ctypes.c_ubyte),
+                    ("endpoint", ctypes.c_ubyte),
+                    ("status", ctypes.c_int),
+                    ("flags", ctypes.c_uint),
+                    ("buffer", ctypes.c_void_p),
+                    ("buffer_length", ctypes.c_int),
+                    ("actual_length", ctypes.c_int),
+                    ("start_frame", ctypes.c_int),
+                    ("number_of_packets", ctypes.c_int),
+                    ("error_count", ctypes.c_int),
+                    ("signr", ctypes.c_uint),
+                    ("usercontext", ctypes.c_void_p)]
+
+    USBDEVFS_BULK = _IOWR('U', 2, _usbdevfs_bulktransfer)
+    USBDEVFS_SETCONFIGURATION = _IOR('U', 5, ctypes.c_uint)
+    USBDEVFS_SUBMITURB = _IOR('U', 10, _usbdevfs_urb)
+    USBDEVFS_DISCARDURB = _IO('U', 11)
+    USBDEVFS_REAPURBNDELAY = _IOW('U', 13, ctypes.c_void_p)
+    USBDEVFS_CLAIMINTERFACE = _IOR('U', 15, ctypes.c_uint)
+    USBDEVFS_RELEASEINTERFACE = _IOR('U', 16, ctypes.c_uint)
+    USBDEVFS_RESET = _IO('U', 20)
+    USBDEVFS_URB_TYPE_BULK = 3
+
+    # We can't use fcntl.ioctl() for the URB calls: it copies small arguments
+    # into a temporary buffer, and the kernel hangs on to the address of the
+    # URB we submit to write its results back into it when it completes.
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.ioctl.argtypes = [ctypes.c_int, ctypes.c_ulong, ctypes.c_void_p]
+
+    def _ioctl(fd, request, arg=None):
+        r = _libc.ioctl(fd, request, arg)
+        if r < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return r
+
+    class BulkUSB(BaseBulkUSB):
+        """
+        talk to Linux's usbfs (/dev/bus/usb/BBB/DDD) directly with ioctl()s,
+        like libusb does, but without libusb (or pyusb) in the way.
+
+        Devices are found by walking sysfs.
+
+        Reference: <linux/usbdevice_fs.h>, and drivers/usb/core/devio.c for what it actually does.
+        """
+
+        # how many URBs write_stream() keeps in flight
+        STREAM_DEPTH = 4
+
+        def __init__(self, vendor, product, endpoint=1, path=None):
+            super().__init__(vendor, product, endpoint, path)
+
+            paths = sysfs.devices(vendor, product)
+            if path is not None:
+                paths = [p for p in paths if p == path]
+            if not paths:
+                if path is None:
+                    raise OSError("Unable to find USB Device %s" % format_ids(vendor, product))
+                raise OSError("Unable to find USB Device %s at %s" % (format_ids(vendor, product), path))
+            self._path = path = paths[0]
+
+            # find the interface our endpoint belongs to, and its packet size while we're there
+            self._interface = 0
+            for intf in sorted(os.listdir(os.path.join(sysfs.ROOT, path))):
+                if intf.startswith(path + ":") and os.path.isdir(os.path.join(sysfs.ROOT, path, intf, "ep_%02x" % endpoint)):
+                    self._interface = int(sysfs.attr(intf, "bInterfaceNumber"), 16)
+                    self.max_packet_size = int(sysfs.attr(os.path.join(intf, "ep_%02x" % endpoint), "wMaxPacketSize"), 16)
+                    break
+
+            node = "/dev/bus/usb/%03d/%03d" % (int(sysfs.attr(path, "busnum")), int(sysfs.attr(path, "devnum")))
+            self._fd = os.open(node, os.O_RDWR)
+            try:
+                if not sysfs.attr(path, "bConfigurationValue"): #empty means unconfigured
+                    _ioctl(self._fd, USBDEVFS_SETCONFIGURATION, ctypes.byref(ctypes.c_uint(1)))
+                _ioctl(self._fd, USBDEVFS_CLAIMINTERFACE, ctypes.byref(ctypes.c_uint(self._interface)))
+            except OSError:
+                os.close(self._fd)
+                raise
+
+            # writev() has to gather into memory it can point the kernel at; keep one around rather than allocate every time
+            self._scratch = None
+
+        @classmethod
+        def enumerate(cls, vendor, product):
+            return sysfs.devices(vendor, product)
+
+        def _bulk(self, ep, address, length):
+            xfer = _usbdevfs_bulktransfer(ep, length, self.timeout or 0, #0 means forever
+                                          address)
+            return _ioctl(self._fd, USBDEVFS_BULK, ctypes.byref(xfer))
+
+        def read(self, len):
+            buf = ctypes.create_string_buffer(len)
+            n = self._bulk(0b10000000 | self.endpoint, ctypes.addressof(buf), len)
+            return buf.raw[:n]
+
+        def write(self, data):
+            # the kernel copies out of data itself, so there's no need for us to first
+            with Pinned(data) as buf:
+                return self._bulk(self.endpoint, buf.address, len(buf))
+
+        def writev(self, buffers):
+            # a transfer has to come out of one buffer, so gather them into the scratch one
+            # (it's a command and a chunk at most, so this is the one place we still copy)
+            n = sum(len(b) for b in buffers)
+            if self._scratch is None or ctypes.sizeof(self._scratch) < n:
+                self._scratch = (ctypes.c_ubyte * max(n, self.transfer_size))()
+            view = memoryview(self._scratch).cast("B")
+            i = 0
+            for b in buffers:
+                view[i:i+len(b)] = b
+                i += len(b)
+            return self._bulk(self.endpoint, ctypes.addressof(self._scratch), n)
+
+        def write_stream(self, chunks, depth=None):
+            """
+            pipelined version of BaseBulkUSB.write_stream(), on USBDEVFS_SUBMITURB/REAPURB.
+
+            This is what libusb does for its asynchronous transfers:
+            queue up to `depth` URBs and only wait when they're all in flight.
+            usbfs has no timeouts on URBs, so we time them out ourselves with poll(),
+            which reports POLLOUT when there's a URB ready to reap.
+            The kernel takes its own copy of what an OUT URB points at when it's submitted,
+            so each chunk goes to it as it is, and is done with as soon as it's queued.
+            """
+            depth = depth or self.STREAM_DEPTH
+            urbs = []
+            free = collections.deque(range(depth))
+            inflight = collections.deque()
+            poller = select.poll()
+            poller.register(self._fd, select.POLLOUT)
+            total = 0
+
+            def reap(timeout, check=True):
+                # URBs on one endpoint complete in order, so what comes back is always the oldest
+                if not poller.poll(-1 if timeout is None else timeout):
+                    raise OSError(errno.ETIMEDOUT, "Timed out waiting for a bulk transfer to complete")
+                done = ctypes.c_void_p()
+                _ioctl(self._fd, USBDEVFS_REAPURBNDELAY, ctypes.byref(done))
+                i = inflight.popleft()
+                assert done.value == ctypes.addressof(urbs[i]), "usbfs reaped a URB out of order"
+                free.append(i)
+                urb = urbs[i]
+                if check:
+                    if urb.status:
+                        raise OSError(-urb.status, os.strerror(-urb.status))
+                    if urb.actual_length != urb.buffer_length:
+                        raise OSError(errno.EIO, "Short bulk write: %d of %d bytes" % (urb.actual_length, urb.buffer_length))
+
+            try:
+                for chunk in chunks:
+                    if not free:
+                        reap(self.timeout)
+                    i = free.popleft()
+                    n = len(chunk)
+                    if i == len(urbs):
+                        urbs.append(_usbdevfs_urb())
+
+                    urb = urbs[i]
+                    ctypes.memset(ctypes.byref(urb), 0, ctypes.sizeof(urb))
+                    urb.type = USBDEVFS_URB_TYPE_BULK
+                    urb.endpoint = self.endpoint
+                    urb.buffer_length = n
+                    # pin a view of our own, so that the caller can still release theirs
+                    with Pinned(memoryview(chunk)) as buf:
+                        urb.buffer = buf.address
+                        try:
+                            _ioctl(self._fd, USBDEVFS_SUBMITURB, ctypes.byref(urb))
+                        except OSError:
+                            free.appendleft(i)
+                            raise
+                    inflight.append(i)
+                    total += n
+
+                while inflight:
+                    reap(self.timeout)
+            finally:
+                # on the way out because of an error: the kernel still has pointers into
+                # the URBs we're about to drop, so take them back first
+                for i in inflight:
+                    try:
+                        _ioctl(self._fd, USBDEVFS_DISCARDURB, ctypes.byref(urbs[i]))
+                    except OSError:
+                        pass #it finished in the meantime
+                while inflight:
+                    reap(None, check=False)
+            return total
+
+        def reset(self):
+            _ioctl(self._fd, USBDEVFS_RESET)
+        
+        def close(self):
+            try:
+                _ioctl(self._fd, USBDEVFS_RELEASEINTERFACE, ctypes.byref(ctypes.c_uint(self._interface)))
+            except OSError:
+                pass #e.g. it's already gone off and rebooted into u-boot
+            os.close(self._fd)
@@ -1,4 +1,9 @@
-def readinto_io(self, target, chunksize=4096):
+import time
+import errno
+import queue
+import threading
+
+def readinto_io(self, target, chunksize=4096, depth=0, on_chunk=None):
     """
     A missing idiom.
     
@@ -6,12 +11,167 @@ def readinto_io(self, target, chunksize=4096):
      too small is going to be dominated by overhead
      too large is going to be dominated by blocking to wait for buffering to happen
     
+    If depth is given, reading happens in another thread, up to depth
+    chunks ahead of writing (see read_ahead()), so that a slow read()
+    (say, one that's decompressing) and a slow target overlap instead of
+    taking turns; the chunks go through write_chunks(), and on_chunk is as for it.
+    
+    returns the number of bytes written
+    
     Inspired by python-requests's request.iter_content()
     """
+    if depth:
+        return write_chunks(read_ahead(self, chunksize, depth), target, on_chunk)
+    total = 0
     while True:
         chunk = self.read(chunksize)
         if not chunk: break
         amt = target.write(chunk)
+        total += len(chunk)
         #print("wrote",amt,"bytes") #DEBUG
+    return total
 # TODO: attach this to a suitably high-level class in the IO hierarchy
 
+def read_ahead(f, chunksize=4096, depth=4):
+    """
+    read binary file f in chunksize pieces on a separate thread,
+    keeping up to depth of them ready and waiting.
+    
+    Yields memoryviews of a ring of depth buffers that are reused as we go,
+    so each is only good until the next one is asked for; the consumer
+    must be done with (e.g. have copied) a chunk before moving on.
+    Every chunk is full-sized except maybe the last.
+    
+    If the read fails, the exception comes out of the generator, in order.
+    """
+    ring = [bytearray(chunksize) for i in range(depth)]
+    free = queue.Queue()
+    for buf in ring:
+        free.put(buf)
+    full = queue.Queue()
+    stop = threading.Event()
+    
+    def produce():
+        try:
+            while not stop.is_set():
+                buf = free.get()
+                if buf is None: #the consumer's gone
+                    return
+                n = 0
+                with memoryview(buf) as view:
+                    while n < chunksize:
+                        r = f.readinto(view[n:])
+                        if not r:
+                            break
+                        n += r
+                if n:
+                    full.put((buf, n))
+                if n < chunksize:
+                    break
+            full.put(None)
+        except BaseException as e:
+            full.put(e)
+    
+    producer = threading.Thread(target=produce, name="read_ahead", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = full.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            buf, n = item
+            with memoryview(buf) as view, view[:n] as chunk:
+                yield chunk
+            free.put(buf)
+    finally:
+        stop.set()
+        free.put(None) #in case it's waiting for a buffer
+        producer.join()
+
+def write_chunks(chunks, target, on_chunk=None, header=None):
+    """
+    write each of the buffers in chunks to target, through
+    target.write_stream() if it has one (see usbbulk.base.BaseBulkUSB),
+    so that backends which can pipeline transfers get to.
+    
+    If header (a buffer) is given, it goes first, together with the first chunk
+    in a single write, through target.writev() if it has one, to save it a transfer of its own;
+    the rest of the chunks go out just as they would have without it.
+    
+    on_chunk(nbytes, seconds), if given, is called after each chunk with how long target took over it.
+    (With a pipelining write_stream() that's how long it took to queue, not to reach the device.)
+    
+    returns the number of bytes of chunks written (not counting header)
+    """
+    total = 0
+    def timed():
+        nonlocal total
+        for chunk in chunks:
+            start = time.monotonic()
+            yield chunk
+            total += len(chunk)
+            if on_chunk is not None:
+                on_chunk(len(chunk), time.monotonic() - start)
+    
+    stream = timed()
+    try:
+        if header is not None:
+            first = next(stream, None)
+            buffers = [header] if first is None else [header, first]
+            if hasattr(target, "writev"):
+                target.writev(buffers)
+            else:
+                target.write(b"".join(buffers))
+        if hasattr(target, "write_stream"):
+            target.write_stream(stream)
+        else:
+            for chunk in stream:
+                target.write(chunk)
+    finally:
+        stream.close() #if target failed partway, this lets go of the chunk it was holding
+        if hasattr(chunks, "close"):
+            chunks.close()
+    return total
+
+def write_buffer(buf, target, chunksize=4096, max_packet_size=None, on_chunk=None, header=None):
+    """
+    write all of buffer-like buf to target in chunksize pieces, without copying it.
+    
+    Unlike readinto_io(), this never allocates: the chunks are memoryview slices of buf.
+    Hand it a mmap and the only copy made is the one into the kernel.
+    The chunks go out through write_chunks().
+    
+    If max_packet_size is given, target is taken to be a USB bulk pipe,
+    and if buf ends exactly on a packet boundary a zero-length packet is
+    sent after it, so that the other end can tell the transfer is over.
+    Leave it out when the other end already knows how much is coming
+    (as the OMAP ROM does), since then the extra packet is just noise.
+    
+    on_chunk and header are as for write_chunks().
+    
+    returns the number of bytes of buf written
+    """
+    with memoryview(buf) as raw, raw.cast("B") as view: #cast so that slicing and len() count bytes
+        
+        def chunks():
+            for i in range(0, len(view), chunksize):
+                # release each slice as we go, or the `with` above can't release view
+                with view[i:i+chunksize] as chunk:
+                    yield chunk
+            if max_packet_size and len(view) % max_packet_size == 0:
+                yield b""
+        
+        write_chunks(chunks(), target, on_chunk, header)
+        return len(view)
+
+def is_timeout(e):
+    """
+    whether OSError e means "timed out" rather than "broke".
+    
+    pyusb raises a USBError (an IOError) with errno set, ugen(4) a plain OSError;
+    since neither are constructed in a way that promotes them to TimeoutError,
+    we have to look at errno ourselves.
+    """
+    return isinstance(e, TimeoutError) or getattr(e, "errno", None) == errno.ETIMEDOUT